@@ -41,6 +41,9 @@ class AuthRequestHandler(six.moves.BaseHTTPServer.BaseHTTPRequestHandler):
     # False means no authentiation
     DO_AUTH = 1
 
+    # name of the user authenticated for the current request
+    auth_user = None
+
     def parse_request(self):
         if not six.moves.BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self):
             return False
@@ -59,6 +62,7 @@ class AuthRequestHandler(six.moves.BaseHTTPServer.BaseHTTPRequestHandler):
             if not self.get_userinfo(user, password, self.command):
                 self.send_autherror(401, b"Authorization Required")
                 return False
+            self.auth_user = user
         return True
 
     def send_autherror(self, code, message=None):
@@ -39,7 +39,9 @@ class Section:
     def __repr__(self):
         return self.__parser.items(self.name)
 
-    def getboolean(self, name):
+    def getboolean(self, name, default=False):
+        if name not in self:
+            return default
         return self.__parser.getboolean(self.name, name)
 
     def __contains__(self, name):
@@ -7,20 +7,26 @@ from __future__ import absolute_import
 from . import AuthServer
 from six.moves import urllib
 import logging
+import itertools
+import os
+import uuid
 
 from .propfind import PROPFIND
-from .report import REPORT
+from .snapshot import Snapshot
+from .report import create_report
 from .delete import DELETE
 from .davcopy import COPY
 from .davmove import MOVE
 
-from .utils import rfc1123_date, IfParser, tokenFinder
-from .errors import DAV_Error, DAV_NotFound
+from .utils import rfc1123_date, IfParser, tokenFinder, parse_range, \
+    parse_http_date, parse_etags, parse_prefer
+from .errors import DAV_Error, DAV_NotFound, DAV_ConditionFailed
 
 from .constants import DAV_VERSION_1, DAV_VERSION_2
 from .locks import LockManager
-import gzip
-import io
+from .throttle import throttle
+from .compression import GZIP_LEVEL, accepts_gzip, compressible, \
+    gzip_etag, gzip_stream, parse_skip_types
 
 from pywebdav import __version__
 
@@ -31,6 +37,26 @@ log = logging.getLogger(__name__)
 
 BUFFER_SIZE = 128 * 1000  # 128 Ko
 
+# a Range header asking for more parts is ignored
+MAX_RANGES = 100
+
+# request headers evaluated by DAVRequestHandler._precondition()
+CONDITIONAL_HEADERS = ('If-Match', 'If-None-Match', 'If-Modified-Since',
+                       'If-Unmodified-Since')
+
+# defaults for persistent connections, see [DAV] keepalive_* options
+KEEPALIVE_TIMEOUT = 15
+KEEPALIVE_MAX_REQUESTS = 100
+
+# body of an answer naming the condition which failed (RFC 4918 16)
+DAV_ERROR = ('<?xml version="1.0" encoding="utf-8"?>\n'
+             '<D:error xmlns:D="DAV:"><D:%s/></D:error>')
+
+
+def _is_iterator(DATA):
+    """ tell if DATA is a generated body, e.g. a streamed multistatus """
+    return hasattr(DATA, '__next__') and not hasattr(DATA, 'read')
+
 
 class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
     """Simple DAV request handler with
@@ -54,38 +80,292 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
     """
 
     server_version = "DAV/" + __version__
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, do not let Nagle's
+    # algorithm delay them on a persistent connection
+    disable_nagle_algorithm = True
+
+    # a throttle.BandwidthLimiter shaping response bodies, None for line rate
+    bandwidth_limiter = None
     encode_threshold = 1400  # common MTU
 
-    def send_body(self, DATA, code=None, msg=None, desc=None,
-                  ctype='application/octet-stream', headers={}):
-        """ send a body in one part """
-        log.debug("Use send_body method")
+    def setup(self):
+        AuthServer.AuthRequestHandler.setup(self)
+        self.init_connection()
+
+    def init_connection(self):
+        """ reset the per connection state
+
+        Called by setup() and by servers which provide rfile and
+        wfile themselves instead of using setup().
+        """
+        self._requests_served = 0
+        self._connection_bucket = None
+
+    def handle_one_request(self):
+        """ wait for and handle the next request on this connection
+
+        While waiting the connection is reported idle to the server
+        (if it supports it) so that it can be reaped once the
+        keep-alive timeout expired.
+
+        """
+        connection_idle = getattr(self.server, 'connection_idle', None)
+        timeout = self._keepalive_timeout()
+        if connection_idle is not None and timeout > 0:
+            connection_idle(self.connection, timeout,
+                            first=not self._requests_served)
+
+        AuthServer.AuthRequestHandler.handle_one_request(self)
+
+    def parse_request(self):
+        connection_busy = getattr(self.server, 'connection_busy', None)
+        if connection_busy is not None:
+            connection_busy(self.connection)
+
+        self._requests_served += 1
+        return AuthServer.AuthRequestHandler.parse_request(self)
+
+    def _keepalive_timeout(self):
+        """ idle timeout of a persistent connection, 0 disables keep-alive """
+        return float(self._config.DAV.get('keepalive_timeout',
+                                          KEEPALIVE_TIMEOUT))
+
+    def _keepalive_max_requests(self):
+        """ number of requests served per connection, 0 means unlimited """
+        return int(self._config.DAV.get('keepalive_max_requests',
+                                        KEEPALIVE_MAX_REQUESTS))
+
+    def _send_connection_headers(self):
+        """ announce whether the connection is kept alive after this response """
+        timeout = self._keepalive_timeout()
+        max_requests = self._keepalive_max_requests()
+        if (self.close_connection or timeout <= 0 or
+                (max_requests and self._requests_served >= max_requests) or
+                getattr(self.server, 'saturated', False) or
+                getattr(self.server, 'draining', False)):
+            self.send_header('Connection', 'close')
+            return
+
+        self.send_header('Connection', 'Keep-Alive')
+        if max_requests:
+            self.send_header('Keep-Alive', 'timeout=%d, max=%d' % (
+                timeout, max_requests - self._requests_served))
+        else:
+            self.send_header('Keep-Alive', 'timeout=%d' % timeout)
+
+    def _close_unread_body(self):
+        """ the request body will not be read: do not reuse the connection """
+        if ('Content-Length' in self.headers or
+                'Transfer-Encoding' in self.headers):
+            self.close_connection = True
+
+    def _bandwidth_buckets(self):
+        """ token buckets the current response has to draw from """
+        limiter = self.bandwidth_limiter
+        if not limiter:
+            return []
+
+        if self._connection_bucket is None:
+            self._connection_bucket = limiter.connection_bucket()
+        return limiter.buckets(self.auth_user, self._connection_bucket)
+
+    def _write_body(self, buf):
+        """ write a part of the response body, shaped if configured """
+        buckets = self._bandwidth_buckets()
+        if not buckets:
+            self.wfile.write(buf)
+            return
+
+        view = memoryview(buf)
+        for start in range(0, len(view), BUFFER_SIZE):
+            block = view[start:start + BUFFER_SIZE]
+            throttle(buckets, len(block))
+            self.wfile.write(block)
+
+    def _write_chunk(self, buf):
+        """ write one chunk of a chunked transfer-encoded body """
+        if not buf:
+            # an empty chunk would terminate the body
+            return
+        self.wfile.write(b"%x\r\n" % len(buf))
+        self._write_body(buf)
+        self.wfile.write(b"\r\n")
+
+    def _sendfile(self, DATA, chunked=False):
+        """ send DATA straight from its file descriptor
+
+        Uses os.sendfile (through socket.sendfile) when DATA has a
+        fileno() and a length, e.g. a filesystem Resource, so that the
+        content never gets copied into userspace.
+
+        Returns False, without having sent anything, if DATA is not
+        backed by a file descriptor.
+        """
+        try:
+            DATA.fileno()
+            offset = DATA.tell()
+            count = len(DATA)
+        except (AttributeError, TypeError, OSError, ValueError):
+            return False
+
+        log.debug("Use sendfile")
+        if chunked:
+            self.wfile.write(b"%x\r\n" % count)
+        try:
+            self._send_fd(DATA, offset, count)
+        finally:
+            DATA.close()
+        if chunked:
+            self.wfile.write(b"\r\n")
+        return True
+
+    def _send_fd(self, DATA, offset, count):
+        """ send count bytes from offset of the file behind DATA
+
+        The offset is handed to sendfile, or to pread if the connection
+        can not sendfile, so the file position is never used and one
+        descriptor serves any number of ranges.
+        """
+        sendfile = getattr(self.connection, 'sendfile', None)
+        if sendfile is None:
+            fd = DATA.fileno()
+            while count > 0:
+                buf = os.pread(fd, min(count, BUFFER_SIZE), offset)
+                if not buf:
+                    break
+                self._write_body(buf)
+                offset += len(buf)
+                count -= len(buf)
+            return
+
+        buckets = self._bandwidth_buckets()
+        if not buckets:
+            sendfile(DATA, offset, count)
+            return
+
+        while count > 0:
+            block = min(count, BUFFER_SIZE)
+            throttle(buckets, block)
+            sendfile(DATA, offset, block)
+            offset += block
+            count -= block
+
+    def _write_range(self, DATA, offset, count):
+        """ write count bytes of DATA from offset """
+        try:
+            DATA.fileno()
+        except (AttributeError, OSError, ValueError):
+            pass
+        else:
+            self._send_fd(DATA, offset, count)
+            return
 
-        self.send_response(code, message=msg)
-        self.send_header("Connection", "close")
+        DATA.seek(offset)
+        while count > 0:
+            buf = DATA.read(min(count, BUFFER_SIZE))
+            if not buf:
+                break
+            self._write_body(buf)
+            count -= len(buf)
+
+    def _start_response(self, code, msg=None, headers={}):
+        """ send the status line and the headers common to all bodies """
+        self.send_response(int(code), message=msg)
+        self._send_connection_headers()
         self.send_header("Accept-Ranges", "bytes")
         self.send_header('Date', rfc1123_date())
 
         self._send_dav_version()
 
         for a, v in headers.items():
-            v = v.encode() if isinstance(v, six.text_type) else v
             self.send_header(a, v)
 
+    def _gzip_allowed(self, ctype):
+        """ tell if content of type ctype may be sent gzip encoded """
+        level = int(self._config.DAV.get('gzip_level', GZIP_LEVEL))
+        if level <= 0 or 'Range' in self.headers:
+            # byte ranges refer to the identity encoding
+            return False
+
+        skip_types = parse_skip_types(
+            self._config.DAV.get('gzip_skip_types', ''))
+        return compressible(ctype, skip_types)
+
+    def _content_coding(self, DATA, ctype, headers):
+        """ tell if the response varies with Accept-Encoding and if DATA
+        has to be compressed """
+        if 'Content-Encoding' in headers:
+            # encoded by the interface already
+            return True, False
+
+        if not DATA or not self._gzip_allowed(ctype):
+            return False, False
+
+        try:
+            if len(DATA) <= self.encode_threshold:
+                return False, False
+        except TypeError:
+            # a stream of unknown length
+            pass
+
+        return True, accepts_gzip(self.headers.get('Accept-Encoding'))
+
+    @staticmethod
+    def _gzip_headers(headers):
+        """ headers of the representation compressed on the fly, which
+        needs its own entity tag """
+        headers = dict(headers)
+        for name in 'Etag', 'ETag':
+            if headers.get(name):
+                headers[name] = gzip_etag(headers[name])
+        return headers
+
+    def _gzip_body(self, blocks):
+        """ compress the blocks of a body on the fly """
+        level = int(self._config.DAV.get('gzip_level', GZIP_LEVEL))
+        return gzip_stream(blocks, level)
+
+    def _body_blocks(self, DATA):
+        """ iterate over the parts of a response body """
+        if isinstance(DATA, (six.binary_type, six.text_type)):
+            yield DATA
+        elif (_is_iterator(DATA) or
+              self._config.DAV.getboolean('http_response_use_iterator')):
+            for buf in DATA:
+                yield buf
+        else:
+            # Don't use iterator, it's a compatibility option
+            yield DATA.read()
+
+    def send_body(self, DATA, code=None, msg=None, desc=None,
+                  ctype='application/octet-stream', headers={}):
+        """ send a body in one part """
+        log.debug("Use send_body method")
+
+        if isinstance(DATA, six.text_type):
+            DATA = DATA.encode('utf-8')
+
+        vary, gzipped = self._content_coding(DATA, ctype, headers)
+        if gzipped and not isinstance(DATA, bytes):
+            if (self.request_version != 'HTTP/1.0' and
+                    self._config.DAV.getboolean('chunked_http_response')):
+                # the length of a stream compressed on the fly is unknown
+                return self.send_body_chunks(DATA, code, msg, desc, ctype,
+                                             headers)
+            gzipped = False
+
+        if gzipped:
+            headers = self._gzip_headers(headers)
+        self._start_response(code, msg, headers)
+
+        if vary:
+            self.send_header('Vary', 'Accept-Encoding')
+
         if DATA:
             try:
-                if 'gzip' in self.headers.get('Accept-Encoding', '').split(',') \
-                        and len(DATA) > self.encode_threshold:
-                    buffer = io.BytesIO()
-                    output = gzip.GzipFile(mode='wb', fileobj=buffer)
-                    if isinstance(DATA, str) or isinstance(DATA, six.text_type):
-                        output.write(DATA)
-                    else:
-                        for buf in DATA:
-                            output.write(buf)
-                    output.close()
-                    buffer.seek(0)
-                    DATA = buffer.getvalue()
+                if gzipped:
+                    DATA = b''.join(self._gzip_body([DATA]))
                     self.send_header('Content-Encoding', 'gzip')
 
                 self.send_header('Content-Length', len(DATA))
@@ -96,25 +376,25 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
             self.send_header('Content-Length', 0)
 
         self.end_headers()
-        if DATA:
-            if isinstance(DATA, str) or isinstance(DATA, six.text_type) or isinstance(DATA, bytes):
+        if DATA and self.command != 'HEAD':
+            if isinstance(DATA, bytes):
                 log.debug("Don't use iterator")
-                self.wfile.write(DATA)
-            else:
+                self._write_body(DATA)
+            elif not self._sendfile(DATA):
                 if self._config.DAV.getboolean('http_response_use_iterator'):
                     # Use iterator to reduce using memory
                     log.debug("Use iterator")
                     for buf in DATA:
-                        self.wfile.write(buf)
+                        self._write_body(buf)
                         self.wfile.flush()
                 else:
                     # Don't use iterator, it's a compatibility option
                     log.debug("Don't use iterator")
                     res = DATA.read()
                     if isinstance(res,bytes):
-                        self.wfile.write(res)
+                        self._write_body(res)
                     else:
-                        self.wfile.write(res.encode('utf8'))
+                        self._write_body(res.encode('utf8'))
         return None
 
     def send_body_chunks_if_http11(self, DATA, code, msg=None, desc=None,
@@ -122,6 +402,9 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
                                    headers={}):
         if (self.request_version == 'HTTP/1.0' or
             not self._config.DAV.getboolean('chunked_http_response')):
+            if _is_iterator(DATA):
+                # the length of a generated body is only known at its end
+                DATA = b''.join(DATA)
             self.send_body(DATA, code, msg, desc, ctype, headers)
         else:
             self.send_body_chunks(DATA, code, msg, desc, ctype, headers)
@@ -132,69 +415,51 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
 
         self.responses[207] = (msg, desc)
         self.send_response(code, message=msg)
-        self.send_header("Content-type", ctype)
+        self._send_connection_headers()
+        self.send_header("Content-Type", ctype)
         self.send_header("Transfer-Encoding", "chunked")
+        if self.command in ('GET', 'HEAD'):
+            self.send_header("Accept-Ranges", "bytes")
         self.send_header('Date', rfc1123_date())
 
         self._send_dav_version()
 
+        vary, gzipped = self._content_coding(DATA, ctype, headers)
+        if gzipped:
+            headers = self._gzip_headers(headers)
         for a, v in headers.items():
             self.send_header(a, v)
 
-        GZDATA = None
-        if DATA:
-            if ('gzip' in self.headers.get('Accept-Encoding', '').split(',')
-                and len(DATA) > self.encode_threshold):
-                buffer = io.BytesIO()
-                output = gzip.GzipFile(mode='wb', fileobj=buffer)
-                if isinstance(DATA, bytes):
-                    output.write(DATA)
-                else:
-                    for buf in DATA:
-                        buf = buf.encode() if isinstance(buf, six.text_type) else buf
-                        output.write(buf)
-                output.close()
-                buffer.seek(0)
-                GZDATA = buffer.getvalue()
-                self.send_header('Content-Encoding', 'gzip')
-
-            self.send_header('Content-Length', len(DATA))
-            self.send_header('Content-Type', ctype)
-
-        else:
-            self.send_header('Content-Length', 0)
+        if vary:
+            self.send_header('Vary', 'Accept-Encoding')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
 
         self.end_headers()
 
-        if GZDATA:
-            self.wfile.write(GZDATA)
+        if self.command == 'HEAD':
+            return
+
+        if gzipped:
+            for buf in self._gzip_body(self._body_blocks(DATA)):
+                self._write_chunk(buf)
 
         elif DATA:
             DATA = DATA.encode() if isinstance(DATA, six.text_type) else DATA
             if isinstance(DATA, six.binary_type):
-                self.wfile.write(b"%s\r\n" % hex(len(DATA))[2:].encode())
-                self.wfile.write(DATA)
-                self.wfile.write(b"\r\n")
-                self.wfile.write(b"0\r\n")
-                self.wfile.write(b"\r\n")
-            else:
-                if self._config.DAV.getboolean('http_response_use_iterator'):
+                self._write_chunk(DATA)
+            elif not self._sendfile(DATA, chunked=True):
+                if (_is_iterator(DATA) or self._config.DAV.getboolean(
+                        'http_response_use_iterator')):
                     # Use iterator to reduce using memory
                     for buf in DATA:
                         buf = buf.encode() if isinstance(buf, six.text_type) else buf
-                        self.wfile.write((hex(len(buf))[2:] + "\r\n").encode())
-                        self.wfile.write(buf)
-                        self.wfile.write(b"\r\n")
-
-                    self.wfile.write(b"0\r\n")
-                    self.wfile.write(b"\r\n")
+                        self._write_chunk(buf)
                 else:
                     # Don't use iterator, it's a compatibility option
-                    self.wfile.write((hex(len(DATA))[2:] + "\r\n").encode())
-                    self.wfile.write(DATA.read())
-                    self.wfile.write(b"\r\n")
-                    self.wfile.write(b"0\r\n")
-                    self.wfile.write(b"\r\n")
+                    self._write_chunk(DATA.read())
+
+        self.wfile.write(b"0\r\n\r\n")
 
     def _send_dav_version(self):
         if self._config.DAV.getboolean('lockemulation'):
@@ -227,43 +492,51 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
         uri = urllib.parse.urljoin(self.get_baseuri(dc), self.path)
         uri = urllib.parse.unquote(uri).encode()
 
+        res = self._snapshot(uri)
         headers = {}
 
         # get the last modified date (RFC 1123!)
-        try:
-            headers['Last-Modified'] = dc.get_prop(
-                uri, "DAV:", "getlastmodified")
-        except DAV_NotFound:
-            pass
+        last_modified = res.get('getlastmodified')
+        if last_modified is not None:
+            headers['Last-Modified'] = last_modified
 
         # get the ETag if any
-        try:
-            headers['Etag'] = dc.get_prop(uri, "DAV:", "getetag")
-        except DAV_NotFound:
-            pass
+        etag = res.get('getetag')
+        if etag is not None:
+            headers['Etag'] = etag
+
+        # answer conditional requests before the content is opened
+        status_code = self._precondition(res)
+        if status_code == 304:
+            if etag is not None and self._gzip_wanted(res) and \
+                    gzip_etag(etag) in self.headers.get('If-None-Match', ''):
+                # revalidated the gzip representation
+                headers['Etag'] = gzip_etag(etag)
+            self._start_response(304, None, headers)
+            self.end_headers()
+            return status_code
+        elif status_code:
+            self.send_status(status_code)
+            return status_code
 
         # get the content type
-        try:
-            if uri.endswith(b'/'):
-                # we could do away with this very non-local workaround for
-                # _get_listing if the data could have a type attached
-                content_type = 'text/html;charset=utf-8'
-            else:
-                content_type = dc.get_prop(uri, "DAV:", "getcontenttype")
-        except DAV_NotFound:
-            content_type = "application/octet-stream"
+        if uri.endswith(b'/'):
+            # we could do away with this very non-local workaround for
+            # _get_listing if the data could have a type attached
+            content_type = 'text/html;charset=utf-8'
+        else:
+            content_type = res.get('getcontenttype',
+                                   "application/octet-stream")
 
-        range = None
         status_code = 200
-        if 'Range' in self.headers:
-            p = self.headers['Range'].find("bytes=")
-            if p != -1:
-                range = self.headers['Range'][p + 6:].split("-")
-                status_code = 206
 
         # get the data
         try:
-            data = dc.get_data(uri, range)
+            data = None
+            if with_body:
+                data = self._get_gzip_data(dc, uri, content_type, headers)
+            if data is None:
+                data = dc.get_data(uri)
         except DAV_Error as error:
             (ec, dd) = error.args
             self.send_status(ec)
@@ -272,18 +545,176 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
         # send the data
         if with_body is False:
             data = None
+        elif 'Range' in self.headers and 'Content-Encoding' not in headers:
+            status_code = self._send_ranges(data, content_type, headers)
+            if status_code is not None:
+                return status_code
+            status_code = 200
 
         if isinstance(data, str) or isinstance(data, six.text_type):
             self.send_body(data, status_code, None, None, content_type,
                            headers)
         else:
-            headers['Keep-Alive'] = 'timeout=15, max=86'
-            headers['Connection'] = 'Keep-Alive'
             self.send_body_chunks_if_http11(data, status_code, None, None,
                                             content_type, headers)
 
         return status_code
 
+    def _snapshot(self, uri):
+        """ return a Snapshot of the resource at uri for this request """
+        return Snapshot(self.IFACE_CLASS, uri, self)
+
+    def _precondition(self, res):
+        """ evaluate the conditional headers of the request (RFC 7232)
+
+        res is the Snapshot of the resource. Returns None if the request
+        is to be performed, else the status code to answer with: 304 for
+        GET and HEAD, 412 otherwise.
+        """
+        if not any(name in self.headers for name in CONDITIONAL_HEADERS):
+            return None
+
+        etag = res.get('getetag')
+        if etag is not None:
+            etag = parse_etags(etag)[0]
+        last_modified = res.get('getlastmodified')
+        if last_modified is not None:
+            last_modified = parse_http_date(last_modified)
+
+        def matches(hdr, weak):
+            tags = parse_etags(hdr)
+            if tags == [(False, '*')]:
+                return res.exists
+            if etag is None:
+                return False
+            if weak:
+                # a client given the gzip representation sends its tag
+                names = (etag[1], etag[1] + '-gzip') if \
+                    self._gzip_wanted(res) else (etag[1], )
+                return any(tag in names for is_weak, tag in tags)
+            return not etag[0] and (False, etag[1]) in tags
+
+        safe = self.command in ('GET', 'HEAD')
+        if 'If-Match' in self.headers:
+            if not matches(self.headers['If-Match'], False):
+                return 412
+        elif 'If-Unmodified-Since' in self.headers:
+            date = parse_http_date(self.headers['If-Unmodified-Since'])
+            if (date is not None and last_modified is not None and
+                    last_modified > date):
+                return 412
+
+        if 'If-None-Match' in self.headers:
+            if matches(self.headers['If-None-Match'], True):
+                return 304 if safe else 412
+        elif safe and 'If-Modified-Since' in self.headers:
+            date = parse_http_date(self.headers['If-Modified-Since'])
+            if (date is not None and last_modified is not None and
+                    last_modified <= date):
+                return 304
+
+        return None
+
+    def _gzip_wanted(self, res):
+        """ tell if the content of res may be sent gzip encoded to this
+        client """
+        return (accepts_gzip(self.headers.get('Accept-Encoding')) and
+                self._gzip_allowed(res.get('getcontenttype',
+                                           'application/octet-stream')))
+
+    def _if_range(self, headers):
+        """ tell if the Range header applies according to If-Range """
+        value = self.headers.get('If-Range', '').strip()
+        if not value:
+            return True
+
+        if value.startswith('"') or value.startswith('W/'):
+            # only strong validators match
+            return value == headers.get('Etag') and not value.startswith('W/')
+
+        date = parse_http_date(value)
+        return (date is not None and 'Last-Modified' in headers and
+                date == parse_http_date(headers['Last-Modified']))
+
+    def _send_ranges(self, data, ctype, headers):
+        """ answer a Range request with the asked for parts of data
+
+        A single range is sent as it is, several ones as
+        multipart/byteranges, all of them from the same data object.
+        Returns the status code, or None if the Range header does not
+        apply and the whole content has to be sent.
+        """
+        try:
+            size = len(data)
+        except TypeError:
+            return None
+
+        ranges = parse_range(self.headers['Range'], size)
+        if ranges is None or len(ranges) > MAX_RANGES or \
+                not self._if_range(headers):
+            return None
+
+        if not ranges:
+            if hasattr(data, 'close'):
+                data.close()
+            headers['Content-Range'] = 'bytes */%d' % size
+            self.send_body(None, 416, headers=headers)
+            return 416
+
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+            parts = [(b'', first, last - first + 1)]
+            trailer = b''
+        else:
+            boundary = uuid.uuid4().hex
+            parts = []
+            for first, last in ranges:
+                head = ('\r\n--%s\r\nContent-Type: %s\r\n'
+                        'Content-Range: bytes %d-%d/%d\r\n\r\n' %
+                        (boundary, ctype, first, last, size))
+                parts.append((head.encode(), first, last - first + 1))
+            trailer = ('\r\n--%s--\r\n' % boundary).encode()
+            ctype = 'multipart/byteranges; boundary=%s' % boundary
+
+        self._start_response(206, None, headers)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', sum(
+            len(head) + count for head, first, count in parts) + len(trailer))
+        self.end_headers()
+
+        try:
+            for head, first, count in parts:
+                if head:
+                    self._write_body(head)
+                self._write_range(data, first, count)
+            if trailer:
+                self._write_body(trailer)
+        finally:
+            if hasattr(data, 'close'):
+                data.close()
+        return 206
+
+    def _get_gzip_data(self, dc, uri, content_type, headers):
+        """ ask the interface for content it has gzip compressed at hand
+
+        Returns None if there is none or the client does not want it,
+        else headers are updated for the compressed representation.
+        """
+        get_gzip_data = getattr(dc, 'get_gzip_data', None)
+        if (get_gzip_data is None or not self._gzip_allowed(content_type) or
+                not accepts_gzip(self.headers.get('Accept-Encoding'))):
+            return None
+
+        data = get_gzip_data(uri, self.encode_threshold)
+        if data is not None:
+            headers['Content-Encoding'] = 'gzip'
+            etag = headers.get('Etag')
+            if etag:
+                # a different representation needs a different tag
+                headers['Etag'] = gzip_etag(etag)
+        return data
+
     def do_HEAD(self):
         """ Send a HEAD response: Retrieves resource information w/o body """
 
@@ -308,15 +739,18 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
         """ This will always fail because we can not reproduce HTTP requests.
         We send back a 405=Method Not Allowed. """
 
+        self._close_unread_body()
         self.send_body(None, 405, 'Method Not Allowed', 'Method Not Allowed')
 
     def do_POST(self):
         """ Replacement for GET response. Not implemented here. """
 
+        self._close_unread_body()
         self.send_body(None, 405, 'Method Not Allowed', 'Method Not Allowed')
 
     def do_PROPPATCH(self):
         # currently unsupported
+        self._close_unread_body()
         return self.send_status(423)
 
     def do_PROPFIND(self):
@@ -334,14 +768,36 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
         uri = urllib.parse.urljoin(self.get_baseuri(dc), self.path)
         uri = urllib.parse.unquote(uri).encode()
 
+        depth = self.headers.get('Depth', 'infinity').lower()
+        if depth == 'infinity' and not self._config.DAV.getboolean(
+                'propfind_depth_infinity', True):
+            return self.send_dav_error(403, 'propfind-finite-depth')
+
         try:
-            pf = PROPFIND(uri, dc, self.headers.get('Depth', 'infinity'), body)
+            offset = int(self.headers.get('Continuation', 0))
+            if offset < 0:
+                raise ValueError(offset)
+        except ValueError:
+            return self.send_status(400)
+
+        try:
+            pf = PROPFIND(uri, dc, depth, body, offset)
         except ExpatError:
             # parse error
             return self.send_status(400)
+        pf.max_responses = int(self._config.DAV.get('propfind_max_responses',
+                                                    PROPFIND.max_responses))
+        pf.time_limit = float(self._config.DAV.get('propfind_time_limit',
+                                                   PROPFIND.time_limit))
+
+        headers = {}
+        prefer = parse_prefer(self.headers.get_all('Prefer', ()))
+        if prefer.get('return') == 'minimal':
+            pf.minimal = True
+            headers['Preference-Applied'] = 'return=minimal'
 
         try:
-            DATA = b'%s\n' % pf.createResponse()
+            DATA = pf.createResponseStream()
         except DAV_Error as error:
             (ec, dd) = error.args
             return self.send_status(ec)
@@ -350,19 +806,27 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
         # taken from Resource.py @ Zope webdav
         if (self.headers.get('User-Agent') ==
             'Microsoft Data Access Internet Publishing Provider DAV 1.1'):
-            DATA = DATA.replace(b'<ns0:getlastmodified xmlns:ns0="DAV:">',
-                                b'<ns0:getlastmodified xmlns:n="DAV:" '
-                                b'xmlns:b="urn:uuid:'
-                                b'c2f41010-65b3-11d1-a29f-00aa00c14882/" '
-                                b'b:dt="dateTime.rfc1123">')
-            DATA = DATA.replace(b'<ns0:creationdate xmlns:ns0="DAV:">',
-                                b'<ns0:creationdate xmlns:n="DAV:" '
-                                b'xmlns:b="urn:uuid:'
-                                b'c2f41010-65b3-11d1-a29f-00aa00c14882/" '
-                                b'b:dt="dateTime.tz">')
+            DATA = (self._msie_dates(block) for block in DATA)
 
+        DATA = itertools.chain(DATA, [b'\n'])
         self.send_body_chunks_if_http11(DATA, 207, 'Multi-Status',
-                                        'Multiple responses')
+                                        'Multiple responses',
+                                        headers=headers)
+
+    @staticmethod
+    def _msie_dates(DATA):
+        """ declare the date types of a PROPFIND answer for MSIE """
+        DATA = DATA.replace(b'<ns0:getlastmodified xmlns:ns0="DAV:">',
+                            b'<ns0:getlastmodified xmlns:n="DAV:" '
+                            b'xmlns:b="urn:uuid:'
+                            b'c2f41010-65b3-11d1-a29f-00aa00c14882/" '
+                            b'b:dt="dateTime.rfc1123">')
+        DATA = DATA.replace(b'<ns0:creationdate xmlns:ns0="DAV:">',
+                            b'<ns0:creationdate xmlns:n="DAV:" '
+                            b'xmlns:b="urn:uuid:'
+                            b'c2f41010-65b3-11d1-a29f-00aa00c14882/" '
+                            b'b:dt="dateTime.tz">')
+        return DATA
 
     def do_REPORT(self):
         """ Query properties on defined resource. """
@@ -379,14 +843,20 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
         uri = urllib.parse.urljoin(self.get_baseuri(dc), self.path)
         uri = urllib.parse.unquote(uri).encode()
 
-        rp = REPORT(uri, dc, self.headers.get('Depth', '0'), body)
-
         try:
-            DATA = '%s\n' % rp.createResponse()
+            rp = create_report(uri, dc, self.headers.get('Depth', '0').lower(),
+                               body)
+            DATA = rp.createResponseStream()
+        except (ExpatError, TypeError):
+            # parse error or no body
+            return self.send_status(400)
+        except DAV_ConditionFailed as error:
+            return self.send_dav_error(*error.args)
         except DAV_Error as error:
             (ec, dd) = error.args
             return self.send_status(ec)
 
+        DATA = itertools.chain(DATA, [b'\n'])
         self.send_body_chunks_if_http11(DATA, 207, 'Multi-Status',
                                         'Multiple responses')
 
@@ -426,65 +896,29 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
         if uri.find(b'#') >= 0:
             return self.send_status(404)
 
+        res = self._snapshot(uri)
+
         # locked resources are not allowed to delete
-        if self._l_isLocked(uri):
+        if res.lock is not None:
             return self.send_body(None, 423, 'Locked', 'Locked')
 
-        # Handle If-Match
-        if 'If-Match' in self.headers:
-            test = False
-            etag = None
-            try:
-                etag = dc.get_prop(uri, "DAV:", "getetag")
-            except:
-                pass
-            for match in self.headers['If-Match'].split(','):
-                if match == '*':
-                    if dc.exists(uri):
-                        test = True
-                        break
-                else:
-                    if match == etag:
-                        test = True
-                        break
-            if not test:
-                self.send_status(412)
-                self.log_request(412)
-                return
-
-        # Handle If-None-Match
-        if 'If-None-Match' in self.headers:
-            test = True
-            etag = None
-            try:
-                etag = dc.get_prop(uri, "DAV:", "getetag")
-            except:
-                pass
-            for match in self.headers['If-None-Match'].split(','):
-                if match == '*':
-                    if dc.exists(uri):
-                        test = False
-                        break
-                else:
-                    if match == etag:
-                        test = False
-                        break
-            if not test:
-                self.send_status(412)
-                self.log_request(412)
-                return
+        # Handle If-Match, If-None-Match and If-Unmodified-Since
+        status = self._precondition(res)
+        if status:
+            self.send_status(status)
+            self.log_request(status)
+            return
 
         try:
             dl = DELETE(uri, dc)
-            if dc.is_collection(uri):
-                res = dl.delcol()
-                if res:
-                    self.send_status(207, body=res)
+            if res.is_collection:
+                result = dl.delcol()
+                if result:
+                    self.send_status(207, body=result)
                 else:
                     self.send_status(204)
             else:
-                res = dl.delone() or 204
-                self.send_status(res)
+                self.send_status(dl.delone() or 204)
         except DAV_NotFound:
             self.send_body(None, 404, 'Not Found', 'Not Found')
 
@@ -495,70 +929,24 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
 
         log.debug("do_PUT: uri = %s" % uri)
         log.debug('do_PUT: headers = %s' % self.headers)
-        # Handle If-Match
-        if 'If-Match' in self.headers:
-            log.debug("do_PUT: If-Match %s" % self.headers['If-Match'])
-            test = False
-            etag = None
-            try:
-                etag = dc.get_prop(uri, "DAV:", "getetag")
-            except:
-                pass
-
-            log.debug("do_PUT: etag = %s" % etag)
-
-            for match in self.headers['If-Match'].split(','):
-                if match == '*':
-                    if dc.exists(uri):
-                        test = True
-                        break
-                else:
-                    if match == etag:
-                        test = True
-                        break
-            if not test:
-                self.send_status(412)
-                self.log_request(412)
-                return
-
-        # Handle If-None-Match
-        if 'If-None-Match' in self.headers:
-            log.debug("do_PUT: If-None-Match %s" %
-                      self.headers['If-None-Match'])
+        res = self._snapshot(uri)
 
-            test = True
-            etag = None
-            try:
-                etag = dc.get_prop(uri, "DAV:", "getetag")
-            except:
-                pass
-
-            log.debug("do_PUT: etag = %s" % etag)
-
-            for match in self.headers['If-None-Match'].split(','):
-                if match == '*':
-                    if dc.exists(uri):
-                        test = False
-                        break
-                else:
-                    if match == etag:
-                        test = False
-                        break
-            if not test:
-                self.send_status(412)
-                self.log_request(412)
-                return
+        # Handle If-Match, If-None-Match and If-Unmodified-Since
+        status = self._precondition(res)
+        if status:
+            self._close_unread_body()
+            self.send_status(status)
+            self.log_request(status)
+            return
 
         # locked resources are not allowed to be overwritten
         ifheader = self.headers.get('If')
-        if (
-            (self._l_isLocked(uri)) and
-            (not ifheader)
-        ):
+        uri_token = res.lock
+        if uri_token is not None and not ifheader:
+            self._close_unread_body()
             return self.send_body(None, 423, 'Locked', 'Locked')
 
-        if self._l_isLocked(uri) and ifheader:
-            uri_token = self._l_getLockForUri(uri)
+        if uri_token is not None and ifheader:
             taglist = IfParser(ifheader)
             found = False
             for tag in taglist:
@@ -574,16 +962,13 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
                 if found:
                     break
             if not found:
+                self._close_unread_body()
                 res = self.send_body(None, 423, 'Locked', 'Locked')
                 self.log_request(423)
                 return res
 
-        # Handle expect
-        expect = self.headers.get('Expect', '')
-        if (expect.lower() == '100-continue' and
-                self.protocol_version >= 'HTTP/1.1' and
-                self.request_version >= 'HTTP/1.1'):
-            self.send_status(100)
+        # Expect: 100-continue has already been answered by
+        # BaseHTTPRequestHandler.handle_expect_100()
 
         content_type = None
         if 'Content-Type' in self.headers:
@@ -592,21 +977,13 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
         headers = {}
         headers['Location'] = uri
 
-        try:
-            etag = dc.get_prop(uri, "DAV:", "getetag")
-            headers['ETag'] = etag
-        except:
-            pass
-
         expect = self.headers.get('transfer-encoding', '')
         if (
             expect.lower() == 'chunked' and
             self.protocol_version >= 'HTTP/1.1' and
             self.request_version >= 'HTTP/1.1'
         ):
-            self.send_body(None, 201, 'Created', '', headers=headers)
-
-            dc.put(uri, self._readChunkedData(), content_type)
+            body = self._readChunkedData()
         else:
             # read the body
             body = None
@@ -617,14 +994,21 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
             else:
                 log.debug("do_PUT: Content-Length = empty")
 
-            try:
-                dc.put(uri, body, content_type)
-            except DAV_Error as error:
-                (ec, dd) = error.args
-                return self.send_status(ec)
+        try:
+            dc.put(uri, body, content_type)
+        except DAV_Error as error:
+            (ec, dd) = error.args
+            return self.send_status(ec)
+        finally:
+            res.changed()
 
-            self.send_body(None, 201, 'Created', '', headers=headers)
-            self.log_request(201)
+        # the entity tag of the new content
+        etag = res.get('getetag')
+        if etag is not None:
+            headers['ETag'] = etag
+
+        self.send_body(None, 201, 'Created', '', headers=headers)
+        self.log_request(201)
 
     def _readChunkedData(self):
         l = int(self.rfile.readline(), 16)
@@ -684,8 +1068,11 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
         dest_uri = self.headers['Destination']
         dest_uri = urllib.parse.unquote(dest_uri).encode()
 
+        source = self._snapshot(source_uri)
+        dest = self._snapshot(dest_uri)
+
         # check locks on source and dest
-        if self._l_isLocked(source_uri) or self._l_isLocked(dest_uri):
+        if source.lock is not None or dest.lock is not None:
             return self.send_body(None, 423, 'Locked', 'Locked')
 
         # Overwrite?
@@ -715,7 +1102,7 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
 
         # now it only can be "infinity" but we nevertheless check for a
         # collection
-        if dc.is_collection(source_uri):
+        if source.is_collection:
             try:
                 res = cp.tree_action()
             except DAV_Error as error:
@@ -750,6 +1137,10 @@ class DAVRequestHandler(AuthServer.AuthRequestHandler, LockManager):
         self.send_body(body, code, self.responses.get(code, [''])[0], msg,
                        mediatype)
 
+    def send_dav_error(self, code, condition):
+        """ answer with code and the DAV: condition which failed """
+        self.send_status(code, body=(DAV_ERROR % condition).encode('utf-8'))
+
     def get_baseuri(self, dc):
         baseuri = dc.baseuri
         if 'Host' in self.headers:
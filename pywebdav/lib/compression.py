@@ -0,0 +1,93 @@
+"""
+Streaming gzip content encoding
+
+Response bodies are compressed block by block with a zlib compressor
+in gzip format, so the memory used does not depend on the size of the
+body. Content types which are compressed already are left alone.
+
+"""
+
+from __future__ import absolute_import
+import zlib
+
+import six
+
+# default compression level, see [DAV] gzip_level
+GZIP_LEVEL = 6
+
+# content types not worth compressing, see [DAV] gzip_skip_types;
+# a trailing / matches the whole major type
+SKIP_TYPES = ('image/', 'audio/', 'video/',
+              'application/zip', 'application/gzip', 'application/x-gzip',
+              'application/x-bzip2', 'application/x-xz',
+              'application/x-7z-compressed', 'application/x-rar-compressed',
+              'application/vnd.rar', 'application/zstd', 'application/pdf',
+              'application/vnd.openxmlformats-officedocument',
+              'application/vnd.oasis.opendocument', 'application/epub+zip',
+              'font/woff', 'font/woff2')
+
+# compressible image formats
+TEXT_IMAGES = ('image/svg+xml', 'image/bmp', 'image/x-icon')
+
+
+def parse_skip_types(value):
+    """ read the gzip_skip_types option, a comma separated list """
+    if not value:
+        return SKIP_TYPES
+    return tuple(t.strip().lower() for t in value.split(',') if t.strip())
+
+
+def accepts_gzip(accept_encoding):
+    """ tell if an Accept-Encoding header value allows gzip """
+    allowed = None
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.partition(';')
+        name = name.strip().lower()
+        if name not in ('gzip', 'x-gzip', '*'):
+            continue
+
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        # an explicit gzip entry wins over the wildcard
+        if name != '*' or allowed is None:
+            allowed = quality > 0
+        if name != '*':
+            break
+    return bool(allowed)
+
+
+def compressible(content_type, skip_types=SKIP_TYPES):
+    """ tell if content of the given type is worth compressing """
+    ctype = (content_type or '').split(';')[0].strip().lower()
+    if ctype in TEXT_IMAGES and ctype not in skip_types:
+        return True
+    for skip in skip_types:
+        if ctype == skip or (skip.endswith('/') and ctype.startswith(skip)) \
+                or ctype.startswith(skip + '.'):
+            return False
+    return True
+
+
+def gzip_etag(etag):
+    """ the entity tag of the gzip encoded representation of a resource
+    whose identity representation has etag """
+    return etag[:-1] + '-gzip"' if etag.endswith('"') else etag + '-gzip'
+
+
+def gzip_stream(blocks, level=GZIP_LEVEL):
+    """ compress an iterable of byte strings to gzip blocks """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for block in blocks:
+        if isinstance(block, six.text_type):
+            block = block.encode('utf-8')
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
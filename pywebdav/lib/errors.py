@@ -60,3 +60,14 @@ class DAV_Requested_Range_Not_Satisfiable(DAV_Error):
             DAV_Error.__init__(self, 416)
         pass
 
+
+class DAV_ConditionFailed(DAV_Error):
+    """ a precondition or postcondition of the request failed
+
+    1. the error code
+    2. the name of the condition element in the DAV: namespace,
+       e.g. valid-sync-token; the answer has a <DAV:error> body
+    """
+
+    def __init__(self, code, condition):
+        DAV_Error.__init__(self, code, condition)
@@ -8,12 +8,24 @@ class.
 """
 
 from __future__ import absolute_import
-from xml.dom import minidom
 from .locks import LockManager
+from .utils import XMLFragment
 from .errors import *
 
 import time
 
+# the same for every resource, serialized once
+SUPPORTEDLOCK = XMLFragment.fromxml(
+    '<D:lockentry>\n'
+    '<D:lockscope><D:exclusive></D:exclusive></D:lockscope>\n'
+    '<D:locktype><D:write></D:write></D:locktype>\n'
+    '</D:lockentry>\n', 'xmlns:D="http://dummy/d"')
+
+LOCKS = LockManager()
+
+# namespace of the getctag property of collections
+CS_NS = 'http://calendarserver.org/ns/'
+
 class dav_interface:
     """ interface class for implementing DAV servers """
 
@@ -39,8 +51,70 @@ class dav_interface:
     # the method prefix
     # e.g. for DAV:getcontenttype we call dav_getcontenttype()
     M_NS={"DAV:" : "_get_dav",
+          CS_NS  : "_get_cs",
           "NS2"  : "ns2" }
 
+    # method names of the class by prefix, see _compile_prop_methods()
+    _prop_methods = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._compile_prop_methods()
+
+    @staticmethod
+    def _find_prop_methods(names, prefix):
+        """ map property names to the names of their methods
+
+        Properties with a '-' are answered by methods with a '_', both
+        spellings are in the result.
+        """
+        methods = {}
+        for name in names:
+            if name.startswith(prefix + '_'):
+                pname = name[len(prefix) + 1:]
+                methods[pname] = methods[pname.replace('_', '-')] = name
+        return methods
+
+    @classmethod
+    def _compile_prop_methods(cls):
+        """ collect the property methods of the class, once per class """
+        names = dir(cls)
+        cls._prop_methods = dict(
+            (prefix, cls._find_prop_methods(names, prefix))
+            for prefix in set(cls.M_NS.values()))
+
+    def _compile_prop_dispatch(self):
+        """ bind the property methods of this instance
+
+        Returns a dict namespace -> {property name: bound method}. Call
+        it again after changing M_NS or the methods of an instance.
+        """
+        table = {}
+        for ns, prefix in self.M_NS.items():
+            methods = self._prop_methods.get(prefix)
+            if methods is None:
+                # M_NS changed on the instance
+                methods = self._find_prop_methods(dir(self), prefix)
+            table[ns] = dict((pname, getattr(self, name))
+                             for pname, name in methods.items())
+        self._prop_dispatch = table
+        return table
+
+    def prop_method(self, ns, propname):
+        """ return the method answering a property, None if there is none """
+        try:
+            table = self._prop_dispatch
+        except AttributeError:
+            table = self._compile_prop_dispatch()
+
+        methods = table.get(ns)
+        if methods is None:
+            return None
+        method = methods.get(propname)
+        if method is None and '-' in propname:
+            method = methods.get(propname.replace('-', '_'))
+        return method
+
     def get_propnames(self,uri):
         """ return the property names allowed for the given URI
 
@@ -68,18 +142,80 @@ class dav_interface:
         ns        -- namespace of the property
         pname        -- name of the property
         """
-        if ns in self.M_NS:
-            prefix=self.M_NS[ns]
-        else:
+        m=self.prop_method(ns, propname)
+        if m is None:
             raise DAV_NotFound
-        mname=prefix+"_"+propname.replace('-', '_')
         try:
-            m=getattr(self,mname)
-            r=m(uri)
-            return r
+            return m(uri)
         except AttributeError:
             raise DAV_NotFound
 
+    def get_props(self, uri, ns_props, st=None):
+        """ return the values of several properties at once
+
+        ns_props maps namespaces to lists of property names, the result
+        maps them to dicts of property name -> value. A property which
+        could not be read has the DAV_Error raised for it as value. st
+        is the metadata get_child_entries() returned for the resource,
+        if any.
+
+        This calls get_prop() for each property; override it to read
+        all properties of a resource in one go.
+        """
+        result = {}
+        for ns, plist in ns_props.items():
+            values = result[ns] = {}
+            for prop in plist:
+                try:
+                    values[prop] = self.get_prop(uri, ns, prop)
+                except DAV_Error as error:
+                    values[prop] = error
+        return result
+
+    def get_child_entries(self, uri):
+        """ iterate over the children of a collection with their metadata
+
+        Yields (uri, st) pairs. st is an os.stat_result like object
+        (st_mode, st_size, st_mtime, st_ino) or None if the metadata is
+        not at hand; it can be passed on to get_props().
+        """
+        for child in self.get_childs(uri):
+            yield child, None
+
+    def get_filtered_child_entries(self, uri, filter):
+        """ iterate over the children of a collection for a REPORT
+
+        Yields (uri, st, match) triples as get_child_entries() does,
+        match tells if the child satisfies filter, the root element of
+        the REPORT body. Children which do not match are listed too,
+        the REPORT descends into them.
+
+        The matching children are taken from get_childs(uri, filter),
+        once per collection, next to the listing of get_child_entries();
+        override it to list the collection and evaluate the filter in
+        one pass.
+        """
+        matching = set(self.get_childs(uri, filter))
+        for child, st in self.get_child_entries(uri):
+            yield child, st, child in matching
+
+    def get_changes(self, uri, token, infinite=False, limit=None):
+        """ return the changes of a collection since a sync token
+
+        Returns (token, changes, truncated) for a sync-collection
+        REPORT (RFC 6578): the new sync token and the list of (uri,
+        deleted) pairs of the members which changed or went away since
+        token, oldest first. Members of member collections are included
+        if infinite is set. With more than limit changes the first limit
+        ones are returned, truncated is set and the token continues after
+        them. Without a token only the current one is returned, changes
+        is None then.
+
+        Raise DAV_ConditionFailed(403, 'valid-sync-token') for a token
+        which can not be used. The default does not track changes.
+        """
+        raise DAV_ConditionFailed(403, 'supported-report')
+
     ###
     ### DATA methods (for GET and PUT)
     ###
@@ -104,23 +240,18 @@ class dav_interface:
     ### LOCKing information
     ###
     def _get_dav_supportedlock(self, uri):
+        """ the supportedlock property, an XMLFragment
 
-        txt = ('<main xmlns:D="http://dummy/d" xmlns:ns1="http://webdav.de/ns1"><D:lockentry>\n'
-                '<D:lockscope><D:exclusive></D:exclusive></D:lockscope>\n'
-                '<D:locktype><D:write></D:write></D:locktype>\n'
-                '</D:lockentry></main>\n')
-        xml = minidom.parseString(txt)
-        return xml.firstChild.firstChild
+        This used to be a minidom element, callers which need one get it
+        from the element() of the fragment.
+        """
+        return SUPPORTEDLOCK
 
     def _get_dav_lockdiscovery(self, uri):
-        lcm = LockManager()
-        if lcm._l_isLocked(uri):
-            lock = lcm._l_getLockForUri(uri)
-            txt = lock.asXML(discover=True, namespace='D')
-
-            txtwithns = '<main xmlns:D="http://dummy/D" xmlns:n="http://webdav.de/N">%s</main>'
-            xml = minidom.parseString(txtwithns % txt)
-            return xml.firstChild.firstChild
+        """ the lockdiscovery property, an XMLFragment or '' """
+        lock = LOCKS._l_getLockForUri(uri)
+        if lock is not None:
+            return lock.discoveryFragment()
 
         return ''
 
@@ -140,6 +271,10 @@ class dav_interface:
         # format it
         return time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(d))
 
+    def _get_cs_getctag(self, uri):
+        """ return the change tag of a collection """
+        return self.get_ctag(uri)
+
 
     ###
     ### OVERRIDE THESE!
@@ -153,6 +288,17 @@ class dav_interface:
         """ return the last modification date of the resource """
         return time.time()
 
+    def get_ctag(self, uri):
+        """ return the change tag of a collection
+
+        The tag changes whenever a member of the collection, at any
+        depth, is changed, created or removed. Checking it must be cheap,
+        clients ask for it to decide whether to list the collection.
+        Interface classes which have tags list the getctag property of
+        CS_NS in get_propnames() for their collections.
+        """
+        raise DAV_NotFound
+
 
     ###
     ### COPY MOVE DELETE
@@ -279,3 +425,5 @@ class dav_interface:
         """ return 1 or None depending on if a resource is a collection """
         return None # no
 
+
+dav_interface._compile_prop_methods()
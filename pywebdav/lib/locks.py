@@ -1,7 +1,11 @@
 from __future__ import absolute_import
 import time
+import heapq
+import threading
+import itertools
+from contextlib import contextmanager
 from six.moves import urllib
-import random
+import uuid
 
 import logging
 
@@ -10,44 +14,247 @@ log = logging.getLogger(__name__)
 import xml.dom
 from xml.dom import minidom
 
-from .utils import rfc1123_date, IfParser, tokenFinder
+from .utils import rfc1123_date, IfParser, tokenFinder, XMLFragment, \
+    parse_timeout
 from .errors import *
 
-tokens_to_lock = {}
-uris_to_token = {}
+# number of mutexes the lock table is split into
+STRIPES = 64
+
+# longest lock granted in seconds, also for Infinite (0 = no limit), see
+# [DAV] lock_max_timeout
+MAX_TIMEOUT = 7 * 24 * 3600
+
+# the expiry heap of a stripe is not cleaned while it is smaller
+_HEAP_MIN = 64
+
+_CHANGES, _CONFLICTS, _CONTENDED, _WAITED, _EXPIRED = range(5)
+
+
+class LockTable:
+    """ the locks held on resources, shared by all request threads
+
+    Changes of the locks of a URI are serialized by one of a fixed set
+    of mutexes picked by the hash of the URI, requests locking
+    different resources seldom wait for each other. Lookups read the
+    dicts without a mutex, single dict operations are atomic.
+
+    Each stripe keeps a heap of the expiry times of its locks. Expired
+    locks are removed from the stripe before it is changed and by
+    expire(), which the servers run periodically; until then lookups
+    skip them. The table starts the timeouts of its locks with clock,
+    time.time by default.
+
+    """
+
+    def __init__(self, stripes=STRIPES, clock=time.time):
+        self.tokens = {}
+        self.uris = {}
+        self._stripes = [threading.Lock() for i in range(stripes)]
+        # per stripe: (expiry time, number, lock), outdated entries
+        # are skipped when popped
+        self._heaps = [[] for i in range(stripes)]
+        self._heap_limits = [_HEAP_MIN] * stripes
+        self._numbers = itertools.count()
+        self._counters = [[0, 0, 0, 0.0, 0] for i in range(stripes)]
+        self._clock = clock
+        self._started = clock()
+
+    @contextmanager
+    def _stripe(self, uri):
+        """ hold the mutex of uri with its expired locks removed
+
+        Yields the index of the stripe.
+        """
+        index = hash(uri) % len(self._stripes)
+        mutex = self._stripes[index]
+        if mutex.acquire(False):
+            waited = None
+        else:
+            start = time.monotonic()
+            mutex.acquire()
+            waited = time.monotonic() - start
+        try:
+            counters = self._counters[index]
+            counters[_CHANGES] += 1
+            if waited is not None:
+                counters[_CONTENDED] += 1
+                counters[_WAITED] += waited
+            self._expire_stripe(index, self._clock())
+            yield index
+        finally:
+            mutex.release()
+
+    def _expire_stripe(self, index, now):
+        heap = self._heaps[index]
+        while heap and heap[0][0] <= now:
+            expires, number, lock = heapq.heappop(heap)
+            if lock.expires == expires and self.tokens.get(lock.token) is lock:
+                self._remove(lock)
+                self._counters[index][_EXPIRED] += 1
+
+    def _schedule(self, index, lock):
+        """ remember when lock expires """
+        if lock.expires is None:
+            return
+        heap = self._heaps[index]
+        heapq.heappush(heap, (lock.expires, next(self._numbers), lock))
+        if len(heap) > self._heap_limits[index]:
+            # drop the entries of released and refreshed locks
+            heap[:] = [entry for entry in heap
+                       if entry[2].expires == entry[0] and
+                       self.tokens.get(entry[2].token) is entry[2]]
+            heapq.heapify(heap)
+            self._heap_limits[index] = max(_HEAP_MIN, 2 * len(heap))
+
+    def _valid(self, lock):
+        expires = lock.expires
+        return expires is None or expires > self._clock()
+
+    def _add(self, index, lock):
+        lock.modified = self._clock()
+        old = self.uris.get(lock.uri)
+        if old is not None:
+            self.tokens.pop(old.token, None)
+        self.tokens[lock.token] = lock
+        self.uris[lock.uri] = lock
+        self._schedule(index, lock)
+
+    def _remove(self, lock):
+        del self.tokens[lock.token]
+        if self.uris.get(lock.uri) is lock:
+            del self.uris[lock.uri]
+
+    def acquire(self, lock):
+        """ add lock unless its URI is locked already, return whether """
+        with self._stripe(lock.uri) as index:
+            if self.get_for_uri(lock.uri) is not None:
+                self._counters[index][_CONFLICTS] += 1
+                return False
+            self._add(index, lock)
+            return True
+
+    def set(self, lock):
+        """ add lock, replacing the one held on its URI """
+        with self._stripe(lock.uri) as index:
+            self._add(index, lock)
+
+    def refresh(self, lock, timeout):
+        """ restart the timeout of a lock held, return whether it is """
+        with self._stripe(lock.uri) as index:
+            if self.tokens.get(lock.token) is not lock:
+                # released or expired meanwhile
+                return False
+            lock.setTimeout(timeout)
+            lock.modified = self._clock()
+            self._schedule(index, lock)
+            return True
+
+    def release(self, token):
+        """ remove the lock named by token, return it or None """
+        lock = self.tokens.get(token)
+        if lock is None:
+            return None
+        with self._stripe(lock.uri):
+            if self.tokens.get(token) is not lock:
+                # released or expired meanwhile
+                return None
+            self._remove(lock)
+            return lock
+
+    def get(self, token):
+        """ return the lock named by token, None if it expired """
+        lock = self.tokens.get(token)
+        if lock is not None and self._valid(lock):
+            return lock
+        return None
+
+    def get_for_uri(self, uri):
+        """ return the lock held on uri, None if it expired """
+        lock = self.uris.get(uri)
+        if lock is not None and self._valid(lock):
+            return lock
+        return None
+
+    def expire(self):
+        """ remove the expired locks of all the stripes """
+        now = self._clock()
+        for index, mutex in enumerate(self._stripes):
+            heap = self._heaps[index]
+            if heap and heap[0][0] <= now:
+                with mutex:
+                    self._expire_stripe(index, now)
+
+    def stats(self):
+        """ return the number of locks, their expiry and how much the
+        mutexes are used """
+        self.expire()
+        changes, conflicts, contended, waited, expired = [
+            sum(column) for column in zip(*self._counters)]
+        uptime = self._clock() - self._started
+        return {'locks': len(self.uris),
+                'stripes': len(self._stripes),
+                'changes': changes,
+                'conflicts': conflicts,
+                'contended': contended,
+                'contention_ratio': (float(contended) / changes
+                                     if changes else 0.0),
+                'wait_time': waited,
+                'expired': expired,
+                'expiry_rate': expired / uptime if uptime else 0.0}
+
+
+lock_table = LockTable()
+
+# the dicts of the shared table, for code reading them directly
+tokens_to_lock = lock_table.tokens
+uris_to_token = lock_table.uris
 
 class LockManager:
     """ Implements the locking backend and serves as MixIn for DAVRequestHandler """
 
+    # the LockTable holding the locks
+    lock_table = lock_table
+
     def _init_locks(self):
-        return tokens_to_lock, uris_to_token
+        return self.lock_table.tokens, self.lock_table.uris
 
     def _l_isLocked(self, uri):
-        tokens, uris = self._init_locks()
-        return uri in uris
+        return self.lock_table.get_for_uri(uri) is not None
 
     def _l_hasLock(self, token):
-        tokens, uris = self._init_locks()
-        return token in tokens
+        return self.lock_table.get(token) is not None
 
     def _l_getLockForUri(self, uri):
-        tokens, uris = self._init_locks()
-        return uris.get(uri, None)
+        return self.lock_table.get_for_uri(uri)
 
     def _l_getLock(self, token):
-        tokens, uris = self._init_locks()
-        return tokens.get(token, None)
+        return self.lock_table.get(token)
 
     def _l_delLock(self, token):
-        tokens, uris = self._init_locks()
-        if token in tokens:
-            del uris[tokens[token].uri]
-            del tokens[token]
+        self.lock_table.release(token)
 
     def _l_setLock(self, lock):
-        tokens, uris = self._init_locks()
-        tokens[lock.token] = lock
-        uris[lock.uri] = lock
+        self.lock_table.set(lock)
+
+    def _l_refreshLock(self, lock, timeout):
+        """ restart the timeout of lock, return whether it is still held """
+        return self.lock_table.refresh(lock, timeout)
+
+    def _l_acquireLock(self, lock):
+        """ lock the URI of lock if nobody else did, return whether """
+        return self.lock_table.acquire(lock)
+
+    def _lock_timeout(self):
+        """ the timeout in seconds granted to a LOCK, None for Infinite """
+        timeout = parse_timeout(self.headers.get('Timeout'))
+        limit = int(self._config.DAV.get('lock_max_timeout', MAX_TIMEOUT))
+        if limit > 0 and (timeout is None or timeout > limit):
+            timeout = limit
+        if timeout is not None and timeout < 1:
+            # Second-0 would expire before the answer is sent
+            timeout = 1
+        return timeout
 
     def _lock_unlock_parse(self, body):
         doc = minidom.parseString(body)
@@ -70,8 +277,9 @@ class LockManager:
             # locking of children/collections not yet supported
             pass
 
-        if not self._l_isLocked(uri):
-            self._l_setLock(lock)
+        if not self._l_acquireLock(lock):
+            # locked by a concurrent request
+            return None, result
 
         # because we do not handle children we leave result empty
         return lock.token, result
@@ -127,14 +335,24 @@ class LockManager:
         elif body and not ifheader:
             # LOCK with XML information
             data = self._lock_unlock_parse(body)
+            data['timeout'] = self._lock_timeout()
             token, result = self._lock_unlock_create(uri, 'unknown', depth, data)
 
             if result:
                 self.send_body(result, '207', 'Error', 'Error',
                                 'text/xml; charset="utf-8"')
 
+            elif token is None:
+                self.responses[423] = ('Locked', 'Already locked')
+                return self.send_status(423)
+
             else:
-                lock = self._l_getLock(token)
+                # from the table even if its timeout already passed,
+                # unless it was released or removed meanwhile
+                tokens, uris = self._init_locks()
+                lock = tokens.get(token)
+                if lock is None:
+                    return self.send_status(412)
                 self.send_body(lock.asXML(), '200', 'OK', 'OK',
                                 'text/xml; charset="utf-8"',
                                 {'Lock-Token' : '<opaquelocktoken:%s>' % token})
@@ -147,10 +365,9 @@ class LockManager:
             for tag in taglist:
                 for listitem in tag.list:
                     token = tokenFinder(listitem)
-                    if token and self._l_hasLock(token):
-                        lock = self._l_getLock(token)
-                        timeout = self.headers.get('Timeout', 'Infinite')
-                        lock.setTimeout(timeout) # automatically refreshes
+                    lock = token and self._l_getLock(token)
+                    if lock and self._l_refreshLock(lock,
+                                                    self._lock_timeout()):
                         found = 1
 
                         self.send_body(lock.asXML(), 
@@ -168,18 +385,19 @@ class LockItem:
     """ Lock with support for exclusive write locks. Some code taken from
     webdav.LockItem from the Zope project. """
 
-    def __init__(self, uri, creator, lockowner, depth=0, timeout='Infinite',
+    def __init__(self, uri, creator, lockowner, depth=0, timeout=None,
                     locktype='write', lockscope='exclusive', token=None, **kw):
 
         self.uri = uri
         self.creator = creator
         self.owner = lockowner
         self.depth = depth
-        self.timeout = timeout
+        self.timeout = self._parseTimeout(timeout)
         self.locktype = locktype
         self.lockscope = lockscope
         self.token = token and token or self.generateToken()
         self.modified = time.time()
+        self._discovery = None
 
     def getModifiedTime(self):
         return self.modified
@@ -187,26 +405,55 @@ class LockItem:
     def refresh(self):
         self.modified = time.time()
 
+    @property
+    def expires(self):
+        """ the time the lock expires at, None if it does not """
+        if self.timeout is None:
+            return None
+        return self.modified + self.timeout
+
     def isValid(self):
-        now = time.time()
-        modified = self.modified
-        timeout = self.timeout
-        return (modified + timeout) > now
+        expires = self.expires
+        return expires is None or expires > time.time()
 
     def generateToken(self):
-        _randGen = random.Random(time.time())
-        return '%s-%s-00105A989226:%.03f' %  \
-             (_randGen.random(),_randGen.random(),time.time())
+        # unique even for locks created at the same time (RFC 4918 C)
+        return str(uuid.uuid4())
 
     def getTimeoutString(self):
-        t = str(self.timeout)
-        if t[-1] == 'L': t = t[:-1]
-        return 'Second-%s' % t
+        if self.timeout is None:
+            return 'Infinite'
+        return 'Second-%d' % self.timeout
+
+    @staticmethod
+    def _parseTimeout(timeout):
+        """ seconds or None, from seconds or a Timeout header value """
+        if isinstance(timeout, str):
+            return parse_timeout(timeout)
+        return timeout
 
     def setTimeout(self, timeout):
-        self.timeout = timeout
+        """ restart the lock with a new timeout
+
+        Locks in a LockTable are refreshed through its refresh() which
+        reschedules their expiry.
+        """
+        self.timeout = self._parseTimeout(timeout)
         self.modified = time.time()
 
+    def discoveryFragment(self):
+        """ the lockdiscovery property value of the lock
+
+        Serialized once and again only when the timeout changed.
+        """
+        cached = self._discovery
+        if cached is None or cached[0] != self.timeout:
+            fragment = XMLFragment.fromxml(
+                self.asXML(discover=True, namespace='D'),
+                'xmlns:D="http://dummy/D" xmlns:n="http://webdav.de/N"')
+            cached = self._discovery = (self.timeout, fragment)
+        return cached[1]
+
     def asXML(self, namespace='d', discover=False):
         owner_str = ''
         if isinstance(self.owner, str):
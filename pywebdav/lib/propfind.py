@@ -2,6 +2,9 @@ from __future__ import absolute_import
 import xml.dom.minidom
 domimpl = xml.dom.minidom.getDOMImplementation()
 
+import stat
+import time
+import itertools
 import logging
 from six.moves import urllib
 
@@ -11,6 +14,56 @@ from .errors import DAV_Error, DAV_NotFound
 
 log = logging.getLogger(__name__)
 
+# size of the blocks a multistatus document is streamed in
+STREAM_BLOCK_SIZE = 64 * 1024
+
+MULTISTATUS_START = (b'<?xml version="1.0" encoding="utf-8"?>'
+                     b'<D:multistatus xmlns:D="DAV:">')
+MULTISTATUS_END = b'</D:multistatus>'
+MULTISTATUS_EMPTY = (b'<?xml version="1.0" encoding="utf-8"?>'
+                     b'<D:multistatus xmlns:D="DAV:"/>')
+
+
+def multistatus(responses, block_size=STREAM_BLOCK_SIZE):
+    """ serialize <D:response> elements to a multistatus document
+
+    The elements are serialized one by one as they come and the
+    document is yielded in blocks of about block_size bytes, so that
+    only one response lives in memory at a time. The output is the
+    same as the one of a minidom document holding all responses.
+    """
+    blocks = []
+    size = 0
+    for response in responses:
+        if not blocks and not size:
+            blocks.append(MULTISTATUS_START)
+        data = response.toxml().encode('utf-8')
+        blocks.append(data)
+        size += len(data)
+        if size >= block_size:
+            yield b''.join(blocks)
+            blocks = []
+            size = -1
+
+    if size == 0:
+        yield MULTISTATUS_EMPTY
+        return
+
+    blocks.append(MULTISTATUS_END)
+    yield b''.join(blocks)
+
+
+def prime(blocks):
+    """ produce the first block of a stream right away
+
+    An error raised before the first block is raised here, while the
+    status of the answer can still be chosen.
+    """
+    blocks = iter(blocks)
+    for first in blocks:
+        return itertools.chain([first], blocks)
+    return blocks
+
 
 class PROPFIND:
     """ parse a propfind xml element and extract props
@@ -27,7 +80,16 @@ class PROPFIND:
 
     """
 
-    def __init__(self, uri, dataclass, depth, body):
+    # responses per request and seconds spent on them, 0 = no limit;
+    # the rest of the answer is asked for with the Continuation header
+    max_responses = 0
+    time_limit = 0
+
+    # leave out the properties which were not found, for clients asking
+    # with Prefer: return=minimal (RFC 8144)
+    minimal = False
+
+    def __init__(self, uri, dataclass, depth, body, offset=0):
         self.request_type = None
         self.nsmap = {}
         self.proplist = {}
@@ -37,6 +99,11 @@ class PROPFIND:
         self._uri = uri.rstrip(b'/')
         self._has_body = None   # did we parse a body?
 
+        # responses skipped, the Continuation header of the request
+        self.offset = offset
+        # the Continuation of the next page, None if this is the last
+        self.continuation = None
+
         if dataclass.verbose:
             log.info('PROPFIND: Depth is %s, URI is %s' % (depth, uri))
 
@@ -81,51 +148,126 @@ class PROPFIND:
         df = self.create_allprop()
         return df
 
+    def createResponseStream(self):
+        """ Create the multistatus response as an iterator of blocks
+
+        Same as createResponse() but the responses are created and
+        serialized while the blocks are consumed.
+
+        """
+
+        # check if resource exists
+        if not self._dataclass.exists(self._uri):
+            raise DAV_NotFound
+
+        if self.request_type == RT_PROPNAME:
+            return prime(self.stream_propname())
+
+        if self.request_type != RT_PROP:
+            # no body means ALLPROP!
+            self.set_allprops()
+        return prime(self.stream_prop())
+
+    def iter_entries(self):
+        """ iterate over the (uri, st) pairs the Depth header asks for
+
+        st is the metadata of the resource from get_child_entries(),
+        None if unknown, or the DAV_Error raised listing a member
+        collection. Errors listing the request URI are raised.
+        """
+        dc = self._dataclass
+        if self._depth == "0":
+            yield self._uri, None
+
+        elif self._depth == "1":
+            children = list(dc.get_child_entries(self._uri))
+            yield self._uri, None
+            for entry in children:
+                yield entry
+
+        elif self._depth == 'infinity':
+            entries = [(self._uri, None)]
+            while entries:
+                uri, st = entries.pop()
+                if st is None or stat.S_ISDIR(st.st_mode):
+                    try:
+                        children = list(dc.get_child_entries(uri))
+                    except DAV_Error as error:
+                        if uri == self._uri:
+                            raise
+                        st, children = error, []
+                    yield uri, st
+                    entries.extend(children)
+                else:
+                    yield uri, st
+
+    def iter_page(self):
+        """ iterate over the entries of the requested page
+
+        Skips offset entries and stops after max_responses entries or
+        when time_limit is spent, setting continuation to the offset of
+        the next page. The order is the one of the interface class, a
+        tree changed between two pages may show entries twice or not
+        at all. The time spent skipping does not count against
+        time_limit, only the listing of the skipped entries is repeated
+        for each page, not the reading of their properties.
+        """
+        self.continuation = None
+        entries = itertools.islice(self.iter_entries(), self.offset, None)
+        if self.offset:
+            # skip before starting the clock
+            first = next(entries, None)
+            if first is None:
+                return
+            entries = itertools.chain([first], entries)
+        deadline = None
+        if self.time_limit:
+            deadline = time.monotonic() + self.time_limit
+
+        count = 0
+        for number, entry in enumerate(entries, self.offset):
+            if count and (count == self.max_responses or
+                          (deadline and time.monotonic() >= deadline)):
+                self.continuation = number
+                return
+            count += 1
+            yield entry
+
     def create_propname(self):
         """ create a multistatus response for the prop names """
+        return b''.join(self.stream_propname())
 
+    def stream_propname(self):
+        """ stream a multistatus response for the prop names """
         dc = self._dataclass
-        # create the document generator
         doc = domimpl.createDocument(None, "multistatus", None)
-        ms = doc.documentElement
-        ms.setAttribute("xmlns:D", "DAV:")
-        ms.tagName = 'D:multistatus'
 
-        if self._depth == "0":
-            pnames = dc.get_propnames(self._uri)
-            re = self.mk_propname_response(self._uri, pnames, doc)
-            ms.appendChild(re)
+        def responses():
+            for uri, st in self.iter_page():
+                try:
+                    if isinstance(st, DAV_Error):
+                        raise st
+                    pnames = dc.get_propnames(uri)
+                except DAV_Error as error:
+                    yield self.mk_status_response(uri, error.args[0], doc)
+                    continue
+                yield self.mk_propname_response(uri, pnames, doc)
+            if self.continuation is not None:
+                yield self.mk_truncated_response(doc)
 
-        elif self._depth == "1":
-            pnames = dc.get_propnames(self._uri)
-            re = self.mk_propname_response(self._uri, pnames, doc)
-            ms.appendChild(re)
-
-            for newuri in dc.get_childs(self._uri):
-                pnames = dc.get_propnames(newuri)
-                re = self.mk_propname_response(newuri, pnames, doc)
-                ms.appendChild(re)
-        elif self._depth == 'infinity':
-            uri_list = [self._uri]
-            while uri_list:
-                uri = uri_list.pop()
-                pnames = dc.get_propnames(uri)
-                re = self.mk_propname_response(uri, pnames, doc)
-                ms.appendChild(re)
-                uri_childs = self._dataclass.get_childs(uri)
-                if uri_childs:
-                    uri_list.extend(uri_childs)
-
-        return doc.toxml(encoding="utf-8")
+        return multistatus(responses())
 
-    def create_allprop(self):
-        """ return a list of all properties """
+    def set_allprops(self):
+        """ ask for all the properties of the resource """
         self.proplist = {}
         self.namespaces = []
         for ns, plist in self._dataclass.get_propnames(self._uri).items():
             self.proplist[ns] = plist
             self.namespaces.append(ns)
 
+    def create_allprop(self):
+        """ return a list of all properties """
+        self.set_allprops()
         return self.create_prop()
 
     def create_prop(self):
@@ -149,53 +291,26 @@ class PROPFIND:
         (Not Found) or 403 (Forbidden).
 
         """
-        # create the document generator
-        doc = domimpl.createDocument(None, "multistatus", None)
-        ms = doc.documentElement
-        ms.setAttribute("xmlns:D", "DAV:")
-        ms.tagName = 'D:multistatus'
-
-        if self._depth == "0":
-            gp, bp = self.get_propvalues(self._uri)
-            res = self.mk_prop_response(self._uri, gp, bp, doc)
-            ms.appendChild(res)
-
-        elif self._depth == "1":
-            gp, bp = self.get_propvalues(self._uri)
-            res = self.mk_prop_response(self._uri, gp, bp, doc)
-            ms.appendChild(res)
-
-            for newuri in self._dataclass.get_childs(self._uri):
-                gp, bp = self.get_propvalues(newuri)
-                res = self.mk_prop_response(newuri, gp, bp, doc)
-                ms.appendChild(res)
-        elif self._depth == 'infinity':
-            uri_list = [self._uri]
-            while uri_list:
-                uri = uri_list.pop()
-                gp, bp = self.get_propvalues(uri)
-                res = self.mk_prop_response(uri, gp, bp, doc)
-                ms.appendChild(res)
-                uri_childs = self._dataclass.get_childs(uri)
-                if uri_childs:
-                    uri_list.extend(uri_childs)
-
-        return doc.toxml(encoding="utf-8")
+        return b''.join(self.stream_prop())
 
-    def mk_propname_response(self, uri, propnames, doc):
-        """ make a new <prop> result element for a PROPNAME request
+    def stream_prop(self):
+        """ stream the multistatus response of a <prop> request """
+        doc = domimpl.createDocument(None, "multistatus", None)
 
-        This will simply format the propnames list.
-        propnames should have the format {NS1 : [prop1, prop2, ...], NS2: ...}
+        def responses():
+            for uri, st in self.iter_page():
+                yield self.mk_entry_response(uri, st, doc)
+            if self.continuation is not None:
+                yield self.mk_truncated_response(doc)
 
-        """
-        re = doc.createElement("D:response")
+        return multistatus(responses())
 
+    def mk_href(self, uri, doc):
+        """ make the <href> element of a response """
         if self._dataclass.baseurl:
             uri = self._dataclass.baseurl + '/' + '/'.join(uri.split('/')[3:])
 
-        # write href information
-        uparts = urllib.parse.urlparse(uri)
+        uparts = urllib.parse.urlparse(uri.decode())
         fileloc = uparts[2]
         href = doc.createElement("D:href")
 
@@ -203,7 +318,66 @@ class PROPFIND:
                                   '/'.join(uparts[1:2]) +
                                   urllib.parse.quote(fileloc))
         href.appendChild(huri)
-        re.appendChild(href)
+        return href
+
+    def mk_entry_response(self, uri, st, doc):
+        """ make the response of an entry of iter_entries()
+
+        An entry which can not be answered gets the status of its
+        error, the other ones of the document are still sent.
+        """
+        try:
+            if isinstance(st, DAV_Error):
+                raise st
+            gp, bp = self.get_propvalues(uri, st)
+        except DAV_Error as error:
+            return self.mk_status_response(uri, error.args[0], doc)
+        return self.mk_prop_response(uri, gp, bp, doc)
+
+    def mk_status_response(self, uri, code, doc):
+        """ make a response with a status only """
+        re = doc.createElement("D:response")
+        re.appendChild(self.mk_href(uri, doc))
+        s = doc.createElement("D:status")
+        s.appendChild(doc.createTextNode(utils.gen_estring(code)))
+        re.appendChild(s)
+        return re
+
+    def mk_truncated_response(self, doc):
+        """ make the response telling that more results are available
+
+        As in RFC 5323 the request URI is answered with 507 and a
+        number-of-matches-within-limits error; the description holds
+        the header to send for the next page, if there is one.
+        """
+        re = doc.createElement("D:response")
+        re.appendChild(self.mk_href(self._uri, doc))
+
+        s = doc.createElement("D:status")
+        s.appendChild(doc.createTextNode(utils.gen_estring(507)))
+        re.appendChild(s)
+
+        e = doc.createElement("D:error")
+        e.appendChild(doc.createElement("D:number-of-matches-within-limits"))
+        re.appendChild(e)
+
+        if self.continuation is not None:
+            d = doc.createElement("D:responsedescription")
+            d.appendChild(doc.createTextNode(
+                "Continuation: %d" % self.continuation))
+            re.appendChild(d)
+        return re
+
+    def mk_propname_response(self, uri, propnames, doc):
+        """ make a new <prop> result element for a PROPNAME request
+
+        This will simply format the propnames list.
+        propnames should have the format {NS1 : [prop1, prop2, ...], NS2: ...}
+
+        """
+        re = doc.createElement("D:response")
+
+        re.appendChild(self.mk_href(uri, doc))
 
         ps = doc.createElement("D:propstat")
         nsnum = 0
@@ -241,19 +415,7 @@ class PROPFIND:
                 re.setAttribute("xmlns:ns" + str(nsnum), nsname)
             nsnum += 1
 
-        if self._dataclass.baseurl:
-            uri = self._dataclass.baseurl + '/' + '/'.join(uri.split('/')[3:])
-
-        # write href information
-        uparts = urllib.parse.urlparse(uri.decode())
-        fileloc = uparts[2]
-        href = doc.createElement("D:href")
-
-        huri = doc.createTextNode(uparts[0] + '://' +
-                                  '/'.join(uparts[1:2]) +
-                                  urllib.parse.quote(fileloc))
-        href.appendChild(huri)
-        re.appendChild(href)
+        re.appendChild(self.mk_href(uri, doc))
 
         # write good properties
         ps = doc.createElement("D:propstat")
@@ -269,7 +431,9 @@ class PROPFIND:
             for p, v in good_props[ns].items():
 
                 pe = doc.createElement(ns_prefix + str(p))
-                if isinstance(v, xml.dom.minidom.Element):
+                if isinstance(v, utils.XMLFragment):
+                    pe.appendChild(v.node(doc))
+                elif isinstance(v, xml.dom.minidom.Element):
                     pe.appendChild(v)
                 elif isinstance(v, list):
                     for val in v:
@@ -297,6 +461,8 @@ class PROPFIND:
 
             # write a propstat for each error code
             for ecode in bad_props.keys():
+                if ecode == 404 and self.minimal:
+                    continue
                 ps = doc.createElement("D:propstat")
                 re.appendChild(ps)
                 bp = doc.createElement("D:prop")
@@ -321,7 +487,7 @@ class PROPFIND:
         # return the new response element
         return re
 
-    def get_propvalues(self, uri):
+    def get_propvalues(self, uri, st=None):
         """ create lists of property values for an URI
 
         We create two lists for an URI: the properties for
@@ -333,18 +499,17 @@ class PROPFIND:
         good_props = {}
         bad_props = {}
 
-        ddc = self._dataclass
+        values = self._dataclass.get_props(uri, self.proplist, st)
         for ns, plist in self.proplist.items():
             good_props[ns] = {}
             for prop in plist:
-                ec = 0
-                try:
-                    r = ddc.get_prop(uri, ns, prop)
+                r = values[ns][prop]
+                if not isinstance(r, DAV_Error):
                     good_props[ns][prop] = r
-                except DAV_Error as error_code:
-                    ec = error_code.args[0]
+                    continue
 
                 # ignore props with error_code if 0 (invisible)
+                ec = r.args[0]
                 if ec == 0:
                     continue
 
@@ -1,121 +1,170 @@
 from __future__ import absolute_import
-from .propfind import PROPFIND
+import stat
+import itertools
+
+from six.moves import urllib
+from .constants import RT_ALLPROP
+from .errors import DAV_Error, DAV_NotFound, DAV_ConditionFailed
+from .propfind import PROPFIND, multistatus, prime, domimpl
 from xml.dom import minidom
-domimpl = minidom.getDOMImplementation()
 
-from .utils import get_parenturi
+
+def create_report(uri, dataclass, depth, body):
+    """ return the handler of the report asked for in body """
+    root = minidom.parseString(body).documentElement
+    if (root.namespaceURI, root.localName) == ('DAV:', 'sync-collection'):
+        return SyncCollection(uri, dataclass, depth, body)
+    return REPORT(uri, dataclass, depth, body)
+
 
 class REPORT(PROPFIND):
+    """ answer a REPORT request
+
+    The body is parsed like the one of a PROPFIND for the properties
+    to return; its root element is the filter handed to the interface
+    class, which decides which resources match it. The tree is walked
+    once, each collection is listed once through
+    get_filtered_child_entries().
 
-    def __init__(self, uri, dataclass, depth, body):
-        PROPFIND.__init__(self, uri, dataclass, depth, body)
+    """
+
+    def __init__(self, uri, dataclass, depth, body, offset=0):
+        PROPFIND.__init__(self, uri, dataclass, depth, body, offset)
 
         doc = minidom.parseString(body)
 
         self.filter = doc.documentElement
 
-    def create_propname(self):
-        """ create a multistatus response for the prop names """
+    def iter_entries(self):
+        """ iterate over the (uri, st) pairs matching the filter
 
-        dc=self._dataclass
-        # create the document generator
+        Errors listing collections are handled as in PROPFIND.
+        """
+        dc = self._dataclass
+        root_matches = self._root_matches()
+        if self._depth == "0":
+            if root_matches:
+                yield self._uri, None
+
+        elif self._depth == "1":
+            children = list(dc.get_filtered_child_entries(self._uri,
+                                                          self.filter))
+            if root_matches:
+                yield self._uri, None
+            for uri, st, match in children:
+                if match:
+                    yield uri, st
+
+        elif self._depth == 'infinity':
+            entries = [(self._uri, None, root_matches)]
+            while entries:
+                uri, st, match = entries.pop()
+                children = []
+                if st is None or stat.S_ISDIR(st.st_mode):
+                    try:
+                        children = list(dc.get_filtered_child_entries(
+                            uri, self.filter))
+                    except DAV_Error as error:
+                        if uri == self._uri:
+                            raise
+                        st = error
+                if match:
+                    yield uri, st
+                entries.extend(children)
+
+    def _root_matches(self):
+        """ check the filter for the request URI in its parent listing """
+        parts = urllib.parse.urlparse(self._uri)
+        if parts.path.strip(b'/') == b'':
+            # the root has no parent to ask
+            return True
+
+        parent = self._uri.rsplit(b'/', 1)[0]
+        for uri, st, match in self._dataclass.get_filtered_child_entries(
+                parent, self.filter):
+            if uri == self._uri:
+                return match
+        return False
+
+
+class SyncCollection(REPORT):
+    """ answer a sync-collection REPORT (RFC 6578)
+
+    The changes since the sync token of the request come from
+    get_changes() of the interface class. Without a token all members
+    are reported. Members which changed are answered with the requested
+    properties, members which went away with 404; the new sync token
+    closes the multistatus.
+
+    """
+
+    def __init__(self, uri, dataclass, depth, body, offset=0):
+        REPORT.__init__(self, uri, dataclass, depth, body, offset)
+        if self._depth != "0":
+            raise DAV_Error(400, 'sync-collection needs Depth: 0')
+
+        self.sync_token = self._text('sync-token') or None
+        level = self._text('sync-level')
+        if level not in ('1', 'infinite'):
+            raise DAV_Error(400, 'bad sync-level %s' % level)
+        self.infinite = level == 'infinite'
+        # the members are walked like for a PROPFIND of that depth
+        self._depth = 'infinity' if self.infinite else '1'
+
+        self.limit = None
+        nresults = self._text('nresults')
+        if nresults:
+            if not nresults.isdigit() or int(nresults) < 1:
+                raise DAV_Error(400, 'bad nresults %s' % nresults)
+            self.limit = int(nresults)
+
+    def _text(self, name):
+        """ return the text of a DAV: element of the body, '' if none """
+        for e in self.filter.getElementsByTagNameNS('DAV:', name):
+            return ''.join(node.data for node in e.childNodes
+                           if node.nodeType == node.TEXT_NODE).strip()
+        return ''
+
+    def createResponseStream(self):
+        """ stream the changed members and the new sync token """
+        dc = self._dataclass
+        if not dc.exists(self._uri):
+            raise DAV_NotFound
+
+        token, changes, truncated = dc.get_changes(
+            self._uri, self.sync_token, self.infinite, self.limit)
+        if changes is None:
+            # initial sync, skip the collection itself
+            entries = itertools.islice(self.iter_members(), 1, None)
+            if self.limit is not None:
+                entries = list(itertools.islice(entries, self.limit + 1))
+                if len(entries) > self.limit:
+                    raise DAV_ConditionFailed(
+                        507, 'number-of-matches-within-limits')
+            entries = ((uri, st, False) for uri, st in entries)
+        else:
+            entries = ((uri, None, deleted or not dc.exists(uri))
+                       for uri, deleted in changes)
+
+        if self.request_type == RT_ALLPROP:
+            self.set_allprops()
         doc = domimpl.createDocument(None, "multistatus", None)
-        ms = doc.documentElement
-        ms.setAttribute("xmlns:D", "DAV:")
-        ms.tagName = 'D:multistatus'
-
-        if self._depth=="0":
-            if self._uri in self._dataclass.get_childs(get_parenturi(self._uri),
-                    self.filter):
-                pnames=dc.get_propnames(self._uri)
-                re=self.mk_propname_response(self._uri,pnames, doc)
-                ms.appendChild(re)
-
-        elif self._depth=="1":
-            if self._uri in self._dataclass.get_childs(get_parenturi(self._uri),
-                    self.filter):
-                pnames=dc.get_propnames(self._uri)
-                re=self.mk_propname_response(self._uri,pnames, doc)
-                ms.appendChild(re)
-
-            for newuri in dc.get_childs(self._uri, self.filter):
-                pnames=dc.get_propnames(newuri)
-                re=self.mk_propname_response(newuri,pnames, doc)
-                ms.appendChild(re)
-        elif self._depth=='infinity':
-            uri_list = [self._uri]
-            while uri_list:
-                uri = uri_list.pop()
-                if uri in self._dataclass.get_childs(get_parenturi(uri),
-                        self.filter):
-                    pnames=dc.get_propnames(uri)
-                    re=self.mk_propname_response(uri,pnames, doc)
-                    ms.appendChild(re)
-                uri_childs = self._dataclass.get_childs(uri)
-                if uri_childs:
-                    uri_list.extend(uri_childs)
-
-        return doc.toxml(encoding="utf-8")
-
-    def create_prop(self):
-        """ handle a <prop> request
-
-        This will
-
-        1. set up the <multistatus>-Framework
-
-        2. read the property values for each URI 
-           (which is dependant on the Depth header)
-           This is done by the get_propvalues() method.
-
-        3. For each URI call the append_result() method
-           to append the actual <result>-Tag to the result
-           document.
-
-        We differ between "good" properties, which have been
-        assigned a value by the interface class and "bad" 
-        properties, which resulted in an error, either 404
-        (Not Found) or 403 (Forbidden).
 
-        """
+        def responses():
+            for uri, st, deleted in entries:
+                if deleted:
+                    yield self.mk_status_response(uri, 404, doc)
+                else:
+                    yield self.mk_entry_response(uri, st, doc)
+            if truncated:
+                yield self.mk_truncated_response(doc)
 
+            st = doc.createElement("D:sync-token")
+            st.appendChild(doc.createTextNode(token))
+            yield st
 
-        # create the document generator
-        doc = domimpl.createDocument(None, "multistatus", None)
-        ms = doc.documentElement
-        ms.setAttribute("xmlns:D", "DAV:")
-        ms.tagName = 'D:multistatus'
-
-        if self._depth=="0":
-            if self._uri in self._dataclass.get_childs(get_parenturi(self._uri),
-                    self.filter):
-                gp,bp=self.get_propvalues(self._uri)
-                res=self.mk_prop_response(self._uri,gp,bp,doc)
-                ms.appendChild(res)
-
-        elif self._depth=="1":
-            if self._uri in self._dataclass.get_childs(get_parenturi(self._uri),
-                    self.filter):
-                gp,bp=self.get_propvalues(self._uri)
-                res=self.mk_prop_response(self._uri,gp,bp,doc)
-                ms.appendChild(res)
-
-            for newuri in self._dataclass.get_childs(self._uri, self.filter):
-                gp,bp=self.get_propvalues(newuri)
-                res=self.mk_prop_response(newuri,gp,bp,doc)
-                ms.appendChild(res)
-        elif self._depth=='infinity':
-            uri_list = [self._uri]
-            while uri_list:
-                uri = uri_list.pop()
-                if uri in self._dataclass.get_childs(get_parenturi(uri),
-                        self.filter):
-                    gp,bp=self.get_propvalues(uri)
-                    res=self.mk_prop_response(uri,gp,bp,doc)
-                    ms.appendChild(res)
-                uri_childs = self._dataclass.get_childs(uri)
-                if uri_childs:
-                    uri_list.extend(uri_childs)
-
-        return doc.toxml(encoding="utf-8")
+        return prime(multistatus(responses()))
 
+    def iter_members(self):
+        """ iterate over the collection and all its members """
+        return PROPFIND.iter_entries(self)
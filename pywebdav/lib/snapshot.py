@@ -0,0 +1,99 @@
+"""
+Request-scoped view of a resource
+
+Answering one request asks about the same resource several times: its
+entity tag and modification date for the preconditions, its type,
+whether it exists, is a collection or is locked. A Snapshot looks each
+of them up once, the DAV: properties with a single get_props() call,
+and remembers the answers until the request changes the resource.
+
+"""
+
+from __future__ import absolute_import
+
+from .constants import COLLECTION
+from .errors import DAV_Error
+
+# DAV: properties fetched together on first use
+SNAPSHOT_PROPS = ('getetag', 'getlastmodified', 'getcontenttype',
+                  'resourcetype')
+
+_UNKNOWN = object()
+
+
+class Snapshot:
+    """ what a request learned about the resource at uri
+
+    dc is the interface class, locks the LockManager (the request
+    handler) asked about the lock state.
+    """
+
+    def __init__(self, dc, uri, locks=None):
+        self.dc = dc
+        self.uri = uri
+        self._locks = locks
+        self.changed()
+
+    def changed(self):
+        """ forget everything, the request modified the resource """
+        self._props = None
+        self._exists = _UNKNOWN
+        self._collection = _UNKNOWN
+        self._lock = _UNKNOWN
+
+    def prop(self, name):
+        """ return a DAV: property or raise its DAV_Error """
+        if self._props is None:
+            self._props = dict(self.dc.get_props(
+                self.uri, {'DAV:': SNAPSHOT_PROPS})['DAV:'])
+        if name not in self._props:
+            try:
+                self._props[name] = self.dc.get_prop(self.uri, 'DAV:', name)
+            except DAV_Error as error:
+                self._props[name] = error
+
+        value = self._props[name]
+        if isinstance(value, DAV_Error):
+            raise value
+        return value
+
+    def get(self, name, default=None):
+        """ return a DAV: property, default if it can not be read """
+        try:
+            return self.prop(name)
+        except DAV_Error:
+            return default
+
+    def _resourcetype(self):
+        """ the resourcetype if it has been fetched already, else _UNKNOWN """
+        if self._props is not None:
+            value = self._props.get('resourcetype', _UNKNOWN)
+            if not isinstance(value, DAV_Error):
+                return value
+        return _UNKNOWN
+
+    @property
+    def exists(self):
+        if self._exists is _UNKNOWN:
+            if self._resourcetype() is not _UNKNOWN:
+                self._exists = True
+            else:
+                self._exists = bool(self.dc.exists(self.uri))
+        return self._exists
+
+    @property
+    def is_collection(self):
+        if self._collection is _UNKNOWN:
+            resourcetype = self._resourcetype()
+            if resourcetype is not _UNKNOWN:
+                self._collection = resourcetype == COLLECTION
+            else:
+                self._collection = bool(self.dc.is_collection(self.uri))
+        return self._collection
+
+    @property
+    def lock(self):
+        """ the lock held on the resource, None if there is none """
+        if self._lock is _UNKNOWN:
+            self._lock = self._locks._l_getLockForUri(self.uri)
+        return self._lock
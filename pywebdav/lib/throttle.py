@@ -0,0 +1,108 @@
+"""
+
+Bandwidth shaping for response bodies
+
+A BandwidthLimiter hands out token buckets: one shared by all
+connections, one per authenticated user and one per connection.
+Before a block is written the sender takes its size from every
+bucket it was given and waits for the slowest one.
+
+"""
+
+from __future__ import absolute_import
+import threading
+import time
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """ token bucket refilled with rate bytes per second
+
+    The bucket may go into debt: a block larger than the available
+    tokens is granted at once and the debt is paid by the delay
+    returned from reserve(). The bucket is refilled by clock, the
+    monotonic time by default, so steps of the wall clock neither stall
+    nor burst it.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._clock = clock
+        self._tokens = self.burst
+        self._stamp = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """ take amount tokens, return the seconds to wait before using them """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+
+class BandwidthLimiter:
+    """ global, per user and per connection limits in bytes per second
+
+    A limit of 0 disables the corresponding bucket.
+    """
+
+    def __init__(self, rate=0, user_rate=0, connection_rate=0,
+                 clock=time.monotonic):
+        self.rate = int(rate)
+        self.user_rate = int(user_rate)
+        self.connection_rate = int(connection_rate)
+        self._clock = clock
+
+        self._bucket = self.rate and TokenBucket(self.rate,
+                                                 clock=clock) or None
+        self._user_buckets = {}
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.rate or self.user_rate or self.connection_rate)
+
+    __nonzero__ = __bool__
+
+    def connection_bucket(self):
+        """ return a new bucket for a connection or None """
+        if self.connection_rate:
+            return TokenBucket(self.connection_rate, clock=self._clock)
+        return None
+
+    def buckets(self, user=None, connection_bucket=None):
+        """ return the buckets a request of user has to draw from """
+        buckets = []
+        if self._bucket is not None:
+            buckets.append(self._bucket)
+
+        if self.user_rate and user is not None:
+            with self._lock:
+                bucket = self._user_buckets.get(user)
+                if bucket is None:
+                    bucket = self._user_buckets[user] = \
+                        TokenBucket(self.user_rate, clock=self._clock)
+            buckets.append(bucket)
+
+        if connection_bucket is not None:
+            buckets.append(connection_bucket)
+
+        return buckets
+
+
+def throttle(buckets, amount):
+    """ wait until amount bytes may be sent through all buckets """
+    delay = 0
+    for bucket in buckets:
+        delay = max(delay, bucket.reserve(amount))
+
+    if delay > 0:
+        time.sleep(delay)
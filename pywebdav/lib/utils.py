@@ -1,6 +1,8 @@
 from __future__ import absolute_import
 import time
 import re
+import stat
+from email.utils import parsedate_tz, mktime_tz
 
 from xml.dom import minidom
 from six.moves import urllib
@@ -57,21 +59,19 @@ def create_treelist(dataclass,uri):
     It will return the flattened tree as list
 
     """
-    queue=[uri]
-    list=[uri]
-    while len(queue):
-        element=queue[-1]
-        if dataclass.is_collection(element):
-            childs=dataclass.get_childs(element)
+    queue=[(uri, None)]
+    result=[uri]
+    while queue:
+        element, st = queue.pop()
+        if st is None:
+            collection = dataclass.is_collection(element)
         else:
-            childs=[]
-        if len(childs):
-            list=list+childs
-        # update queue
-        del queue[-1]
-        if len(childs):
-            queue=queue+childs
-    return list
+            collection = stat.S_ISDIR(st.st_mode)
+        if collection:
+            childs = list(dataclass.get_child_entries(element))
+            result.extend(child for child, st in childs)
+            queue.extend(childs)
+    return result
 
 def is_prefix(uri1,uri2):
     """ returns 1 of uri1 is a prefix of uri2 """
@@ -124,6 +124,52 @@ def make_xmlresponse(result):
 
     return doc.toxml(encoding="utf-8")
 
+
+class _RawXML(minidom.Text):
+    """ text node whose data is written out as markup """
+
+    def writexml(self, writer, indent="", addindent="", newl=""):
+        writer.write(self.data)
+
+
+class XMLFragment:
+    """ a property value serialized once, for values which rarely change
+
+    Interface classes can return it instead of a minidom element, the
+    response writer copies the markup as is instead of serializing a
+    tree for every resource. Callers which need the minidom element
+    get it from element().
+    """
+
+    def __init__(self, markup, namespaces=''):
+        self.markup = markup
+        self.namespaces = namespaces
+
+    @classmethod
+    def fromxml(cls, text, namespaces):
+        """ serialize the first element of text
+
+        namespaces are the xmlns attributes the prefixes of text need.
+        """
+        doc = minidom.parseString('<main %s>%s</main>' % (namespaces, text))
+        return cls(doc.documentElement.firstChild.toxml(), namespaces)
+
+    def element(self):
+        """ return a new minidom element parsed from the markup """
+        doc = minidom.parseString('<main %s>%s</main>' % (self.namespaces,
+                                                         self.markup))
+        return doc.documentElement.firstChild
+
+    def node(self, doc):
+        """ return a node of doc holding the markup """
+        node = _RawXML()
+        node.data = self.markup
+        node.ownerDocument = doc
+        return node
+
+    def toxml(self):
+        return self.markup
+
 # taken from App.Common
 
 weekday_abbr = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
@@ -160,6 +206,104 @@ def rfc850_date(ts=None):
             str(year)[2:],
             hh, mm, ss)
 
+def parse_http_date(value):
+    """ return the timestamp of an HTTP-date, None if it is malformed """
+    try:
+        date = parsedate_tz(value)
+    except (TypeError, ValueError):
+        return None
+    if date is None:
+        return None
+    return mktime_tz(date)
+
+EntityTag = re.compile(r'\s*(W/)?("[^"]*"|[^",\s]+)\s*(?:,|$)')
+
+def parse_etags(hdr):
+    """ parse the entity tag list of an If-Match or If-None-Match header
+
+    Returns a list of (weak, opaque-tag) tuples, the quotes are removed.
+    Unquoted tags sent by older clients are accepted as well.
+    """
+    tags = []
+    for m in EntityTag.finditer(hdr):
+        tags.append((bool(m.group(1)), m.group(2).strip('"')))
+    return tags
+
+RangeSpec = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+def parse_range(hdr, size):
+    """ parse a Range header (RFC 7233) for a content of size bytes
+
+    Returns the sorted list of satisfiable (first, last) byte positions,
+    overlapping and adjacent ranges coalesced. The list is empty if no
+    range is satisfiable. None is returned if the header is malformed or
+    not in bytes, it has to be ignored then.
+
+    """
+    unit, sep, specs = hdr.partition('=')
+    if not sep or unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        m = RangeSpec.match(spec)
+        if not m or not (m.group(1) or m.group(2)):
+            return None
+
+        first, last = m.group(1), m.group(2)
+        if not first:
+            # suffix range: the last bytes
+            length = int(last)
+            if length > 0 and size > 0:
+                ranges.append((max(size - length, 0), size - 1))
+            continue
+
+        first = int(first)
+        last = int(last) if last else size - 1
+        if m.group(2) and last < first:
+            return None
+        if first < size:
+            ranges.append((first, min(last, size - 1)))
+
+    ranges.sort()
+    coalesced = []
+    for first, last in ranges:
+        if coalesced and first <= coalesced[-1][1] + 1:
+            coalesced[-1] = (coalesced[-1][0], max(last, coalesced[-1][1]))
+        else:
+            coalesced.append((first, last))
+    return coalesced
+
+def parse_prefer(hdrs):
+    """ parse the Prefer headers of a request (RFC 7240)
+
+    Returns a dict of preference name (lower case) -> value, '' for a
+    preference without one. Parameters are dropped, the first one of
+    repeated preferences wins.
+    """
+    prefs = {}
+    for hdr in hdrs:
+        for pref in hdr.split(','):
+            name, sep, value = pref.split(';', 1)[0].partition('=')
+            name = name.strip().lower()
+            if name and name not in prefs:
+                prefs[name] = value.strip().strip('"')
+    return prefs
+
+def parse_timeout(hdr):
+    """ parse the Timeout header of a LOCK request (RFC 4918 10.7)
+
+    Returns the first timeout of the list the server understands in
+    seconds, None for Infinite or if there is none.
+    """
+    for value in (hdr or '').split(','):
+        value = value.strip()
+        if value.lower() == 'infinite':
+            return None
+        if value[:7].lower() == 'second-' and value[7:].isdigit():
+            return int(value[7:])
+    return None
+
 ### If: header handling support.  IfParser returns a sequence of
 ### TagList objects in the order they were parsed which can then
 ### be used in WebDAV methods to decide whether an operation can
@@ -0,0 +1,347 @@
+"""
+asyncio based server engine
+
+AsyncHTTPServer is a drop-in replacement for ThreadedHTTPServer. The
+connections are owned by an asyncio event loop: it accepts them, waits
+for the request headers and closes idle persistent connections without
+holding a thread. Only a request which has been received completely up
+to its headers is handed to a bounded pool of worker threads, where the
+unchanged DAVRequestHandler logic runs and talks to the blocking
+dav_interface. Request and response bodies are streamed through the
+asyncio transport, files with loop.sendfile.
+
+"""
+
+from __future__ import absolute_import
+import asyncio
+import socket
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from pywebdav.lib.WebDAVServer import BUFFER_SIZE, KEEPALIVE_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+# default size of the worker thread pool
+WORKERS = 32
+
+
+class _StreamReaderFile:
+    """ blocking rfile for handler threads reading from an asyncio stream
+
+    The request headers already read by the event loop are served first.
+    """
+
+    def __init__(self, loop, reader, head):
+        self._loop = loop
+        self._reader = reader
+        self._buffer = head
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def readline(self, size=-1):
+        if b'\n' not in self._buffer:
+            try:
+                self._buffer += self._call(self._reader.readline())
+            except ValueError:
+                # line longer than the stream limit, return what we have
+                pass
+
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size is not None and size >= 0:
+            end = min(end, size)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._buffer + self._call(self._reader.read())
+            self._buffer = b''
+            return data
+
+        if len(self._buffer) < size:
+            try:
+                self._buffer += self._call(
+                    self._reader.readexactly(size - len(self._buffer)))
+            except asyncio.IncompleteReadError as e:
+                self._buffer += e.partial
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        pass
+
+
+class _TransportWriter:
+    """ buffered wfile for handler threads writing to an asyncio stream """
+
+    def __init__(self, loop, writer):
+        self._loop = loop
+        self._writer = writer
+        self._buffer = []
+        self._size = 0
+
+    def write(self, data):
+        self._buffer.append(bytes(data))
+        self._size += len(data)
+        if self._size >= BUFFER_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self._buffer:
+            return
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        asyncio.run_coroutine_threadsafe(self._write(data), self._loop).result()
+
+    async def _write(self, data):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    def close(self):
+        pass
+
+
+class _Connection:
+    """ stands in for the client socket of a handler """
+
+    def __init__(self, loop, writer, wfile):
+        self._loop = loop
+        self._writer = writer
+        self._wfile = wfile
+
+    def sendfile(self, file, offset=0, count=None):
+        """ send a file through the transport, zero-copy where possible """
+        self._wfile.flush()
+        coro = self._loop.sendfile(self._writer.transport, file, offset, count)
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def getpeername(self):
+        return self._writer.get_extra_info('peername')
+
+
+class AsyncHTTPServer:
+    """ serve DAV requests from an asyncio event loop
+
+    The interface follows socketserver: construct it with the server
+    address and the request handler class, then call serve_forever()
+    and shutdown() from another thread. The size of the worker pool is
+    read from the workers option of the [DAV] section.
+
+    """
+
+    request_queue_size = 128
+    allow_reuse_address = True
+
+    # requests served before serve_forever() returns, 0 means unlimited
+    max_requests = 0
+
+    # called without arguments once max_requests is reached
+    on_recycle = None
+
+    # seconds between two runs of the periodic tasks
+    tick_interval = 1.0
+
+    # seconds between two reports of stats() in the log, 0 means never;
+    # read from the stats_interval option of the [DAV] section
+    stats_interval = 0
+
+    def __init__(self, server_address, RequestHandlerClass, reuse_port=False):
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+
+        config = getattr(RequestHandlerClass, '_config', None)
+        workers = WORKERS
+        if config is not None:
+            workers = int(config.DAV.get('workers', WORKERS) or WORKERS)
+            self.stats_interval = float(config.DAV.get('stats_interval', 0)
+                                        or 0)
+        self.max_workers = workers
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if self.allow_reuse_address:
+                self.socket.setsockopt(socket.SOL_SOCKET,
+                                       socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                self.socket.setsockopt(socket.SOL_SOCKET,
+                                       socket.SO_REUSEPORT, 1)
+            self.socket.bind(server_address)
+            self.server_address = self.socket.getsockname()
+            self.socket.listen(self.request_queue_size)
+        except:
+            self.socket.close()
+            raise
+
+        self._loop = None
+        self._executor = None
+        self._idle_writers = set()
+        self.draining = False
+        self.requests_served = 0
+        self._next_report = None
+        self._stopped = threading.Event()
+        self._stopped.set()
+
+    def serve_forever(self):
+        self._stopped.clear()
+        self.draining = False
+        loop = self._loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix='pywebdav')
+        try:
+            server = loop.run_until_complete(asyncio.start_server(
+                self._serve_connection, sock=self.socket))
+            self._ticker = loop.call_later(self.tick_interval, self._tick)
+            loop.run_forever()
+            self._ticker.cancel()
+
+            # stop accepting, drop the idle connections and let the
+            # running requests finish before their connection is closed
+            server.close()
+            self.draining = True
+            for writer in list(self._idle_writers):
+                writer.transport.abort()
+            loop.run_until_complete(
+                loop.run_in_executor(None, self._executor.shutdown))
+            tasks = asyncio.all_tasks(loop)
+            if tasks:
+                loop.run_until_complete(
+                    asyncio.gather(*tasks, return_exceptions=True))
+        finally:
+            loop.close()
+            self._loop = None
+            self._stopped.set()
+
+    def stats(self):
+        """ return the requests served, the connections waiting and the
+        stats of the lock table and of the caches """
+        stats = {'requests': self.requests_served,
+                 'idle_connections': len(self._idle_writers),
+                 'workers': self.max_workers}
+        lock_table = getattr(self.RequestHandlerClass, 'lock_table', None)
+        if lock_table is not None:
+            stats['locks'] = lock_table.stats()
+        dc = getattr(self.RequestHandlerClass, 'IFACE_CLASS', None)
+        for name in 'stat_cache', 'gzip_cache':
+            cache = getattr(dc, name, None)
+            if cache is not None:
+                stats[name] = cache.stats()
+        return stats
+
+    def report_stats(self, now=None):
+        """ log stats() once every stats_interval seconds """
+        if not self.stats_interval:
+            return
+        if now is None:
+            now = self._loop.time()
+        if self._next_report is None:
+            self._next_report = now + self.stats_interval
+        elif now >= self._next_report:
+            self._next_report = now + self.stats_interval
+            log.info('Server stats: %s' % self.stats())
+
+    def expire_locks(self):
+        """ remove the expired locks from the lock table """
+        lock_table = getattr(self.RequestHandlerClass, 'lock_table', None)
+        if lock_table is not None:
+            lock_table.expire()
+
+    def _tick(self):
+        """ run the periodic tasks, in the loop """
+        try:
+            self.expire_locks()
+            self.report_stats()
+        finally:
+            self._ticker = self._loop.call_later(self.tick_interval,
+                                                 self._tick)
+
+    def shutdown(self):
+        """ stop serve_forever() and wait until it returned """
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+        self._stopped.wait()
+
+    def server_close(self):
+        self.socket.close()
+
+    def _make_handler(self, writer):
+        """ create a request handler for a new connection
+
+        The handler is not constructed the socketserver way as that would
+        run the whole connection; the streams are bridged to the loop.
+        """
+        loop = self._loop
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.server = self
+        handler.client_address = writer.get_extra_info('peername')
+        handler.wfile = _TransportWriter(loop, writer)
+        handler.connection = handler.request = \
+            _Connection(loop, writer, handler.wfile)
+        handler.init_connection()
+        return handler
+
+    def _handle_one_request(self, handler):
+        """ run one request in a worker thread """
+        try:
+            handler.handle_one_request()
+        finally:
+            # early error responses are not flushed by the handler
+            handler.wfile.flush()
+
+    async def _serve_connection(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None and sock.family in (socket.AF_INET,
+                                                socket.AF_INET6):
+            # asyncio only does this for sockets created with IPPROTO_TCP
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        handler = self._make_handler(writer)
+        loop = self._loop
+        # 0 disables persistent connections as in the threaded engine
+        keepalive = handler._keepalive_timeout()
+        try:
+            while not self.draining:
+                # without keep-alive the first request is still waited for
+                timeout = keepalive if keepalive > 0 else KEEPALIVE_TIMEOUT
+                self._idle_writers.add(writer)
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b'\r\n\r\n'), timeout)
+                except asyncio.TimeoutError:
+                    log.debug('Closing idle connection %s' %
+                              (handler.client_address, ))
+                    break
+                except (asyncio.IncompleteReadError,
+                        asyncio.LimitOverrunError, ConnectionError):
+                    break
+                finally:
+                    self._idle_writers.discard(writer)
+
+                self.requests_served += 1
+                if self.requests_served == self.max_requests:
+                    self.draining = True
+                    log.info('Served %d requests, shutting down' %
+                             self.max_requests)
+                    if self.on_recycle is not None:
+                        self.on_recycle()
+                    loop.stop()
+
+                handler.rfile = _StreamReaderFile(loop, reader, head)
+                handler.close_connection = True
+                await loop.run_in_executor(self._executor,
+                                           self._handle_one_request, handler)
+                if handler.close_connection or keepalive <= 0:
+                    break
+        except ConnectionError:
+            pass
+        except Exception:
+            log.exception('Error while serving %s' %
+                          (handler.client_address, ))
+        finally:
+            writer.close()
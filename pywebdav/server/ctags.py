@@ -0,0 +1,160 @@
+"""
+Change tags of collections
+
+A client which remembers the getctag property of a collection knows
+whether anything below it changed by asking for that single property,
+without listing the collection. The CTagStore hands out these tags.
+
+The FilesystemHandler bumps the tags of all the ancestors of a path it
+changes. Tags are numbers from a counter shared by all the collections,
+so a collection which is removed and created again never gets one of
+its former tags back.
+
+Changes made outside the server show up through the modification time
+of the directories: when a tag is asked for and the mtime of its
+directory is not the one seen before, the tags of the directory and of
+its ancestors are bumped. Only the entries of a directory change its
+mtime, so a change further down is only seen once the tag of the
+directory holding it was asked for; changes of the content of files
+are not seen that way.
+
+The tags are kept in a SQLite database, in memory or in a file which
+survives restarts and is shared by the pre-forked workers. Without a
+file every start of the server hands out new tags.
+
+"""
+
+from __future__ import absolute_import
+import os
+import uuid
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+_SCHEMA = ('CREATE TABLE IF NOT EXISTS ctags '
+           '(path TEXT PRIMARY KEY, tag INTEGER NOT NULL, mtime INTEGER)',
+           'CREATE TABLE IF NOT EXISTS meta '
+           '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+
+class CTagStore:
+    """ the change tags of the directories below root """
+
+    def __init__(self, root, path=None):
+        self.root = root.rstrip(os.sep) or os.sep
+        self._prefix_path = root.rstrip(os.sep) + os.sep
+        self.path = path
+        self._lock = threading.Lock()
+        self._open()
+        if path is not None and hasattr(os, 'register_at_fork'):
+            # the workers must not share the connection
+            os.register_at_fork(after_in_child=self._reopen)
+
+    def _open(self):
+        self._db = sqlite3.connect(self.path or ':memory:', timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        if self.path is not None:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._transaction() as db:
+            for statement in _SCHEMA:
+                db.execute(statement)
+            db.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)',
+                       ('epoch', uuid.uuid4().hex[:16]))
+            db.execute('INSERT OR IGNORE INTO meta VALUES (?, ?)',
+                       ('counter', '0'))
+            self._epoch = db.execute(
+                "SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+
+    def _reopen(self):
+        self._lock = threading.Lock()
+        self._open()
+
+    @contextmanager
+    def _transaction(self):
+        """ a transaction holding the write lock of the database """
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def _tag(self, number):
+        return '%s-%d' % (self._epoch, number)
+
+    def _next(self, db):
+        """ count up and return the new value of the counter """
+        number = int(db.execute(
+            "SELECT value FROM meta WHERE key = 'counter'").fetchone()[0]) + 1
+        db.execute("UPDATE meta SET value = ? WHERE key = 'counter'",
+                   (str(number),))
+        return number
+
+    def _ancestors(self, directory):
+        """ directory and its parents up to the root """
+        while True:
+            yield directory
+            if directory == self.root or \
+                    not directory.startswith(self._prefix_path):
+                return
+            directory = os.path.dirname(directory)
+
+    def _bump(self, db, directory, number):
+        for parent in self._ancestors(directory):
+            # the mtime is taken on the next lookup, the server changed
+            # the directory after calling changed()
+            db.execute('INSERT OR REPLACE INTO ctags VALUES (?, ?, NULL)',
+                       (parent, number))
+
+    def changed(self, path, subtree=False):
+        """ bump the tags of the directories above path
+
+        If subtree is set, or path is a directory itself, the tags of
+        path and below are forgotten: the directory was removed or
+        created.
+        """
+        path = path.rstrip(os.sep) or os.sep
+        with self._transaction() as db:
+            if subtree or os.path.isdir(path):
+                # every path starting with path + os.sep sorts before
+                # path + the character following os.sep
+                db.execute('DELETE FROM ctags WHERE path = ? OR '
+                           '(path > ? AND path < ?)',
+                           (path, path + os.sep,
+                            path + chr(ord(os.sep) + 1)))
+            if path != self.root:
+                self._bump(db, os.path.dirname(path), self._next(db))
+
+    def get(self, directory, mtime):
+        """ return the tag of directory, whose mtime_ns is mtime """
+        directory = directory.rstrip(os.sep) or os.sep
+        with self._lock:
+            row = self._db.execute('SELECT tag, mtime FROM ctags WHERE '
+                                   'path = ?', (directory,)).fetchone()
+        if row is not None and row[1] == mtime:
+            return self._tag(row[0])
+
+        with self._transaction() as db:
+            row = db.execute('SELECT tag, mtime FROM ctags WHERE path = ?',
+                             (directory,)).fetchone()
+            if row is None or row[1] is None:
+                # not seen yet or just changed by the server
+                number = row[0] if row else int(db.execute(
+                    "SELECT value FROM meta WHERE key = 'counter'"
+                ).fetchone()[0])
+            elif row[1] != mtime:
+                # changed outside the server
+                number = self._next(db)
+                self._bump(db, directory, number)
+            else:
+                return self._tag(row[0])
+            db.execute('INSERT OR REPLACE INTO ctags VALUES (?, ?, ?)',
+                       (directory, number, mtime))
+        return self._tag(number)
+
+    def close(self):
+        self._db.close()
@@ -83,7 +83,7 @@ def deamonize(stdout='/dev/null', stderr=None, stdin='/dev/null',
     if not stderr: stderr = stdout
     si = open(stdin, 'r')
     so = open(stdout, 'a+')
-    se = open(stderr, 'a+', 0)
+    se = open(stderr, 'a+', 1)
     pid = str(os.getpid())
     sys.stderr.write("\n%s\n" % startmsg % pid)
     sys.stderr.flush()
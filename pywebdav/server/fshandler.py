@@ -1,16 +1,20 @@
 from __future__ import absolute_import
 import os
+import stat
+import hashlib
 import textwrap
 import six
 import logging
 import types
 import shutil
-from io import StringIO
+from io import BytesIO
 from six.moves import urllib
 from pywebdav.lib.constants import COLLECTION, OBJECT
 from pywebdav.lib.errors import *
 from pywebdav.lib.iface import *
 from pywebdav.lib.davcmd import copyone, copytree, moveone, movetree, delone, deltree
+from pywebdav.lib.utils import rfc1123_date, iso8601_date
+from pywebdav.server.journal import InvalidToken
 if six.PY2:
     from cgi import escape
 else:
@@ -19,6 +23,12 @@ else:
 log = logging.getLogger(__name__)
 
 BUFFER_SIZE = 128 * 1000 
+
+# entity tags remembered in the hash mode
+ETAG_HASHES = 4096
+
+# uri to local path mappings remembered
+LOCAL_PATHS = 4096
 # include magic support to correctly determine mimetypes
 MAGIC_AVAILABLE = False
 try:
@@ -39,12 +49,13 @@ class Resource(object):
         return self.__file_size
 
     def __iter__(self):
-        while 1:
-            data = self.__fp.read(BUFFER_SIZE)
+        remaining = self.__file_size
+        while remaining > 0:
+            data = self.__fp.read(min(BUFFER_SIZE, remaining))
             if not data:
                 break
+            remaining -= len(data)
             yield data
-            time.sleep(0.005)
         self.__fp.close()
 
     def read(self, length = 0):
@@ -53,7 +64,23 @@ class Resource(object):
 
         data = self.__fp.read(length)
         return data
-        
+
+    def fileno(self):
+        """ file descriptor for zero-copy sending
+
+        Raises io.UnsupportedOperation for in-memory content.
+        """
+        return self.__fp.fileno()
+
+    def tell(self):
+        return self.__fp.tell()
+
+    def seek(self, offset, whence=0):
+        return self.__fp.seek(offset, whence)
+
+    def close(self):
+        self.__fp.close()
+
 
 class FilesystemHandler(dav_interface):
     """ 
@@ -69,12 +96,40 @@ class FilesystemHandler(dav_interface):
 
     """
 
+    # serve foo.gz instead of foo to clients accepting gzip
+    gzip_static = False
+
+    # a gzipcache.GzipCache with compressed variants of the files
+    gzip_cache = None
+
+    # a statcache.StatCache for the metadata of the files
+    stat_cache = None
+
+    # a journal.ChangeJournal recording the changes for sync clients
+    journal = None
+
+    # a ctags.CTagStore with the change tags of the collections
+    ctags = None
+
+    # 'stat': entity tags from inode, size and modification time,
+    # 'hash': from a SHA-1 digest of the content of files
+    etag_mode = 'stat'
+
+    @classmethod
+    def _compile_prop_methods(cls):
+        super()._compile_prop_methods()
+        cls._stat_methods = cls._find_prop_methods(dir(cls), '_stat')
+
     def __init__(self, directory, uri, verbose=False):
+        self._local_paths = {}
         self.setDirectory(directory)
         self.setBaseURI(uri)
 
         # should we be verbose?
         self.verbose = verbose
+
+        # path -> (stat key, digest) for the hash mode
+        self._etag_hashes = {}
         log.info('Initialized with %s %s' % (directory, uri))
 
     def setDirectory(self, path):
@@ -84,6 +139,7 @@ class FilesystemHandler(dav_interface):
             raise Exception('%s not must be a directory!' % path)
 
         self.directory = path
+        self._local_paths = {}
 
     def setBaseURI(self, uri):
         """ Sets the base uri """
@@ -92,10 +148,16 @@ class FilesystemHandler(dav_interface):
 
     def uri2local(self,uri):
         """ map uri in baseuri and local part """
-        uparts=urllib.parse.urlparse(uri.decode())
-        fileloc=uparts[2][1:]
-        filename=os.path.join(self.directory, fileloc)
-        filename=os.path.normpath(filename)
+        filename = self._local_paths.get(uri)
+        if filename is None:
+            uparts=urllib.parse.urlparse(uri.decode())
+            fileloc=uparts[2][1:]
+            filename=os.path.join(self.directory, fileloc)
+            filename=os.path.normpath(filename)
+
+            if len(self._local_paths) >= LOCAL_PATHS:
+                self._local_paths.clear()
+            self._local_paths[uri] = filename
         return filename
 
     def local2uri(self,filename):
@@ -111,23 +173,54 @@ class FilesystemHandler(dav_interface):
     def get_childs(self, uri, filter=None):
         """ return the child objects as self.baseuris for the given URI """
 
-        fileloc=self.uri2local(uri)
-        filelist=[]
-
-        if os.path.exists(fileloc):
-            if os.path.isdir(fileloc):
-                try:
-                    files=os.listdir(fileloc)
-                except:
-                    raise DAV_NotFound
+        filelist = [child for child, entry in self._scan(uri)]
+        if filelist:
+            log.info('get_childs: Childs %s' % filelist)
+        return filelist
 
-                for file in files:
-                    newloc=os.path.join(fileloc,file)
-                    filelist.append(self.local2uri(newloc))
+    def get_child_entries(self, uri):
+        """ iterate over the children of a collection with their stat
 
-                log.info('get_childs: Childs %s' % filelist)
+        The entries come from one scandir pass, each one is stat'ed at
+        most once.
+        """
+        for child, entry in self._scan(uri):
+            try:
+                if self.stat_cache is not None:
+                    st = self.stat_cache.stat(entry.path)
+                else:
+                    st = entry.stat()
+            except OSError:
+                # e.g. a dangling symlink, the properties will tell
+                st = None
+            yield child, st
+
+    def get_filtered_child_entries(self, uri, filter):
+        """ iterate over the children of a collection for a REPORT
+
+        The filter is not evaluated, every child matches and the
+        directory is scanned once. Subclasses which filter in
+        get_childs(uri, filter) get the default of dav_interface.
+        """
+        if type(self).get_childs is not FilesystemHandler.get_childs:
+            return dav_interface.get_filtered_child_entries(self, uri,
+                                                            filter)
+        return ((child, st, True) for child, st in self.get_child_entries(uri))
+
+    def _scan(self, uri):
+        """ list the (uri, os.DirEntry) pairs of a directory """
+        fileloc = self.uri2local(uri)
+        try:
+            it = os.scandir(fileloc)
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+        except OSError:
+            raise DAV_NotFound
 
-        return filelist
+        # the uri of the directory is mapped once, not for every child
+        prefix = self.local2uri(fileloc).rstrip(b'/') + b'/'
+        with it:
+            return [(prefix + entry.name.encode(), entry) for entry in it]
 
     def _get_listing(self, path):
         """Return a directory listing similar to http.server's"""
@@ -145,7 +238,9 @@ class FilesystemHandler(dav_interface):
                 </body>
             </html>
             """)
-        escapeditems = (escape(i) + ('/' if os.path.isdir(os.path.join(path, i)) else '') for i in os.listdir(path) if not i.startswith('.'))
+        with os.scandir(path) as it:
+            escapeditems = [escape(e.name) + ('/' if e.is_dir() else '')
+                            for e in it if not e.name.startswith('.')]
         htmlitems = "\n".join('<li><a href="{i}">{i}</a></li>'.format(i=i) for i in escapeditems)
 
         return template.format(items=htmlitems, path=path)
@@ -154,11 +249,19 @@ class FilesystemHandler(dav_interface):
         """ return the content of an object """
 
         path=self.uri2local(uri)
-        if os.path.exists(path):
-            if os.path.isfile(path):
-                file_size = os.path.getsize(path)
-                if range is None:
+        try:
+            st = self._os_stat(path)
+        except OSError:
+            st = None
+        if st is not None:
+            if stat.S_ISREG(st.st_mode):
+                try:
                     fp=open(path,"rb")
+                except OSError:
+                    raise DAV_NotFound
+                # the cached size may be behind the file
+                file_size = os.fstat(fp.fileno()).st_size
+                if range is None:
                     log.info('Serving content of %s' % uri)
                     return Resource(fp, file_size)
                 else:
@@ -173,18 +276,18 @@ class FilesystemHandler(dav_interface):
                         range[0] = int(range[0])
 
                     if range[0] > file_size:
+                        fp.close()
                         raise DAV_Requested_Range_Not_Satisfiable
 
                     if range[1] > file_size:
                         range[1] = file_size
 
-                    fp=open(path,"rb")
                     fp.seek(range[0])
                     log.info('Serving range %s -> %s content of %s' % (range[0], range[1], uri))
                     return Resource(fp, range[1] - range[0])
-            elif os.path.isdir(path):
-                msg = self._get_listing(path)
-                return Resource(StringIO(msg), len(msg))
+            elif stat.S_ISDIR(st.st_mode):
+                msg = self._get_listing(path).encode('utf-8')
+                return Resource(BytesIO(msg), len(msg))
             else:
                 # also raise an error for collections
                 # don't know what should happen then..
@@ -192,13 +295,149 @@ class FilesystemHandler(dav_interface):
 
         raise DAV_NotFound
 
+    def get_gzip_data(self, uri, min_size=0):
+        """ return the gzip compressed content of a file
+
+        Uses an up to date foo.gz next to the file if gzip_static is
+        set, else the gzip cache. Returns None if neither has the content
+        or the file is not larger than min_size.
+        """
+        path = self.uri2local(uri)
+        try:
+            st = self._os_stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode) or st.st_size <= min_size:
+            return None
+
+        if self.gzip_static:
+            try:
+                fp = open(path + '.gz', 'rb')
+            except OSError:
+                pass
+            else:
+                gz = os.fstat(fp.fileno())
+                if gz.st_mtime >= st.st_mtime:
+                    log.info('Serving content of %s.gz' % uri)
+                    return Resource(fp, gz.st_size)
+                fp.close()
+
+        if self.gzip_cache is not None:
+            fp = self.gzip_cache.open(path, st)
+            if fp is not None:
+                log.info('Serving cached gzip content of %s' % uri)
+                return Resource(fp, os.fstat(fp.fileno()).st_size)
+
+        return None
+
+    def get_props(self, uri, ns_props, st=None):
+        """ return the values of several properties of a resource
+
+        The DAV: properties describing the file are answered from a
+        single stat by the _stat_<name> methods, the other ones through
+        get_prop().
+        """
+        path = self.uri2local(uri)
+        if st is None:
+            try:
+                st = self._os_stat(path)
+            except OSError:
+                pass
+
+        result = {}
+        for ns, plist in ns_props.items():
+            values = result[ns] = {}
+            for prop in plist:
+                method = None
+                if ns == 'DAV:' and st is not None:
+                    method = self._stat_methods.get(prop)
+                try:
+                    if method is None:
+                        values[prop] = self.get_prop(uri, ns, prop)
+                    else:
+                        values[prop] = getattr(self, method)(path, st)
+                except DAV_Error as error:
+                    values[prop] = error
+        return result
+
+    def _stat(self, uri):
+        """ return the local path of uri and its stat result """
+        path = self.uri2local(uri)
+        try:
+            return path, self._os_stat(path)
+        except OSError:
+            raise DAV_NotFound
+
+    def _os_stat(self, path):
+        """ os.stat, through the stat cache if there is one """
+        if self.stat_cache is not None:
+            return self.stat_cache.stat(path)
+        return os.stat(path)
+
+    def _changed(self, path, subtree=False):
+        """ forget the cached metadata of a path the server changed
+
+        The change is recorded in the journal and the change tags of the
+        collections above it are bumped, if there are any.
+        """
+        if self.stat_cache is not None:
+            self.stat_cache.invalidate(path, subtree)
+            # the directory has a new modification time
+            self.stat_cache.invalidate(os.path.dirname(path))
+        if self.ctags is not None:
+            self.ctags.changed(path, subtree)
+        if self.journal is not None:
+            path = path.rstrip(os.sep)
+            self.journal.record(path, not os.path.lexists(path))
+
+    def get_changes(self, uri, token, infinite=False, limit=None):
+        """ return the changes of a collection recorded in the journal """
+        if self.journal is None or not self.is_collection(uri):
+            return dav_interface.get_changes(self, uri, token, infinite,
+                                             limit)
+        if token is None:
+            return self.journal.token(), None, False
+
+        try:
+            token, changes, truncated = self.journal.changes(
+                token, self.uri2local(uri), infinite, limit)
+        except InvalidToken:
+            raise DAV_ConditionFailed(403, 'valid-sync-token')
+        return token, [(self.local2uri(path), deleted)
+                       for path, deleted in changes], truncated
+
+    def _get_dav_sync_token(self, uri):
+        """ the sync token of a collection (RFC 6578) """
+        if self.journal is None or not self.is_collection(uri):
+            raise DAV_NotFound
+        return self.journal.token()
+
+    def get_propnames(self, uri):
+        """ return the property names of a resource
+
+        getctag is only listed for collections, when there is a
+        CTagStore to answer it.
+        """
+        if self.ctags is not None and self.is_collection(uri):
+            return dict(self.PROPS, **{CS_NS: ('getctag',)})
+        return self.PROPS
+
+    def get_ctag(self, uri):
+        """ return the change tag of a collection from the CTagStore """
+        path, st = self._stat(uri)
+        if self.ctags is None or not stat.S_ISDIR(st.st_mode):
+            raise DAV_NotFound
+        return self.ctags.get(path, st.st_mtime_ns)
+
     def _get_dav_resourcetype(self,uri):
         """ return type of object """
-        path=self.uri2local(uri)
-        if os.path.isfile(path):
+        return self._stat_resourcetype(*self._stat(uri))
+
+    def _stat_resourcetype(self, path, st):
+        if stat.S_ISREG(st.st_mode):
             return OBJECT
 
-        elif os.path.isdir(path):
+        elif stat.S_ISDIR(st.st_mode):
             return COLLECTION
 
         raise DAV_NotFound
@@ -208,58 +447,93 @@ class FilesystemHandler(dav_interface):
 
     def _get_dav_getcontentlength(self,uri):
         """ return the content length of an object """
-        path=self.uri2local(uri)
-        if os.path.exists(path):
-            if os.path.isfile(path):
-                s=os.stat(path)
-                return str(s[6])
+        try:
+            return self._stat_getcontentlength(*self._stat(uri))
+        except DAV_NotFound:
+            return '0'
 
+    def _stat_getcontentlength(self, path, st):
+        if stat.S_ISREG(st.st_mode):
+            return str(st.st_size)
         return '0'
 
+    def _stat_getlastmodified(self, path, st):
+        return rfc1123_date(st.st_mtime)
+
+    def _stat_creationdate(self, path, st):
+        return iso8601_date(st.st_ctime)
+
+    def _get_dav_getetag(self, uri):
+        """ return a strong entity tag, taken from a single stat """
+        return self._stat_getetag(*self._stat(uri))
+
+    def _stat_getetag(self, path, st):
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if self.etag_mode == 'hash' and stat.S_ISREG(st.st_mode):
+            return '"%s"' % self._content_hash(path, key)
+        return '"%x-%x-%x"' % key
+
+    def _content_hash(self, path, key):
+        """ return the SHA-1 digest of a file, computed once per version """
+        cached = self._etag_hashes.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        digest = hashlib.sha1()
+        try:
+            with open(path, 'rb') as fp:
+                for block in iter(lambda: fp.read(BUFFER_SIZE), b''):
+                    digest.update(block)
+        except (OSError, IOError):
+            raise DAV_NotFound
+
+        if len(self._etag_hashes) >= ETAG_HASHES:
+            self._etag_hashes.clear()
+        value = digest.hexdigest()
+        self._etag_hashes[path] = (key, value)
+        return value
+
     def get_lastmodified(self,uri):
         """ return the last modified date of the object """
-        path=self.uri2local(uri)
-        if os.path.exists(path):
-            s=os.stat(path)
-            date=s[8]
-            return date
-
-        raise DAV_NotFound
+        path, s = self._stat(uri)
+        return s[stat.ST_MTIME]
 
     def get_creationdate(self,uri):
         """ return the last modified date of the object """
-        path=self.uri2local(uri)
-        if os.path.exists(path):
-            s=os.stat(path)
-            date=s[9]
-            return date
-
-        raise DAV_NotFound
+        path, s = self._stat(uri)
+        return s[stat.ST_CTIME]
 
     def _get_dav_getcontenttype(self, uri):
         """ find out yourself! """
-
-        path=self.uri2local(uri)
-        if os.path.exists(path):
-            if os.path.isfile(path):
-                if MAGIC_AVAILABLE is False \
-                        or self.mimecheck is False:
-                    return 'application/octet-stream'
-                else:
-                    ret, encoding = mimetypes.guess_type(path)
-
-                    # for non mimetype related result we
-                    # simply return an appropriate type
-                    if ret.find('/')==-1:
-                        if ret.find('text')>=0:
-                            return 'text/plain'
-                        else:
-                            return 'application/octet-stream'
+        path = self.uri2local(uri)
+        try:
+            st = self._os_stat(path)
+        except OSError:
+            raise DAV_NotFound('Could not find %s' % path)
+        return self._stat_getcontenttype(path, st)
+
+    def _stat_getcontenttype(self, path, st):
+        if stat.S_ISREG(st.st_mode):
+            if MAGIC_AVAILABLE is False \
+                    or self.mimecheck is False:
+                return 'application/octet-stream'
+            else:
+                ret, encoding = mimetypes.guess_type(path)
+                if ret is None:
+                    raise DAV_NotFound('Unknown type of %s' % path)
+
+                # for non mimetype related result we
+                # simply return an appropriate type
+                if ret.find('/')==-1:
+                    if ret.find('text')>=0:
+                        return 'text/plain'
                     else:
-                        return ret
+                        return 'application/octet-stream'
+                else:
+                    return ret
 
-            elif os.path.isdir(path):
-                return "httpd/unix-directory"
+        elif stat.S_ISDIR(st.st_mode):
+            return "httpd/unix-directory"
 
         raise DAV_NotFound('Could not find %s' % path)
 
@@ -278,6 +552,8 @@ class FilesystemHandler(dav_interface):
         except Exception as e:
             log.info('put: Could not create %s, %r', uri, e)
             raise DAV_Error(424)
+        finally:
+            self._changed(path)
 
         return None
 
@@ -300,6 +576,7 @@ class FilesystemHandler(dav_interface):
         # test, if we are allowed to create it
         try:
             os.mkdir(path)
+            self._changed(path)
             log.info('mkcol: Created new collection %s' % path)
             return 201
         except:
@@ -312,27 +589,29 @@ class FilesystemHandler(dav_interface):
     def rmcol(self,uri):
         """ delete a collection """
         path=self.uri2local(uri)
-        if not os.path.exists(path):
-            raise DAV_NotFound
-
         try:
             shutil.rmtree(path)
+        except FileNotFoundError:
+            raise DAV_NotFound
         except OSError:
             raise DAV_Forbidden # forbidden
+        finally:
+            self._changed(path, subtree=True)
         
         return 204
 
     def rm(self,uri):
         """ delete a normal resource """
         path=self.uri2local(uri)
-        if not os.path.exists(path):
-            raise DAV_NotFound
-
         try:
             os.unlink(path)
+        except FileNotFoundError:
+            raise DAV_NotFound
         except OSError as ex:
             log.info('rm: Forbidden (%s)' % ex)
             raise DAV_Forbidden # forbidden
+        finally:
+            self._changed(path)
 
         return 204
 
@@ -413,6 +692,8 @@ class FilesystemHandler(dav_interface):
         except (OSError, IOError):
             log.info('copy: forbidden')
             raise DAV_Error(409)
+        finally:
+            self._changed(dstfile)
 
     def copycol(self, src, dst):
         """ copy a collection.
@@ -427,15 +708,19 @@ class FilesystemHandler(dav_interface):
 
     def exists(self,uri):
         """ test if a resource exists """
-        path=self.uri2local(uri)
-        if os.path.exists(path):
-            return 1
-        return None
+        try:
+            self._stat(uri)
+        except DAV_NotFound:
+            return None
+        return 1
 
     def is_collection(self,uri):
         """ test if the given uri is a collection """
-        path=self.uri2local(uri)
-        if os.path.isdir(path):
+        try:
+            path, st = self._stat(uri)
+        except DAV_NotFound:
+            return 0
+        if stat.S_ISDIR(st.st_mode):
             return 1
         else:
             return 0
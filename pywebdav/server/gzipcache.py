@@ -0,0 +1,196 @@
+"""
+On-disk cache of gzip compressed files
+
+Compressing the same large file for every download wastes CPU. The
+GzipCache keeps the compressed variant of a file in a cache directory,
+keyed by the path, the modification time and the size of the file, so
+that a modified file is compressed again. The least recently used
+entries are removed when the cache grows beyond its size budget.
+
+"""
+
+from __future__ import absolute_import
+import os
+import time
+import hashlib
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+
+from pywebdav.lib.WebDAVServer import BUFFER_SIZE
+from pywebdav.lib.compression import GZIP_LEVEL, gzip_stream
+
+log = logging.getLogger(__name__)
+
+# default size budget of the cache in bytes, see [DAV] gzip_cache_size
+MAX_SIZE = 256 * 1024 * 1024
+
+
+def _read_blocks(fp):
+    while True:
+        block = fp.read(BUFFER_SIZE)
+        if not block:
+            break
+        yield block
+
+
+class GzipCache:
+    """ compressed variants of files stored in a directory
+
+    Files larger than a quarter of the budget are not cached.
+
+    """
+
+    def __init__(self, directory, max_size=MAX_SIZE, level=GZIP_LEVEL):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_entry_size = max_size // 4
+        self.level = level
+
+        self.hits = 0
+        self.misses = 0
+        self._hit_bytes = 0
+        self._compressed_bytes = 0
+        self._compress_time = 0.0
+
+        self._entries = OrderedDict()
+        self._names = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._load()
+
+    def _load(self):
+        """ register the entries left by a previous run, oldest first """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.gz'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+
+        with self._lock:
+            for mtime, name, size in sorted(entries):
+                self._add(name, size)
+            self._evict()
+
+    def _key(self, path):
+        path = path.encode('utf-8', 'surrogateescape')
+        return hashlib.sha1(path).hexdigest()
+
+    def _add(self, name, size):
+        """ register an entry, replacing the one of an older version """
+        key = name.split('-', 1)[0]
+        old = self._names.get(key)
+        if old is not None and old != name:
+            self._remove(old)
+        self._names[key] = name
+        self._entries[name] = size
+        self._size += size
+
+    def _remove(self, name):
+        self._size -= self._entries.pop(name)
+        key = name.split('-', 1)[0]
+        if self._names.get(key) == name:
+            del self._names[key]
+        try:
+            os.unlink(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self._size > self.max_size and self._entries:
+            name = next(iter(self._entries))
+            log.debug('Evicting %s from the gzip cache' % name)
+            self._remove(name)
+
+    def open(self, path, st=None):
+        """ open the compressed variant of the file at path
+
+        The variant is created on a miss. Returns None if the file is
+        too large to be cached.
+        """
+        if st is None:
+            st = os.stat(path)
+        name = '%s-%d-%d.gz' % (self._key(path), st.st_mtime_ns, st.st_size)
+        filename = os.path.join(self.directory, name)
+
+        with self._lock:
+            if name in self._entries:
+                try:
+                    fp = open(filename, 'rb')
+                except OSError:
+                    # removed behind our back
+                    self._remove(name)
+                else:
+                    self._entries.move_to_end(name)
+                    self.hits += 1
+                    self._hit_bytes += st.st_size
+                    return fp
+
+        if st.st_size > self.max_entry_size:
+            return None
+
+        fp = self._compress(path, st, filename)
+        if fp is not None:
+            with self._lock:
+                self.misses += 1
+                if name in self._entries:
+                    self._size -= self._entries.pop(name)
+                self._add(name, os.fstat(fp.fileno()).st_size)
+                self._evict()
+        return fp
+
+    def _compress(self, path, st, filename):
+        """ compress the file at path to filename and open the result """
+        start = time.time()
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out, open(path, 'rb') as src:
+                for block in gzip_stream(_read_blocks(src), self.level):
+                    out.write(block)
+
+            current = os.stat(path)
+            if (current.st_mtime_ns, current.st_size) != \
+                    (st.st_mtime_ns, st.st_size):
+                # modified while compressing, do not cache a mix
+                os.unlink(tmpname)
+                return None
+
+            os.replace(tmpname, filename)
+            fp = open(filename, 'rb')
+        except OSError:
+            log.exception('Could not compress %s to the gzip cache' % path)
+            try:
+                os.unlink(tmpname)
+            except OSError:
+                pass
+            return None
+
+        with self._lock:
+            self._compress_time += time.time() - start
+            self._compressed_bytes += st.st_size
+        return fp
+
+    def stats(self):
+        """ return the usage and effect of the cache """
+        with self._lock:
+            requests = self.hits + self.misses
+            saved = 0.0
+            if self._compressed_bytes:
+                saved = (self._compress_time * self._hit_bytes /
+                         self._compressed_bytes)
+            return {'entries': len(self._entries),
+                    'size': self._size,
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': float(self.hits) / requests if requests else 0.0,
+                    'compress_seconds': self._compress_time,
+                    'saved_seconds': saved}
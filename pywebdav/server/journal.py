@@ -0,0 +1,277 @@
+"""
+Journal of the changes made through the server
+
+Sync clients (RFC 6578) ask for the members of a collection which
+changed since their last sync token. The ChangeJournal records the
+paths the FilesystemHandler writes or removes, each under a sequence
+number; a sync token names the journal and the number it was issued at.
+
+Only the latest change of a path is kept. Beyond max_entries paths the
+oldest changes are dropped, tokens issued before them are refused and
+the clients sync from scratch.
+
+Without a file the journal lives in memory and its tokens are valid as
+long as the process runs. With a file it survives restarts and is
+shared by the pre-forked workers: changes are appended to it, every
+process reads what the others appended before using the journal, and
+it is rewritten with the kept changes only once it grew to twice their
+number.
+
+"""
+
+from __future__ import absolute_import
+import os
+import uuid
+import threading
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from six.moves import urllib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+# default number of paths remembered, see [DAV] sync_journal_size
+MAX_ENTRIES = 100000
+
+TOKEN_PREFIX = 'http://pywebdav/ns/sync/'
+
+_HEADER = 'pywebdav-journal'
+
+# the file is not rewritten while it holds fewer records
+_COMPACT_MIN = 1024
+
+
+class InvalidToken(ValueError):
+    """ the sync token was not issued by this journal or is too old """
+
+
+class ChangeJournal:
+    """ the latest change of the paths changed through the server """
+
+    def __init__(self, max_entries=MAX_ENTRIES, path=None):
+        self.max_entries = max_entries
+        self.path = path
+
+        self._changes = OrderedDict()
+        self._seq = 0
+        self._floor = 0
+        self._epoch = uuid.uuid4().hex[:16]
+        self._lock = threading.Lock()
+
+        self._fd = None
+        self._lock_fd = None
+        self._offset = 0
+        self._records = 0
+        if path is not None:
+            self._open()
+            if hasattr(os, 'register_at_fork'):
+                # the workers must not share the file offset and lock
+                os.register_at_fork(after_in_child=self._reopen)
+
+    ###
+    ### the journal file
+    ###
+
+    def _open(self):
+        self._lock_fd = os.open(self.path + '.lock',
+                                os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        with self._file_lock():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT |
+                               os.O_APPEND | os.O_CLOEXEC, 0o644)
+            if os.fstat(self._fd).st_size == 0:
+                os.write(self._fd, self._header().encode('utf-8'))
+            self._load()
+
+    def _reopen(self):
+        os.close(self._fd)
+        os.close(self._lock_fd)
+        self._lock = threading.Lock()
+        self._open()
+
+    @contextmanager
+    def _file_lock(self, shared=False):
+        """ exclude the other processes using the file """
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(self._lock_fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _header(self):
+        return '%s %s %d\n' % (_HEADER, self._epoch, self._floor)
+
+    def _load(self):
+        """ read the journal file from its start """
+        self._changes.clear()
+        self._offset = self._records = 0
+        lines = self._read_lines()
+        fields = lines and lines[0].split(' ')
+        if not fields or len(fields) != 3 or fields[0] != _HEADER:
+            raise ValueError('%s is not a change journal' % self.path)
+
+        self._epoch = fields[1]
+        self._seq = self._floor = int(fields[2])
+        self._apply_lines(lines[1:])
+
+    def _catch_up(self):
+        """ apply what other processes appended or rewrote """
+        if os.stat(self.path).st_ino != os.fstat(self._fd).st_ino:
+            # compacted by another process
+            os.close(self._fd)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_APPEND |
+                               os.O_CLOEXEC)
+            self._load()
+        else:
+            self._apply_lines(self._read_lines())
+
+    def _read_lines(self):
+        """ return the complete lines after the last one read """
+        blocks = []
+        offset = self._offset
+        while True:
+            block = os.pread(self._fd, 64 * 1024, offset)
+            if not block:
+                break
+            blocks.append(block)
+            offset += len(block)
+        data = b''.join(blocks)
+
+        # a line is appended with a single write, which may be under way
+        end = data.rfind(b'\n') + 1
+        self._offset += end
+        return data[:end].decode('utf-8').splitlines()
+
+    def _apply_lines(self, lines):
+        for line in lines:
+            seq, kind, path = line.split(' ')
+            self._records += 1
+            if int(seq) > self._seq:
+                self._apply(int(seq), urllib.parse.unquote(
+                    path, errors='surrogateescape'), kind == 'D')
+
+    def _compact(self):
+        """ rewrite the file with the kept changes only """
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                     os.O_CLOEXEC, 0o644)
+        try:
+            lines = [self._header()]
+            for path, (seq, deleted) in self._changes.items():
+                lines.append(self._line(seq, path, deleted))
+            data = ''.join(lines).encode('utf-8')
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, self.path)
+
+        os.close(self._fd)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CLOEXEC)
+        self._offset = len(data)
+        self._records = len(self._changes)
+        log.info('Compacted the change journal to %d records' % self._records)
+
+    @staticmethod
+    def _line(seq, path, deleted):
+        path = urllib.parse.quote(path, errors='surrogateescape')
+        return '%d %s %s\n' % (seq, 'D' if deleted else 'C', path)
+
+    ###
+    ### recording and asking for changes
+    ###
+
+    def _apply(self, seq, path, deleted):
+        self._seq = seq
+        self._changes.pop(path, None)
+        self._changes[path] = (seq, deleted)
+        while len(self._changes) > self.max_entries:
+            path, (self._floor, deleted) = self._changes.popitem(last=False)
+
+    def record(self, path, deleted=False):
+        """ remember that path changed or, if deleted, went away """
+        with self._lock:
+            if self._fd is None:
+                self._apply(self._seq + 1, path, deleted)
+                return
+
+            with self._file_lock():
+                self._catch_up()
+                seq = self._seq + 1
+                line = self._line(seq, path, deleted).encode('utf-8')
+                os.write(self._fd, line)
+                self._offset += len(line)
+                self._records += 1
+                self._apply(seq, path, deleted)
+                if self._records > max(2 * len(self._changes), _COMPACT_MIN):
+                    self._compact()
+
+    def token(self):
+        """ return the sync token of the current state """
+        with self._lock:
+            if self._fd is not None:
+                with self._file_lock(shared=True):
+                    self._catch_up()
+            return self._token(self._seq)
+
+    def _token(self, seq):
+        return '%s%s-%d' % (TOKEN_PREFIX, self._epoch, seq)
+
+    def _parse_token(self, token):
+        if not token.startswith(TOKEN_PREFIX):
+            raise InvalidToken(token)
+        epoch, sep, seq = token[len(TOKEN_PREFIX):].rpartition('-')
+        if epoch != self._epoch or not seq.isdigit():
+            raise InvalidToken(token)
+        seq = int(seq)
+        if seq < self._floor or seq > self._seq:
+            raise InvalidToken(token)
+        return seq
+
+    def changes(self, token, directory, infinite=False, limit=None):
+        """ return the changes below directory since token
+
+        Returns the new token, the list of (path, deleted) pairs in the
+        order they happened and whether the list was truncated: the
+        paths in directory or, if infinite is set, anywhere below it. At
+        most limit changes are returned, the token then continues after
+        the last one. Raises InvalidToken.
+        """
+        with self._lock:
+            if self._fd is not None:
+                with self._file_lock(shared=True):
+                    self._catch_up()
+
+            since = self._parse_token(token)
+            prefix = directory.rstrip(os.sep) + os.sep
+            found = []
+            for path in reversed(self._changes):
+                seq, deleted = self._changes[path]
+                if seq <= since:
+                    break
+                if path.startswith(prefix) and \
+                        (infinite or os.sep not in path[len(prefix):]):
+                    found.append((seq, path, deleted))
+            found.reverse()
+
+            last = self._seq
+            truncated = limit is not None and len(found) > limit
+            if truncated:
+                found = found[:limit]
+                last = found[-1][0]
+            return (self._token(last),
+                    [(path, deleted) for seq, path, deleted in found],
+                    truncated)
+
+    def close(self):
+        for fd in self._fd, self._lock_fd:
+            if fd is not None:
+                os.close(fd)
+        self._fd = self._lock_fd = None
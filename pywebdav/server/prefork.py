@@ -0,0 +1,196 @@
+"""
+Pre-fork multi-process mode
+
+The supervisor forks a number of worker processes, each running its own
+server engine with its own listening socket bound to the same address.
+The sockets are opened with SO_REUSEPORT so that the kernel balances the
+new connections between the workers and no process is limited by the
+interpreter lock of another one.
+
+A worker that dies is restarted. A worker that served a configured
+number of requests tells the supervisor, which starts a fresh worker
+right away, then it stops accepting, finishes its running requests and
+exits.
+
+Stopping the supervisor with SIGTERM or SIGINT (this is what
+daemonize.startstop sends on stop) terminates the workers gracefully.
+
+"""
+
+from __future__ import absolute_import
+import os
+import sys
+import time
+import signal
+import socket
+import struct
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def supported():
+    """ return True if pre-forked workers can share a port here """
+    return hasattr(os, 'fork') and hasattr(socket, 'SO_REUSEPORT')
+
+
+class Supervisor:
+    """ start, watch and restart worker processes
+
+    target is called in every forked worker and returns when the worker
+    should exit; an exception makes the worker exit with status 1. A
+    worker announces with retire() that it is about to exit, its
+    successor is started right away. Any other worker which exits is
+    restarted.
+
+    """
+
+    # seconds to wait before restarting a worker which failed
+    restart_delay = 1.0
+
+    # signals handled by the supervisor
+    signals = (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1)
+
+    def __init__(self, processes, target):
+        self.processes = processes
+        self.target = target
+        self.children = {}
+        self._retiring = set()
+        self._started = 0
+        self._running = False
+        self._notify_r, self._notify_w = os.pipe()
+        os.set_blocking(self._notify_r, False)
+
+    def spawn(self):
+        """ fork a new worker """
+        self._started += 1
+        number = self._started
+
+        # the child must not run the handlers of the supervisor
+        mask = signal.pthread_sigmask(signal.SIG_BLOCK, self.signals)
+        try:
+            pid = os.fork()
+            if pid == 0:
+                self._run_worker(mask)
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+
+        log.info('Started worker %d (pid %d)' % (number, pid))
+        self.children[pid] = number
+        return pid
+
+    def _run_worker(self, mask):
+        status = 1
+        try:
+            os.close(self._notify_r)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+            self.target()
+            status = 0
+        except KeyboardInterrupt:
+            status = 0
+        except Exception:
+            log.exception('Worker %d failed' % os.getpid())
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def retire(self):
+        """ called in a worker: it will exit soon, start its successor
+
+        Signals do not queue, the pid goes through a pipe so that no
+        retirement is lost when several workers retire at once.
+        """
+        os.write(self._notify_w, struct.pack('i', os.getpid()))
+        os.kill(os.getppid(), signal.SIGUSR1)
+
+    def _replace(self, signum=None, frame=None):
+        """ start the successors of the workers which retired """
+        while True:
+            try:
+                data = os.read(self._notify_r, 4096)
+            except BlockingIOError:
+                break
+            for (pid, ) in struct.iter_unpack('i', data):
+                if pid in self.children and pid not in self._retiring:
+                    self._retiring.add(pid)
+                    if self._running:
+                        self.spawn()
+
+    def stop(self, signum=None, frame=None):
+        """ terminate the workers, run() returns once they are gone """
+        self._running = False
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self):
+        """ start the workers and restart them until stop() is called """
+        self._running = True
+        handlers = [(sig, signal.signal(sig, self.stop))
+                    for sig in (signal.SIGTERM, signal.SIGINT)]
+        handlers.append((signal.SIGUSR1,
+                         signal.signal(signal.SIGUSR1, self._replace)))
+        try:
+            for i in range(self.processes):
+                self.spawn()
+
+            while self.children:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+
+                number = self.children.pop(pid, None)
+                retired = pid in self._retiring
+                self._retiring.discard(pid)
+                if number is None or not self._running:
+                    continue
+
+                if retired:
+                    log.info('Worker %d (pid %d) recycled' % (number, pid))
+                    continue
+
+                log.warning('Worker %d (pid %d) exited with status %d, '
+                            'restarting' % (number, pid, status))
+                if status:
+                    time.sleep(self.restart_delay)
+                if self._running:
+                    self.spawn()
+        finally:
+            for sig, handler in handlers:
+                signal.signal(sig, handler)
+            os.close(self._notify_r)
+            os.close(self._notify_w)
+
+
+def serve(server, server_address, handler, processes, max_requests=0):
+    """ serve with processes pre-forked workers of the server engine
+
+    Each worker serves at most max_requests requests (0 = unlimited)
+    before it is replaced by a new one.
+    """
+
+    def worker():
+        runner = server(server_address, handler, reuse_port=True)
+        runner.max_requests = max_requests
+        runner.on_recycle = supervisor.retire
+
+        def terminate(signum, frame):
+            # shutdown() waits for serve_forever, which runs in this thread
+            threading.Thread(target=runner.shutdown).start()
+
+        signal.signal(signal.SIGTERM, terminate)
+        try:
+            runner.serve_forever()
+        finally:
+            runner.server_close()
+
+    supervisor = Supervisor(processes, worker)
+    supervisor.run()
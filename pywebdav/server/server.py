@@ -10,6 +10,11 @@ This is an example implementation of a DAVserver using the DAV package.
 from __future__ import absolute_import
 from __future__ import print_function
 import getopt, sys, os
+import socket
+import queue
+import selectors
+import threading
+import time
 import logging
 
 logging.basicConfig(level=logging.WARNING)
@@ -29,8 +34,16 @@ from pywebdav.server.fileauth import DAVAuthHandler
 from pywebdav.server.mysqlauth import MySQLAuthHandler
 from pywebdav.server.fshandler import FilesystemHandler
 from pywebdav.server.daemonize import startstop
+from pywebdav.server.asyncserver import AsyncHTTPServer, WORKERS
+from pywebdav.server import prefork
+from pywebdav.server.gzipcache import GzipCache, MAX_SIZE as GZIP_CACHE_SIZE
+from pywebdav.server.statcache import StatCache, TTL as STAT_CACHE_TTL
+from pywebdav.server.journal import ChangeJournal
+from pywebdav.server.ctags import CTagStore
 
 from pywebdav.lib.INI_Parse import Configuration
+from pywebdav.lib.throttle import BandwidthLimiter
+from pywebdav.lib.compression import GZIP_LEVEL
 from pywebdav import __version__, __author__
 
 LEVELS = {'debug': logging.DEBUG,
@@ -39,8 +52,306 @@ LEVELS = {'debug': logging.DEBUG,
           'error': logging.ERROR,
           'critical': logging.CRITICAL}
 
+# default length of the worker pool queue, see [DAV] queue_size
+QUEUE_SIZE = 64
+
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    """Handle requests in a separate thread."""
+    """Handle requests in a separate thread.
+
+    Persistent connections waiting for their next request are
+    registered by the request handler as idle. A reaper thread
+    closes them once their keep-alive timeout expired so that idle
+    clients do not hold a thread forever. When the server stops, the
+    idle connections are closed right away, only new connections still
+    get their timeout to send a first request.
+
+    """
+
+    # seconds between two runs of the idle connection reaper
+    reap_interval = 1.0
+
+    # seconds between two reports of stats() in the log, 0 means never;
+    # read from the stats_interval option of the [DAV] section
+    stats_interval = 0
+
+    # requests served before serve_forever() returns, 0 means unlimited
+    max_requests = 0
+
+    # called without arguments once max_requests is reached
+    on_recycle = None
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 bind_and_activate=True, reuse_port=False):
+        self._idle_connections = {}
+        self._idle_lock = threading.Lock()
+        self._reaper_stop = threading.Event()
+        self.requests_served = 0
+        self.draining = False
+        self.allow_reuse_port = reuse_port
+        config = getattr(RequestHandlerClass, '_config', None)
+        if config is not None:
+            self.stats_interval = float(config.DAV.get('stats_interval', 0)
+                                        or 0)
+        self._next_report = None
+        HTTPServer.__init__(self, server_address, RequestHandlerClass,
+                            bind_and_activate)
+
+    def server_bind(self):
+        if self.allow_reuse_port:
+            # lets pre-forked workers listen on the same port
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        HTTPServer.server_bind(self)
+
+    def connection_idle(self, connection, timeout, first=False):
+        """ connection waits for a new request for at most timeout seconds
+
+        first tells that the connection did not send a request yet.
+        """
+        with self._idle_lock:
+            self._idle_connections[connection] = (time.time() + timeout,
+                                                  first)
+
+        if self.draining and not first:
+            # server is shutting down, do not wait for another request
+            self.reap_idle_connections(now=float('inf'), first=False)
+
+    def connection_busy(self, connection):
+        """ connection is serving a request """
+        with self._idle_lock:
+            self._idle_connections.pop(connection, None)
+            self.requests_served += 1
+            recycle = self.requests_served == self.max_requests
+
+        if recycle:
+            self.draining = True
+            log.info('Served %d requests, shutting down' % self.max_requests)
+            if self.on_recycle is not None:
+                self.on_recycle()
+            # shutdown() blocks until serve_forever() returned
+            threading.Thread(target=self.shutdown).start()
+
+    def shutdown_request(self, request):
+        with self._idle_lock:
+            self._idle_connections.pop(request, None)
+        HTTPServer.shutdown_request(self, request)
+
+    def reap_idle_connections(self, now=None, first=True):
+        """ close the idle connections whose timeout expired
+
+        Connections waiting for their first request are left alone
+        unless first is True. Returns the number of reaped connections.
+        """
+        if now is None:
+            now = time.time()
+
+        with self._idle_lock:
+            expired = [c for c, (deadline, waiting_first)
+                       in self._idle_connections.items()
+                       if deadline <= now and (first or not waiting_first)]
+            for connection in expired:
+                del self._idle_connections[connection]
+
+        for connection in expired:
+            try:
+                # wakes up the handler thread blocked in reading
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+        if expired:
+            log.debug('Reaped %d idle connections' % len(expired))
+        return len(expired)
+
+    def stats(self):
+        """ return the requests served, the connections waiting and the
+        stats of the lock table and of the caches """
+        with self._idle_lock:
+            stats = {'requests': self.requests_served,
+                     'idle_connections': len(self._idle_connections)}
+        lock_table = getattr(self.RequestHandlerClass, 'lock_table', None)
+        if lock_table is not None:
+            stats['locks'] = lock_table.stats()
+        dc = getattr(self.RequestHandlerClass, 'IFACE_CLASS', None)
+        for name in 'stat_cache', 'gzip_cache':
+            cache = getattr(dc, name, None)
+            if cache is not None:
+                stats[name] = cache.stats()
+        return stats
+
+    def report_stats(self, now=None):
+        """ log stats() once every stats_interval seconds """
+        if not self.stats_interval:
+            return
+        if now is None:
+            now = time.monotonic()
+        if self._next_report is None:
+            self._next_report = now + self.stats_interval
+        elif now >= self._next_report:
+            self._next_report = now + self.stats_interval
+            log.info('Server stats: %s' % self.stats())
+
+    def expire_locks(self):
+        """ remove the expired locks from the lock table """
+        lock_table = getattr(self.RequestHandlerClass, 'lock_table', None)
+        if lock_table is not None:
+            lock_table.expire()
+
+    def _reap_forever(self):
+        while not self._reaper_stop.wait(self.reap_interval):
+            self.reap_idle_connections()
+            self.expire_locks()
+            self.report_stats()
+
+        # the server stopped, new connections still get their timeout
+        while self._idle_connections:
+            time.sleep(self.reap_interval)
+            self.reap_idle_connections()
+
+    def serve_forever(self, poll_interval=0.5):
+        self.draining = False
+        self._reaper_stop.clear()
+        reaper = threading.Thread(target=self._reap_forever,
+                                  name='pywebdav-reaper')
+        reaper.daemon = True
+        reaper.start()
+        try:
+            HTTPServer.serve_forever(self, poll_interval)
+            if self.allow_reuse_port:
+                # the kernel queues connections for this socket until it
+                # is closed, serve them rather than having them reset
+                self._serve_backlog()
+        finally:
+            self.draining = True
+            self._reaper_stop.set()
+            self.reap_idle_connections(now=float('inf'), first=False)
+
+    def _serve_backlog(self):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self, selectors.EVENT_READ)
+            while selector.select(0):
+                self._handle_request_noblock()
+
+class PooledHTTPServer(ThreadedHTTPServer):
+    """Handle requests in a fixed pool of worker threads.
+
+    Accepted connections wait in a bounded queue for a free worker.
+    When the queue is full the connection is answered with a
+    503 Service Unavailable and a Retry-After header right away. While
+    the pool is saturated the handlers close persistent connections
+    after the current response to make room for the waiting ones.
+
+    The pool size and the queue length are read from the workers and
+    queue_size options of the [DAV] section.
+
+    """
+
+    # seconds a rejected client is asked to wait before retrying
+    retry_after = 1
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 bind_and_activate=True, reuse_port=False):
+        workers, queue_size = WORKERS, QUEUE_SIZE
+        config = getattr(RequestHandlerClass, '_config', None)
+        if config is not None:
+            workers = int(config.DAV.get('workers', workers) or workers)
+            queue_size = int(config.DAV.get('queue_size', queue_size) or
+                             queue_size)
+
+        self.workers = workers
+        self._queue = queue.Queue(queue_size)
+        self._busy = 0
+        self._rejected = 0
+        self._stats_lock = threading.Lock()
+        ThreadedHTTPServer.__init__(self, server_address,
+                                    RequestHandlerClass, bind_and_activate,
+                                    reuse_port)
+
+    @property
+    def saturated(self):
+        """ all workers are busy and connections are waiting """
+        return self._busy >= self.workers and not self._queue.empty()
+
+    def stats(self):
+        """ return the current load of the pool """
+        stats = ThreadedHTTPServer.stats(self)
+        with self._stats_lock:
+            busy, rejected = self._busy, self._rejected
+        stats.update({'workers': self.workers,
+                      'busy': busy,
+                      'saturation': float(busy) / self.workers,
+                      'queued': self._queue.qsize(),
+                      'queue_size': self._queue.maxsize,
+                      'rejected': rejected})
+        return stats
+
+    def process_request(self, request, client_address):
+        try:
+            self._queue.put_nowait((request, client_address))
+        except queue.Full:
+            self._reject(request, client_address)
+
+    def _reject(self, request, client_address):
+        """ answer 503 on the accepting thread, without waiting """
+        with self._stats_lock:
+            self._rejected += 1
+            busy, rejected = self._busy, self._rejected
+        log.warning('Worker queue full, rejecting connection from %s '
+                    '(busy %d, queued %d, rejected %d)' % (
+                        client_address[0], busy, self._queue.qsize(),
+                        rejected))
+        try:
+            # the answer fits in the empty send buffer of a new
+            # connection, a client which does not read loses it
+            request.setblocking(False)
+            request.send(('HTTP/1.1 503 Service Unavailable\r\n'
+                          'Retry-After: %d\r\n'
+                          'Content-Length: 0\r\n'
+                          'Connection: close\r\n\r\n' %
+                          self.retry_after).encode())
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            request, client_address = item
+            with self._stats_lock:
+                self._busy += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                with self._stats_lock:
+                    self._busy -= 1
+                self.shutdown_request(request)
+
+    def serve_forever(self, poll_interval=0.5):
+        workers = self._workers = [
+            threading.Thread(target=self._work, name='pywebdav-worker-%d' % i)
+            for i in range(self.workers)]
+        for worker in workers:
+            worker.start()
+        try:
+            ThreadedHTTPServer.serve_forever(self, poll_interval)
+        finally:
+            # serve the connections already queued, then stop
+            for worker in workers:
+                self._queue.put(None)
+
+    def server_close(self):
+        ThreadedHTTPServer.server_close(self)
+        for worker in getattr(self, '_workers', ()):
+            worker.join()
+
+# server engines selectable with --engine
+ENGINES = {'threaded': ThreadedHTTPServer,
+           'pool': PooledHTTPServer,
+           'asyncio': AsyncHTTPServer}
 
 def runserver(
         port = 8008, host='localhost',
@@ -51,7 +362,9 @@ def runserver(
         password = '',
         handler = DAVAuthHandler,
         server = ThreadedHTTPServer,
-        doserve=True
+        doserve=True,
+        processes = 1,
+        max_requests = 0
     ):
 
     directory = directory.strip()
@@ -87,6 +400,11 @@ def runserver(
 
     if handler._config.DAV.getboolean('lockemulation') is False:
         log.info('Deactivated LOCK, UNLOCK (WebDAV level 2) support')
+    elif processes > 1:
+        log.warning('Each process has its own lock table: a lock taken '
+                    'through one process is not seen by the others, '
+                    'deactivate locking (-J) when serving with several '
+                    'processes')
 
     handler.IFACE_CLASS.mimecheck = True
     if handler._config.DAV.getboolean('mimecheck') is False:
@@ -97,6 +415,70 @@ def runserver(
         log.info('Using %s as base url for PROPFIND requests' % handler._config.DAV.baseurl)
     handler.IFACE_CLASS.baseurl = handler._config.DAV.baseurl
 
+    dv = handler._config.DAV
+    limiter = BandwidthLimiter(dv.get('bandwidth_limit', 0),
+                               dv.get('bandwidth_limit_per_user', 0),
+                               dv.get('bandwidth_limit_per_connection', 0))
+    if limiter:
+        log.info('Limiting bandwidth to %s/%s/%s bytes per second '
+                 '(global/user/connection)' % (limiter.rate,
+                 limiter.user_rate, limiter.connection_rate))
+        handler.bandwidth_limiter = limiter
+    else:
+        handler.bandwidth_limiter = None
+
+    etag_mode = dv.get('etag_mode', 'stat').lower()
+    if etag_mode not in ('stat', 'hash'):
+        log.error('Unknown etag_mode %s, using stat' % etag_mode)
+        etag_mode = 'stat'
+    handler.IFACE_CLASS.etag_mode = etag_mode
+
+    stat_cache_size = int(dv.get('stat_cache_size', 0))
+    if stat_cache_size > 0:
+        handler.IFACE_CLASS.stat_cache = StatCache(
+            stat_cache_size,
+            float(dv.get('stat_cache_ttl', STAT_CACHE_TTL)),
+            dv.getboolean('stat_cache_inotify', True))
+        log.info('Caching the metadata of %d files' % stat_cache_size)
+
+    sync_journal_size = int(dv.get('sync_journal_size', 0))
+    if sync_journal_size > 0:
+        sync_journal_file = dv.get('sync_journal_file', '') or None
+        if processes > 1 and sync_journal_file is None:
+            log.warning('Each process has its own change journal, set '
+                        'sync_journal_file to share one')
+        handler.IFACE_CLASS.journal = ChangeJournal(sync_journal_size,
+                                                    sync_journal_file)
+        log.info('Recording changes for sync clients (%d paths)' %
+                 sync_journal_size)
+
+    if dv.getboolean('ctags', False):
+        ctag_file = dv.get('ctag_file', '') or None
+        if processes > 1 and ctag_file is None:
+            log.warning('Each process has its own change tags, set '
+                        'ctag_file to share them')
+        handler.IFACE_CLASS.ctags = CTagStore(directory, ctag_file)
+        log.info('Maintaining the change tags of the collections')
+
+    handler.IFACE_CLASS.gzip_static = dv.getboolean('gzip_static')
+    if dv.get('gzip_cache_dir', ''):
+        handler.IFACE_CLASS.gzip_cache = GzipCache(
+            dv.get('gzip_cache_dir', ''),
+            int(dv.get('gzip_cache_size', GZIP_CACHE_SIZE)),
+            int(dv.get('gzip_level', GZIP_LEVEL)) or GZIP_LEVEL)
+        log.info('Caching gzip compressed files in %s' %
+                 handler.IFACE_CLASS.gzip_cache.directory)
+
+    if processes > 1 and doserve:
+        if prefork.supported():
+            print(('Listening on %s (%i) with %i processes' %
+                   (host, port, processes)))
+            prefork.serve(server, (host, port), handler, processes,
+                          max_requests)
+            return
+        log.error('Pre-forked processes are not supported on this '
+                  'platform, serving from a single process')
+
     runner = server((host, port), handler)
     if doserve:
         # initialize server on specified port
@@ -142,6 +524,21 @@ Parameters:
     -M, --nomime    Deactivate mimetype sniffing. Sniffing is based on magic numbers
                     detection but can be slow under heavy load. If you are experiencing
                     speed problems try to use this parameter.
+    -E, --engine    Server engine: threaded (default) starts a thread per
+                    connection, pool serves the connections from a fixed
+                    pool of worker threads, asyncio serves the connections
+                    from an event loop and runs requests in a pool of
+                    worker threads.
+    -w, --workers   Number of worker threads of the pool and asyncio
+                    engines (default: 32). Passing it selects the pool
+                    engine instead of the threaded one.
+    -F, --processes Number of pre-forked server processes sharing the port
+                    (default: 1). Dead processes are restarted. The locks
+                    are not shared between the processes, a resource
+                    locked through one can still be locked and changed
+                    through another: use -J with more than one process.
+    --max-requests  Number of requests a process serves before it is
+                    replaced by a fresh one (default: 0 = unlimited).
     -T, --noiter    Deactivate iterator. Use this if you encounter file corruption during 
                     download. Also disables chunked body response.
     -i, --icounter  If you want to run multiple instances then you have to
@@ -170,8 +567,13 @@ def setupDummyConfig(**kw):
         def __init__(self, **kw):
             self.__dict__.update(**kw)
 
-        def getboolean(self, name):
-            return (str(getattr(self, name, 0)) in ('1', "yes", "true", "on", "True"))
+        def getboolean(self, name, default=False):
+            if not hasattr(self, name):
+                return default
+            return (str(getattr(self, name)) in ('1', "yes", "true", "on", "True"))
+
+        def get(self, name, default):
+            return getattr(self, name, default)
 
     class DummyConfig:
         DAV = DummyConfigDAV(**kw)
@@ -197,14 +599,19 @@ def run():
     mimecheck = True
     loglevel = 'warning'
     baseurl = ''
+    engine = 'threaded'
+    workers = 0
+    processes = 1
+    max_requests = 0
 
     # parse commandline
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'P:D:H:d:u:p:nvhmJi:c:Ml:TB:',
+        opts, args = getopt.getopt(sys.argv[1:], 'P:D:H:d:u:p:nvhmJi:c:Ml:TB:E:w:F:',
                 ['host=', 'port=', 'directory=', 'user=', 'password=',
                  'daemon=', 'noauth', 'help', 'verbose', 'mysql', 
                  'icounter=', 'config=', 'nolock', 'nomime', 'loglevel', 'noiter',
-                 'baseurl='])
+                 'baseurl=', 'engine=', 'workers=', 'processes=',
+                 'max-requests='])
     except getopt.GetoptError as e:
         print(usage)
         print('>>>> ERROR: %s' % str(e))
@@ -265,6 +672,18 @@ def run():
         if o in ['-B', '--baseurl']:
             baseurl = a.lower()
 
+        if o in ['-E', '--engine']:
+            engine = a.lower()
+
+        if o in ['-w', '--workers']:
+            workers = int(str(a).strip())
+
+        if o in ['-F', '--processes']:
+            processes = int(str(a).strip())
+
+        if o == '--max-requests':
+            max_requests = int(str(a).strip())
+
     # This feature are disabled because they are unstable
     http_request_use_iterator = 0
 
@@ -288,6 +707,14 @@ def run():
         counter = int(dv.counter)
         lockemulation = dv.lockemulation
         mimecheck = dv.mimecheck
+        engine = dv.get('engine', engine).lower()
+        processes = int(dv.get('processes', processes))
+        max_requests = int(dv.get('max_requests', max_requests))
+
+        if 'workers' in dv:
+            workers = int(dv.workers)
+        elif workers:
+            dv.set('workers', workers)
 
         if 'chunked_http_response' not in dv:
             dv.set('chunked_http_response', chunked_http_response)
@@ -315,7 +742,9 @@ def run():
                 'chunked_http_response': chunked_http_response,
                 'http_request_use_iterator': http_request_use_iterator,
                 'http_response_use_iterator': http_response_use_iterator,
-                'baseurl' : baseurl
+                'baseurl' : baseurl,
+                'engine' : engine,
+                'workers' : workers
                 }
 
         conf = setupDummyConfig(**_dc)
@@ -329,6 +758,13 @@ def run():
     for handler in logging.getLogger().handlers:
         handler.setFormatter(formatter)
 
+    if workers and engine == 'threaded':
+        engine = 'pool'
+
+    if engine not in ENGINES:
+        log.error('Unknown server engine %s!' % engine)
+        sys.exit(3)
+
     if mysql == True and configfile == '':
         log.error('You can only use MySQL with configuration file!')
         sys.exit(3)
@@ -378,7 +814,8 @@ def run():
     handler._config = conf
 
     runserver(port, host, directory, verbose, noauth, user, password, 
-              handler=handler)
+              handler=handler, server=ENGINES[engine],
+              processes=processes, max_requests=max_requests)
 
 if __name__ == '__main__':
     run()
@@ -0,0 +1,298 @@
+"""
+Cache of file metadata
+
+Answering a single request stats the same file several times and the
+same hot directories get listed by many clients. The StatCache keeps
+the os.stat results of recently used paths for a few seconds.
+
+Entries are dropped by the FilesystemHandler when it changes a file
+itself (PUT, DELETE, MKCOL and the COPY and MOVE primitives) and, on
+Linux, by inotify when another program changes a watched directory.
+Without inotify, or beyond the watch budget, changes made outside the
+server show up once the entries expired.
+
+"""
+
+from __future__ import absolute_import
+import os
+import stat
+import time
+import errno
+import struct
+import select
+import threading
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+# defaults, see the [DAV] stat_cache_* options
+MAX_ENTRIES = 65536
+TTL = 2.0
+
+# inotify through the C library, no extra module needed
+INOTIFY_AVAILABLE = False
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.inotify_init1
+    INOTIFY_AVAILABLE = True
+except (ImportError, OSError, AttributeError):
+    pass
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF | IN_ONLYDIR)
+
+# events which take a whole subtree away
+SUBTREE_EVENTS = IN_MOVED_FROM | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    """ watch directories and report the changed paths to a callback
+
+    callback(path, subtree) is called from a reader thread; path is
+    None if events were lost.
+    """
+
+    # watches beyond this budget are not added
+    max_watches = 8192
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.fd = _libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        self._paths = {}
+        self._watches = {}
+        self._lock = threading.Lock()
+        self._full = False
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._thread = threading.Thread(target=self._read_forever,
+                                        name='pywebdav-inotify')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def watch(self, directory):
+        """ start watching a directory, return False if that failed """
+        with self._lock:
+            if directory in self._watches:
+                return True
+            if len(self._watches) >= self.max_watches:
+                return False
+
+            wd = _libc.inotify_add_watch(
+                self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                e = ctypes.get_errno()
+                if e == errno.ENOSPC and not self._full:
+                    self._full = True
+                    log.warning('inotify watch limit reached, changes '
+                                'in more directories are seen on expiry')
+                return False
+
+            self._paths[wd] = directory
+            self._watches[directory] = wd
+            return True
+
+    def close(self):
+        os.write(self._wakeup_w, b'x')
+        self._thread.join()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+        os.close(self.fd)
+
+    def _read_forever(self):
+        while True:
+            ready, _, _ = select.select([self.fd, self._wakeup_r], [], [])
+            if self._wakeup_r in ready:
+                return
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            try:
+                self._dispatch(data)
+            except Exception:
+                log.exception('Could not handle inotify events')
+
+    def _dispatch(self, data):
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.callback(None, True)
+                continue
+
+            with self._lock:
+                directory = self._paths.get(wd)
+                if mask & IN_IGNORED and directory is not None:
+                    del self._paths[wd]
+                    if self._watches.get(directory) == wd:
+                        del self._watches[directory]
+            if directory is None:
+                continue
+
+            if name:
+                self.callback(os.path.join(directory, os.fsdecode(name)),
+                              bool(mask & SUBTREE_EVENTS))
+            # the directory itself changed its mtime or went away
+            self.callback(directory, bool(mask & SUBTREE_EVENTS) and
+                          not name)
+
+
+class StatCache:
+    """ os.stat results of recently used paths
+
+    At most max_entries entries are kept, the least recently used ones
+    are dropped first. An entry is used for ttl seconds.
+
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES, ttl=TTL, inotify=True):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidations = 0
+
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+        self._inotify = None
+        if inotify and INOTIFY_AVAILABLE:
+            self._start_inotify()
+            if hasattr(os, 'register_at_fork'):
+                # the reader thread does not survive a fork
+                os.register_at_fork(after_in_child=self._after_fork)
+
+    def _start_inotify(self):
+        try:
+            self._inotify = Inotify(self._changed)
+        except OSError as e:
+            log.warning('inotify not available (%s), changes made '
+                        'outside the server are seen on expiry' % e)
+
+    def _after_fork(self):
+        if self._inotify is not None:
+            os.close(self._inotify.fd)
+            self._inotify = None
+            self.clear()
+            self._start_inotify()
+
+    def stat(self, path):
+        """ return os.stat(path), from the cache if possible """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                st, expires = entry
+                if expires > now:
+                    self._entries.move_to_end(path)
+                    self.hits += 1
+                    return st
+                del self._entries[path]
+                self.expired += 1
+            self.misses += 1
+            generation = self._generation
+
+        # watch first, a change right after the stat must be seen
+        self._watch(os.path.dirname(path))
+        st = os.stat(path)
+        self.store(path, st, now, generation)
+        return st
+
+    def store(self, path, st, now=None, generation=None):
+        """ remember the stat result st of path
+
+        generation is the one seen before the stat was taken, nothing is
+        stored if an invalidation happened since.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        self._watch(os.path.dirname(path))
+        if stat.S_ISDIR(st.st_mode):
+            # its mtime changes with the entries
+            self._watch(path)
+
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[path] = (st, now + self.ttl)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _watch(self, directory):
+        if self._inotify is not None:
+            self._inotify.watch(directory)
+
+    def invalidate(self, path, subtree=False):
+        """ forget path, and everything below it if subtree is set """
+        with self._lock:
+            self.invalidations += 1
+            self._generation += 1
+            self._entries.pop(path, None)
+            if subtree:
+                prefix = path.rstrip(os.sep) + os.sep
+                for name in [name for name in self._entries
+                             if name.startswith(prefix)]:
+                    del self._entries[name]
+
+    def _changed(self, path, subtree):
+        if path is None:
+            log.info('inotify events lost, clearing the stat cache')
+            self.clear()
+        else:
+            self.invalidate(path, subtree)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def close(self):
+        """ stop watching for changes """
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def stats(self):
+        """ return the usage and effect of the cache """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._entries),
+                    'max_entries': self.max_entries,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'expired': self.expired,
+                    'invalidations': self.invalidations,
+                    'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                    'inotify': self._inotify is not None}
@@ -0,0 +1,83 @@
+"""Benchmark sequential small GETs against an in-process davserver.
+
+Usage: python test/bench_keepalive.py [--requests N] [--no-keepalive]
+                                     [--engine threaded|asyncio]
+
+The client reuses a single HTTPConnection, which transparently
+reconnects whenever the server closes the connection. Running with
+--no-keepalive therefore measures the cost of one TCP handshake per
+request.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+testdir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(testdir, '..'))
+
+from six.moves import http_client
+from pywebdav.server.server import runserver, setupDummyConfig, ENGINES
+from pywebdav.server.fileauth import DAVAuthHandler
+
+HOST = '127.0.0.1'
+PORT = 38029
+
+
+class QuietHandler(DAVAuthHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--no-keepalive', action='store_true')
+    parser.add_argument('--engine', choices=sorted(ENGINES),
+                        default='threaded')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp()
+    with open(os.path.join(root, 'small.txt'), 'wb') as f:
+        f.write(b'x' * 512)
+
+    handler = QuietHandler
+    handler._config = setupDummyConfig(
+        verbose=False, directory=root, port=PORT, host=HOST, noauth=True,
+        lockemulation=True, mimecheck=True, chunked_http_response=True,
+        http_request_use_iterator=False, http_response_use_iterator=True,
+        baseurl='', keepalive_timeout=0 if args.no_keepalive else 15,
+        keepalive_max_requests=0)
+    runner = runserver(PORT, HOST, root, noauth=True, handler=handler,
+                       server=ENGINES[args.engine], doserve=False)
+    thread = threading.Thread(target=runner.serve_forever)
+    thread.start()
+
+    try:
+        conn = http_client.HTTPConnection(HOST, PORT)
+        start = time.time()
+        for _ in range(args.requests):
+            conn.request('GET', '/small.txt')
+            resp = conn.getresponse()
+            resp.read()
+            assert resp.status == 200, resp.status
+        elapsed = time.time() - start
+        conn.close()
+    finally:
+        runner.shutdown()
+        runner.server_close()
+        thread.join()
+        shutil.rmtree(root, True)
+
+    print('%d GETs in %.3fs: %.1f requests/sec (%s engine, keep-alive %s)' % (
+        args.requests, elapsed, args.requests / elapsed, args.engine,
+        'off' if args.no_keepalive else 'on'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Benchmark the property method lookup of dav_interface.
+
+Usage: python test/bench_prop_dispatch.py [--number N]
+
+Compares the compiled dispatch table behind prop_method() with the
+getattr() lookup get_prop() did for each property before.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import timeit
+import argparse
+
+testdir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(testdir, '..'))
+
+from pywebdav.lib.iface import dav_interface
+
+
+def getattr_lookup(dc, ns, propname):
+    """ the lookup get_prop() used to do for each property """
+    prefix = dc.M_NS.get(ns)
+    if prefix is None:
+        return None
+    return getattr(dc, prefix + "_" + propname.replace('-', '_'), None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    dc = dav_interface()
+
+    def per_call(func, *lookup):
+        return min(timeit.repeat(lambda: func(dc, *lookup),
+                                 number=args.number,
+                                 repeat=5)) / args.number
+
+    for name, lookup in (('known', ('DAV:', 'displayname')),
+                         ('unknown', ('DAV:', 'unknown-prop')),
+                         ('unknown namespace', ('urn:y', 'displayname'))):
+        print('%-17s property lookup %5.0f ns, getattr %5.0f ns' % (
+            name, per_call(dav_interface.prop_method, *lookup) * 1e9,
+            per_call(getattr_lookup, *lookup) * 1e9))
+
+
+if __name__ == '__main__':
+    main()
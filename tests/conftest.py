@@ -4,7 +4,7 @@ import shutil
 import pytest
 import tempfile
 import threading
-from pywebdav.server.server import runserver, setupDummyConfig
+from pywebdav.server.server import runserver, setupDummyConfig, ENGINES
 from pywebdav.server.fileauth import DAVAuthHandler
 
 USER = 'test'
@@ -16,13 +16,13 @@ SERVERSCRIPT = os.path.join(os.path.dirname(__file__), '..', 'pywebdav', 'server
 
 class MyRunner(threading.Thread):
 
-    def __init__(self, serverroot):
+    def __init__(self, serverroot, port=PORT, engine='threaded', **config):
         super(MyRunner, self).__init__(name='pywebdav')
 
         _dc = {
             'verbose': True,
             'directory': serverroot,
-            'port': PORT,
+            'port': port,
             'host': HOST,
             'noauth': False,
             'user': USER,
@@ -35,11 +35,14 @@ class MyRunner(threading.Thread):
             'chunked_http_response': True,
             'http_request_use_iterator': True,
             'http_response_use_iterator': True,
-            'baseurl': ''
+            'baseurl': '',
+            'engine': engine
         }
+        _dc.update(config)
         handler = DAVAuthHandler
         handler._config = setupDummyConfig(**_dc)
-        self.runner = runserver(PORT, HOST, serverroot, doserve=False, handler=handler)
+        self.runner = runserver(port, HOST, serverroot, doserve=False, handler=handler,
+                                server=ENGINES[engine])
 
     def run(self):
         self.runner.serve_forever()
@@ -48,17 +51,17 @@ class MyRunner(threading.Thread):
         self.runner.shutdown()
 
 
-def pywebdav_server_runner():
+def pywebdav_server_runner(port=PORT, engine='threaded', **config):
     root = tempfile.mkdtemp()
     print('Created temporary root folder {}'.format(root))
 
     print('Starting webdav server')
-    sthread = MyRunner(root)
+    sthread = MyRunner(root, port, engine, **config)
     sthread.start()
     # Ensure davserver has time to startup
     time.sleep(1)
 
-    yield "http://{}:{}".format(HOST, PORT), USER, PASSWORD
+    yield "http://{}:{}".format(HOST, port), USER, PASSWORD
 
     print('Stopping davserver')
     sthread.stop()
@@ -72,3 +75,9 @@ def pywebdav_server_runner():
 def pywebdav_server():
     for x in pywebdav_server_runner():
         yield x
+
+
+@pytest.fixture(scope="module")
+def pywebdav_async_server():
+    for x in pywebdav_server_runner(PORT + 1, 'asyncio'):
+        yield x
@@ -0,0 +1,53 @@
+import base64
+import socket
+
+import requests
+
+from .conftest import pywebdav_server_runner, HOST, PORT
+
+
+def test_put_get(pywebdav_async_server):
+    url, user, password = pywebdav_async_server
+    content = b'0123456789' * 100000
+    with requests.Session() as session:
+        session.auth = (user, password)
+        ret = session.put(url + '/async.bin', data=content)
+        assert ret.status_code == 201
+
+        ret = session.get(url + '/async.bin',
+                          headers={'Accept-Encoding': 'identity'})
+        assert ret.status_code == 200
+        assert ret.content == content
+
+        ret = session.request('PROPFIND', url + '/', headers={'Depth': '1'})
+        assert ret.status_code == 207
+        assert b'async.bin' in ret.content
+
+
+def test_unauthorized(pywebdav_async_server):
+    url, user, password = pywebdav_async_server
+    ret = requests.get(url + '/')
+    assert ret.status_code == 401
+
+
+def test_keepalive_disabled():
+    for url, user, password in pywebdav_server_runner(
+            PORT + 9, 'asyncio', keepalive_timeout=0):
+        auth = base64.b64encode(('%s:%s' % (user, password)).encode())
+        request = (b'GET / HTTP/1.1\r\nHost: localhost\r\n'
+                   b'Authorization: Basic ' + auth + b'\r\n\r\n')
+        sock = socket.create_connection((HOST, PORT + 9))
+        try:
+            sock.settimeout(5)
+            sock.sendall(request)
+            response = b''
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                response += data
+        finally:
+            sock.close()
+        # closed by the server after the first response
+        assert response.startswith(b'HTTP/1.1 200')
+        assert b'Connection: close' in response
@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from pywebdav.lib.errors import DAV_Error, DAV_NotFound
+from pywebdav.lib.iface import dav_interface, CS_NS
+from pywebdav.server.ctags import CTagStore
+from pywebdav.server.fshandler import FilesystemHandler
+
+
+def test_get_props():
+    directory = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(directory, 'col'))
+        for name in 'col/page.html', 'col/noext':
+            with open(os.path.join(directory, name), 'wb') as fp:
+                fp.write(b'content')
+
+        dc = FilesystemHandler(directory, 'http://localhost/')
+        dc.mimecheck = True
+        ns_props = dict(dc.get_propnames(b'/'))
+        ns_props['urn:x'] = ['unknown']
+
+        for uri in b'/col', b'/col/page.html', b'/col/noext', b'/missing':
+            batch = dc.get_props(uri, ns_props)
+            single = dav_interface.get_props(dc, uri, ns_props)
+            for ns, plist in ns_props.items():
+                for prop in plist:
+                    value, expected = batch[ns][prop], single[ns][prop]
+                    if isinstance(expected, DAV_Error):
+                        assert type(value) is type(expected)
+                        assert value.args[0] == expected.args[0]
+                    elif hasattr(expected, 'toxml'):
+                        assert value.toxml() == expected.toxml()
+                    else:
+                        assert value == expected, (uri, prop)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_get_child_entries():
+    directory = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(directory, 'col'))
+        with open(os.path.join(directory, 'file.txt'), 'wb') as fp:
+            fp.write(b'content')
+        os.symlink('missing', os.path.join(directory, 'dangling'))
+
+        dc = FilesystemHandler(directory, 'http://localhost/')
+        entries = dict(dc.get_child_entries(b'/'))
+        assert sorted(entries) == sorted(dc.local2uri(os.path.join(
+            directory, name)) for name in os.listdir(directory))
+        assert sorted(entries) == sorted(dc.get_childs(b'/'))
+
+        st = entries[b'http://localhost/file.txt']
+        assert st.st_size == 7
+        assert st.st_ino == os.stat(os.path.join(directory, 'file.txt')).st_ino
+        assert os.path.isdir(os.path.join(directory, 'col'))
+        assert entries[b'http://localhost/dangling'] is None
+        assert list(dc.get_child_entries(b'/file.txt')) == []
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_ctags():
+    directory = tempfile.mkdtemp()
+    store = tempfile.mkdtemp()
+    try:
+        def ctags():
+            return dict((uri, dc.get_prop(uri, CS_NS, 'getctag'))
+                        for uri in (b'/', b'/a', b'/a/b', b'/c'))
+
+        dc = FilesystemHandler(directory, 'http://localhost/')
+        dc.ctags = CTagStore(directory, os.path.join(store, 'ctags.db'))
+        for uri in b'/a', b'/a/b', b'/c':
+            dc.mkcol(uri)
+        before = ctags()
+
+        # bumped along the ancestor chain only
+        dc.put(b'/a/b/file.txt', b'content')
+        after = ctags()
+        assert [after[uri] != before[uri] for uri in sorted(after)] == [
+            True, True, True, False]
+        assert ctags() == after
+        with pytest.raises(DAV_NotFound):
+            dc.get_prop(b'/a/b/file.txt', CS_NS, 'getctag')
+
+        # changed outside the server, seen through the mtime, which also
+        # bumps the ancestors
+        os.mkdir(os.path.join(directory, 'a', 'b', 'd'))
+        assert dc.get_prop(b'/a/b', CS_NS, 'getctag') != after[b'/a/b']
+        changed = ctags()
+        assert [changed[uri] != after[uri] for uri in sorted(after)] == [
+            True, True, True, False]
+        after = changed
+
+        # only listed where it can be answered
+        assert CS_NS in dc.get_propnames(b'/a')
+        assert CS_NS not in dc.get_propnames(b'/a/b/file.txt')
+
+        # removed and created again
+        dc.rmcol(b'/a/b')
+        dc.mkcol(b'/a/b')
+        assert ctags()[b'/a/b'] not in (before[b'/a/b'], after[b'/a/b'])
+        after = ctags()
+
+        # kept across restarts
+        dc.ctags.close()
+        dc.ctags = CTagStore(directory, os.path.join(store, 'ctags.db'))
+        assert ctags() == after
+        dc.ctags.close()
+        dc.ctags = None
+        assert CS_NS not in dc.get_propnames(b'/a')
+    finally:
+        shutil.rmtree(directory)
+        shutil.rmtree(store)
+
+
+def test_rm_missing():
+    directory = tempfile.mkdtemp()
+    try:
+        dc = FilesystemHandler(directory, 'http://localhost/')
+        dc.put(b'/file.txt', b'content')
+        dc.mkcol(b'/col')
+        assert dc.rm(b'/file.txt') == 204
+        assert dc.rmcol(b'/col') == 204
+        for method in dc.rm, dc.rmcol:
+            with pytest.raises(DAV_NotFound):
+                method(b'/file.txt')
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,45 @@
+import gzip
+import shutil
+import tempfile
+
+import requests
+
+from pywebdav.server.fileauth import DAVAuthHandler
+from .conftest import pywebdav_server_runner, PORT
+
+
+def test_gzip_variants():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for url, user, password in pywebdav_server_runner(
+                PORT + 4, gzip_static=1, gzip_cache_dir=cache_dir):
+            cache = DAVAuthHandler.IFACE_CLASS.gzip_cache
+            auth = (user, password)
+            headers = {'Accept-Encoding': 'gzip'}
+
+            content = b''.join(b'line %d\n' % i for i in range(10000))
+            requests.put(url + '/text.txt', data=content, auth=auth)
+            for i in range(3):
+                ret = requests.get(url + '/text.txt', auth=auth,
+                                   headers=headers)
+                assert ret.headers['Content-Encoding'] == 'gzip'
+                assert ret.content == content
+            assert (cache.misses, cache.hits) == (1, 2)
+
+            # a modified file is compressed again
+            requests.put(url + '/text.txt', data=content * 2, auth=auth)
+            ret = requests.get(url + '/text.txt', auth=auth, headers=headers)
+            assert ret.content == content * 2
+            assert cache.misses == 2
+            assert cache.stats()['entries'] == 1
+
+            # an up to date foo.gz is served as it is
+            requests.put(url + '/static.txt', data=content, auth=auth)
+            requests.put(url + '/static.txt.gz', auth=auth,
+                         data=gzip.compress(b'precompressed' * 200))
+            ret = requests.get(url + '/static.txt', auth=auth,
+                               headers=headers)
+            assert ret.content == b'precompressed' * 200
+            assert cache.misses == 2
+    finally:
+        shutil.rmtree(cache_dir, True)
@@ -0,0 +1,72 @@
+from xml.dom import minidom
+
+from pywebdav.lib.errors import DAV_NotFound
+from pywebdav.lib.iface import dav_interface
+from pywebdav.lib.locks import LockItem
+
+
+class Interface(dav_interface):
+
+    M_NS = {'DAV:': '_get_dav',
+            'urn:x': 'x'}
+
+    def _get_dav_displayname(self, uri):
+        return 'name'
+
+    def x_some_prop(self, uri):
+        return uri
+
+
+def test_prop_dispatch():
+    dc = Interface()
+    assert dc.get_prop(b'/', 'DAV:', 'displayname') == 'name'
+    assert dc.get_prop(b'/a', 'urn:x', 'some-prop') == b'/a'
+    assert dc.get_prop(b'/a', 'urn:x', 'some_prop') == b'/a'
+    assert dc.prop_method('DAV:', 'supportedlock') is not None
+    for ns, prop in (('DAV:', 'unknown'), ('urn:y', 'displayname'),
+                     ('urn:x', 'displayname')):
+        assert dc.prop_method(ns, prop) is None
+        try:
+            dc.get_prop(b'/', ns, prop)
+        except DAV_NotFound:
+            pass
+        else:
+            assert False, (ns, prop)
+
+    # changes to an instance take effect once recompiled
+    dc.M_NS = dict(dc.M_NS, **{'urn:z': 'x'})
+    dc._compile_prop_dispatch()
+    assert dc.get_prop(b'/b', 'urn:z', 'some-prop') == b'/b'
+
+
+def test_static_prop_fragments():
+    dc = Interface()
+    supportedlock = dc.get_prop(b'/', 'DAV:', 'supportedlock')
+    assert supportedlock is dc.get_prop(b'/other', 'DAV:', 'supportedlock')
+    assert supportedlock.toxml() == (
+        '<D:lockentry>\n'
+        '<D:lockscope><D:exclusive/></D:lockscope>\n'
+        '<D:locktype><D:write/></D:locktype>\n'
+        '</D:lockentry>')
+
+    # every response of a document gets the markup
+    doc = minidom.getDOMImplementation().createDocument(None, 'ms', None)
+    for i in range(2):
+        prop = doc.createElement('D:supportedlock')
+        prop.appendChild(supportedlock.node(doc))
+        doc.documentElement.appendChild(prop)
+    assert doc.documentElement.toxml().count(supportedlock.toxml()) == 2
+
+    # the minidom element the property used to be
+    element = supportedlock.element()
+    assert element.tagName == 'D:lockentry'
+    assert element.getElementsByTagName('D:exclusive')
+    assert element is not supportedlock.element()
+
+    lock = LockItem(b'/locked', 'me', 'owner', timeout=60)
+    fragment = lock.discoveryFragment()
+    assert fragment is lock.discoveryFragment()
+    assert '<D:timeout>Second-60</D:timeout>' in fragment.toxml()
+    lock.setTimeout(120)
+    assert '<D:timeout>Second-120</D:timeout>' in \
+        lock.discoveryFragment().toxml()
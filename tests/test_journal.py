@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from pywebdav.server import journal
+from pywebdav.server.journal import ChangeJournal, InvalidToken
+
+
+def test_changes():
+    j = ChangeJournal(max_entries=3)
+    start = j.token()
+    j.record('/dir/a')
+    j.record('/dir/sub/b')
+    j.record('/other/c')
+    j.record('/dir/a', deleted=True)
+
+    token, changes, truncated = j.changes(start, '/dir')
+    assert changes == [('/dir/a', True)]
+    assert not truncated
+    assert j.changes(start, '/dir', infinite=True)[1] == [
+        ('/dir/sub/b', False), ('/dir/a', True)]
+    assert j.changes(token, '/dir', infinite=True)[1] == []
+
+    # the token continues after the last change returned
+    token, changes, truncated = j.changes(start, '/dir', True, limit=1)
+    assert changes == [('/dir/sub/b', False)]
+    assert truncated
+    assert j.changes(token, '/dir', True)[1] == [('/dir/a', True)]
+
+    # the change of /dir/sub/b is dropped, the tokens before it are too old
+    j.record('/dir/d')
+    j.record('/dir/e')
+    with pytest.raises(InvalidToken):
+        j.changes(start, '/dir')
+    for bad in ('', 'http://example.com/1', j.token() + '1'):
+        with pytest.raises(InvalidToken):
+            j.changes(bad, '/dir')
+
+
+def test_shared_file(monkeypatch):
+    monkeypatch.setattr(journal, '_COMPACT_MIN', 4)
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'journal')
+        first = ChangeJournal(path=path)
+        second = ChangeJournal(path=path)
+        start = second.token()
+        assert first.token() == start
+
+        for i in range(10):
+            first.record('/dir/a')
+        second.record('/dir/b')
+        assert first.changes(start, '/dir')[1] == [
+            ('/dir/a', False), ('/dir/b', False)]
+
+        # compacted, the other journal reloads the file
+        with open(path) as fp:
+            assert len(fp.readlines()) < 12
+        first.record('/dir/c', deleted=True)
+        assert second.changes(start, '/dir')[1] == [
+            ('/dir/a', False), ('/dir/b', False), ('/dir/c', True)]
+        first.close()
+        second.close()
+
+        # kept across restarts
+        third = ChangeJournal(path=path)
+        assert len(third.changes(start, '/dir')[1]) == 3
+        third.close()
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,104 @@
+import threading
+
+from pywebdav.lib.locks import LockItem, LockManager, LockTable
+from pywebdav.lib.utils import parse_timeout
+from pywebdav.server.server import setupDummyConfig
+
+
+def test_lock_table():
+    table = LockTable(stripes=4)
+    manager = LockManager()
+    manager.lock_table = table
+
+    # racing requests for the same resource, only one gets it
+    barrier = threading.Barrier(8)
+    granted = []
+
+    def lock(uri):
+        item = LockItem(uri, 'test', lockowner='')
+        barrier.wait()
+        if manager._l_acquireLock(item):
+            granted.append(item)
+
+    threads = [threading.Thread(target=lock, args=('/same',))
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(granted) == 1
+    assert manager._l_getLockForUri('/same') is granted[0]
+    assert manager._l_getLock(granted[0].token) is granted[0]
+    assert table.stats()['conflicts'] == 7
+
+    for i in range(100):
+        assert manager._l_acquireLock(LockItem('/file%d' % i, 'test', ''))
+    stats = table.stats()
+    assert stats['locks'] == 101
+    assert stats['changes'] == 108
+
+    manager._l_delLock(granted[0].token)
+    assert not manager._l_isLocked('/same')
+    assert not manager._l_hasLock(granted[0].token)
+    assert table.release(granted[0].token) is None
+    assert table.stats()['locks'] == 100
+
+
+def test_lock_expiry():
+    now = [1000.0]
+    table = LockTable(stripes=2, clock=lambda: now[0])
+
+    held = LockItem('/held', 'test', '', timeout='Second-100')
+    short = LockItem('/short', 'test', '', timeout='Infinite, Second-10')
+    forever = LockItem('/forever', 'test', '', timeout='Infinite')
+    assert (held.timeout, short.timeout, forever.timeout) == (100, None, None)
+    short.setTimeout('Second-10')
+    for lock in held, short, forever:
+        assert table.acquire(lock)
+    assert short.getTimeoutString() == 'Second-10'
+
+    # expired locks are absent before they are removed
+    now[0] += 50
+    assert table.get(short.token) is None
+    assert table.get_for_uri('/short') is None
+    assert table.tokens[short.token] is short
+    assert table.refresh(held, 100)
+
+    # and free for others
+    again = LockItem('/short', 'test', '', timeout=10)
+    assert table.acquire(again)
+    assert short.token not in table.tokens
+
+    now[0] += 90
+    table.expire()
+    assert again.token not in table.tokens
+    stats = table.stats()
+    assert stats['locks'] == 2
+    assert stats['expired'] == 2
+    assert stats['expiry_rate'] == 2 / 140.0
+    assert table.get(held.token) is held
+    assert table.get(forever.token) is forever
+
+    # the heaps do not keep the entries of released locks
+    for i in range(1000):
+        lock = LockItem('/churn', 'test', '', timeout=1000)
+        assert table.acquire(lock)
+        table.release(lock.token)
+    assert sum(len(heap) for heap in table._heaps) < 200
+
+
+def test_parse_timeout():
+    assert parse_timeout(None) is None
+    assert parse_timeout('Infinite') is None
+    assert parse_timeout('Second-4100000000') == 4100000000
+    assert parse_timeout('Extend-1, second-60, Infinite') == 60
+    assert parse_timeout('Second-x') is None
+
+
+def test_lock_timeout():
+    manager = LockManager()
+    manager._config = setupDummyConfig(lock_max_timeout=3600)
+    for header, timeout in (('Second-0', 1), ('Second-60', 60),
+                            ('Second-7200', 3600), ('Infinite', 3600)):
+        manager.headers = {'Timeout': header}
+        assert manager._lock_timeout() == timeout
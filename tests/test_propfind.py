@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import time
+
+import pytest
+
+from pywebdav.lib.errors import DAV_Forbidden, DAV_NotFound
+from pywebdav.lib.propfind import PROPFIND
+from pywebdav.server.fshandler import FilesystemHandler
+
+
+class FailingHandler(FilesystemHandler):
+    """ fails to list the collections and answer the files named x """
+
+    def get_child_entries(self, uri):
+        if uri.endswith(b'/x'):
+            raise DAV_NotFound
+        return FilesystemHandler.get_child_entries(self, uri)
+
+    def get_props(self, uri, ns_props, st=None):
+        if uri.endswith(b'/x.txt'):
+            raise DAV_Forbidden
+        return FilesystemHandler.get_props(self, uri, ns_props, st)
+
+
+def test_propfind_stream_errors():
+    directory = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(directory, 'x'))
+        for name in 'a.txt', 'x.txt':
+            with open(os.path.join(directory, name), 'wb') as fp:
+                fp.write(b'content')
+
+        dc = FailingHandler(directory, 'http://localhost/')
+        dc.mimecheck = True
+        dc.baseurl = ''
+
+        # the members which fail are answered with their status
+        body = b''.join(PROPFIND(b'http://localhost/', dc, 'infinity',
+                                 None).createResponseStream())
+        assert body.endswith(b'</D:multistatus>')
+        assert body.count(b'<D:response') == 4
+        assert (b'<D:href>http://localhost/x</D:href><D:status>'
+                b'HTTP/1.1 404 Not Found</D:status>') in body
+        assert (b'<D:href>http://localhost/x.txt</D:href><D:status>'
+                b'HTTP/1.1 403 Forbidden</D:status>') in body
+        assert b'<D:getcontentlength>7</D:getcontentlength>' in body
+
+        # the request URI fails before anything is sent
+        with pytest.raises(DAV_NotFound):
+            PROPFIND(b'http://localhost/x', dc, '1',
+                     None).createResponseStream()
+    finally:
+        shutil.rmtree(directory)
+
+
+class SlowPROPFIND(PROPFIND):
+    """ takes long to list the entries before the page """
+
+    def iter_entries(self):
+        for number in range(10):
+            if number < self.offset:
+                time.sleep(0.02)
+            yield b'/%d' % number, None
+
+
+def test_propfind_page_skip():
+    dc = FilesystemHandler(tempfile.gettempdir(), 'http://localhost/')
+    pf = SlowPROPFIND(b'/', dc, 'infinity', None, offset=5)
+    pf.max_responses = 3
+    pf.time_limit = 0.05
+    # the skipping does not use up the time of the page
+    assert [uri for uri, st in pf.iter_page()] == [b'/5', b'/6', b'/7']
+    assert pf.continuation == 8
+
+    pf = SlowPROPFIND(b'/', dc, 'infinity', None, offset=10)
+    assert list(pf.iter_page()) == []
+    assert pf.continuation is None
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+
+from pywebdav.lib.errors import DAV_NotFound
+from pywebdav.lib.report import REPORT
+from pywebdav.server.fshandler import FilesystemHandler
+
+BODY = (b'<?xml version="1.0"?><D:expand-property xmlns:D="DAV:"><D:prop>'
+        b'<D:getcontentlength/></D:prop></D:expand-property>')
+
+
+class CountingHandler(FilesystemHandler):
+    """ counts the directory listings """
+
+    listings = 0
+
+    def get_child_entries(self, uri):
+        self.listings += 1
+        return FilesystemHandler.get_child_entries(self, uri)
+
+
+class FilteringHandler(FilesystemHandler):
+    """ hides the files starting with x from REPORTs in get_childs() """
+
+    def get_childs(self, uri, filter=None):
+        childs = FilesystemHandler.get_childs(self, uri, filter)
+        if filter is not None:
+            childs = [child for child in childs
+                      if not child.split(b'/')[-1].startswith(b'x')]
+        return childs
+
+
+def test_report_walks_once():
+    directory = tempfile.mkdtemp()
+    try:
+        paths = ['a', 'a/b', 'a/b/c']
+        names = ['f%d' % i for i in range(20)] + ['x0', 'x1']
+        for path in paths:
+            os.mkdir(os.path.join(directory, path))
+            for name in names:
+                with open(os.path.join(directory, path, name), 'wb') as fp:
+                    fp.write(b'content')
+
+        base = b'http://localhost/a'
+
+        def report(dc, depth, uri=base):
+            rp = REPORT(uri, dc, depth, BODY)
+            return sorted(uri for uri, st in rp.iter_entries())
+
+        def files(*names):
+            return [b'http://localhost/' + path.encode() + b'/' +
+                    name.encode() for path in paths for name in names]
+
+        # the filesystem does not filter, each directory is scanned once
+        dc = CountingHandler(directory, 'http://localhost/')
+        found = report(dc, 'infinity')
+        assert found == sorted([base, base + b'/b', base + b'/b/c'] +
+                               files(*names))
+        # the parent of a, then a, b and c once each
+        assert dc.listings == 4
+
+        # an interface class filtering in get_childs(uri, filter)
+        dc = FilteringHandler(directory, 'http://localhost/')
+        dc.mimecheck = True
+        dc.baseurl = ''
+        found = report(dc, 'infinity')
+        assert found == sorted([base, base + b'/b', base + b'/b/c'] +
+                               files(*names[:20]))
+        assert report(dc, '0') == [base]
+        assert report(dc, '0', base + b'/x0') == []
+        assert len(report(dc, '1')) == 22
+
+        body = b''.join(REPORT(base, dc, '1', BODY).createResponseStream())
+        assert body.count(b'<D:getcontentlength>7</D:getcontentlength>') == 20
+
+        # a member collection which can not be listed is answered with
+        # its status
+        def get_child_entries(uri):
+            if uri.endswith(b'/b'):
+                raise DAV_NotFound
+            return FilteringHandler.get_child_entries(dc, uri)
+        dc.get_child_entries = get_child_entries
+        body = b''.join(REPORT(base, dc, 'infinity',
+                               BODY).createResponseStream())
+        assert body.endswith(b'</D:multistatus>')
+        assert (b'<D:href>http://localhost/a/b</D:href><D:status>'
+                b'HTTP/1.1 404 Not Found</D:status>') in body
+    finally:
+        shutil.rmtree(directory)
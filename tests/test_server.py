@@ -1,7 +1,250 @@
+import gzip
+import base64
 import requests
+from six.moves import http_client, urllib
 
 
 def test_connection(pywebdav_server):
     url, user, password = pywebdav_server
     ret = requests.get(url=url, auth=(user, password))
     assert ret.status_code // 100 == 2
+
+
+def test_keepalive(pywebdav_server):
+    url, user, password = pywebdav_server
+    parts = urllib.parse.urlparse(url)
+    auth = base64.b64encode(('%s:%s' % (user, password)).encode()).decode()
+    conn = http_client.HTTPConnection(parts.hostname, parts.port)
+    try:
+        conn.request('GET', '/', headers={'Authorization': 'Basic ' + auth})
+        ret = conn.getresponse()
+        ret.read()
+        assert ret.getheader('Connection') == 'Keep-Alive'
+        sock = conn.sock
+
+        conn.request('GET', '/', headers={'Authorization': 'Basic ' + auth})
+        ret = conn.getresponse()
+        ret.read()
+        assert ret.status == 200
+        assert conn.sock is sock
+    finally:
+        conn.close()
+
+
+def test_get_file(pywebdav_server):
+    url, user, password = pywebdav_server
+    content = bytes(bytearray(range(256))) * 1024
+    ret = requests.put(url + '/data.bin', data=content, auth=(user, password))
+    assert ret.status_code == 201
+
+    headers = {'Accept-Encoding': 'identity'}
+    ret = requests.get(url + '/data.bin', auth=(user, password),
+                       headers=headers)
+    assert ret.status_code == 200
+    assert ret.content == content
+
+    headers['Range'] = 'bytes=1000-'
+    ret = requests.get(url + '/data.bin', auth=(user, password),
+                       headers=headers)
+    assert ret.status_code == 206
+    assert ret.content == content[1000:]
+
+
+def test_get_gzip(pywebdav_server):
+    url, user, password = pywebdav_server
+    content = b''.join(b'line %d of a text file\n' % i for i in range(50000))
+    for name in 'text.txt', 'image.jpg':
+        ret = requests.put(url + '/' + name, data=content,
+                           auth=(user, password))
+        assert ret.status_code == 201
+
+    headers = {'Accept-Encoding': 'gzip, deflate'}
+    ret = requests.get(url + '/text.txt', auth=(user, password),
+                       headers=headers, stream=True)
+    assert ret.headers['Content-Encoding'] == 'gzip'
+    assert ret.headers['Transfer-Encoding'] == 'chunked'
+    assert 'Content-Length' not in ret.headers
+    compressed = ret.raw.read(decode_content=False)
+    assert len(compressed) < len(content) // 4
+    assert gzip.decompress(compressed) == content
+    # the compressed bytes have their own strong validator
+    etag = ret.headers['ETag']
+    identity = requests.head(url + '/text.txt', auth=(user, password),
+                             headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in identity.headers
+    assert etag == identity.headers['ETag'][:-1] + '-gzip"'
+
+    # revalidating the compressed response
+    ret = requests.get(url + '/text.txt', auth=(user, password),
+                       headers={'Accept-Encoding': 'gzip',
+                                'If-None-Match': etag})
+    assert ret.status_code == 304
+    assert ret.headers['ETag'] == etag
+    ret = requests.get(url + '/text.txt', auth=(user, password),
+                       headers={'Accept-Encoding': 'gzip',
+                                'If-None-Match': 'W/' + etag})
+    assert ret.status_code == 304
+    ret = requests.get(url + '/text.txt', auth=(user, password),
+                       headers={'Accept-Encoding': 'identity',
+                                'If-None-Match': etag})
+    assert ret.status_code == 200
+
+    ret = requests.get(url + '/image.jpg', auth=(user, password),
+                       headers=headers)
+    assert 'Content-Encoding' not in ret.headers
+    assert ret.content == content
+
+
+def test_get_ranges(pywebdav_server):
+    url, user, password = pywebdav_server
+    auth = (user, password)
+    content = bytes(bytearray(range(256))) * 64
+    requests.put(url + '/ranges.bin', data=content, auth=auth)
+
+    ret = requests.get(url + '/ranges.bin', auth=auth,
+                       headers={'Range': 'bytes=-500'})
+    assert ret.status_code == 206
+    assert ret.headers['Content-Range'] == 'bytes 15884-16383/16384'
+    assert ret.content == content[-500:]
+
+    ret = requests.get(url + '/ranges.bin', auth=auth,
+                       headers={'Range': 'bytes=0-99,50-149,1000-1099'})
+    assert ret.status_code == 206
+    ctype, boundary = ret.headers['Content-Type'].split('; boundary=')
+    assert ctype == 'multipart/byteranges'
+    parts = ret.content.split(b'--' + boundary.encode())
+    assert parts[-1] == b'--\r\n'
+    assert len(parts) == 4
+    for part, (first, last) in zip(parts[1:3], [(0, 149), (1000, 1099)]):
+        head, body = part.split(b'\r\n\r\n', 1)
+        assert b'Content-Range: bytes %d-%d/16384' % (first, last) in head
+        assert body == content[first:last + 1] + b'\r\n'
+
+    ret = requests.get(url + '/ranges.bin', auth=auth,
+                       headers={'Range': 'bytes=0-99',
+                                'If-Range': 'Sat, 01 Jan 2000 00:00:00 GMT'})
+    assert ret.status_code == 200
+    assert ret.content == content
+
+    ret = requests.get(url + '/ranges.bin', auth=auth,
+                       headers={'Range': 'bytes=20000-'})
+    assert ret.status_code == 416
+    assert ret.headers['Content-Range'] == 'bytes */16384'
+
+
+def test_conditional_requests(pywebdav_server):
+    url, user, password = pywebdav_server
+    auth = (user, password)
+    requests.put(url + '/cond.txt', data=b'content', auth=auth)
+    ret = requests.get(url + '/cond.txt', auth=auth)
+    last_modified = ret.headers['Last-Modified']
+    past = 'Sat, 01 Jan 2000 00:00:00 GMT'
+
+    for method in requests.get, requests.head:
+        ret = method(url + '/cond.txt', auth=auth,
+                     headers={'If-Modified-Since': last_modified})
+        assert ret.status_code == 304
+        assert ret.headers['Last-Modified'] == last_modified
+        assert ret.content == b''
+
+    ret = requests.get(url + '/cond.txt', auth=auth,
+                       headers={'If-Modified-Since': past})
+    assert ret.status_code == 200
+    assert ret.content == b'content'
+
+    ret = requests.put(url + '/cond.txt', data=b'new', auth=auth,
+                       headers={'If-Unmodified-Since': past})
+    assert ret.status_code == 412
+    ret = requests.delete(url + '/cond.txt', auth=auth,
+                          headers={'If-Unmodified-Since': past})
+    assert ret.status_code == 412
+    ret = requests.delete(url + '/cond.txt', auth=auth,
+                          headers={'If-Unmodified-Since': last_modified})
+    assert ret.status_code == 204
+
+
+def test_etags(pywebdav_server):
+    url, user, password = pywebdav_server
+    auth = (user, password)
+    ret = requests.put(url + '/tagged.txt', data=b'first', auth=auth)
+    etag = ret.headers['ETag']
+    assert etag.startswith('"') and etag.endswith('"')
+
+    ret = requests.get(url + '/tagged.txt', auth=auth)
+    assert ret.headers['ETag'] == etag
+    ret = requests.request('PROPFIND', url + '/tagged.txt', auth=auth,
+                           headers={'Depth': '0'})
+    assert ('<D:getetag>%s</D:getetag>' % etag) in ret.text.replace(
+        '&quot;', '"')
+
+    ret = requests.get(url + '/tagged.txt', auth=auth,
+                       headers={'If-None-Match': etag})
+    assert ret.status_code == 304
+
+    ret = requests.put(url + '/tagged.txt', data=b'second', auth=auth,
+                       headers={'If-Match': etag})
+    assert ret.status_code == 201
+    assert ret.headers['ETag'] != etag
+    ret = requests.put(url + '/tagged.txt', data=b'third', auth=auth,
+                       headers={'If-Match': etag})
+    assert ret.status_code == 412
+
+
+def test_propfind_stream(pywebdav_server):
+    url, user, password = pywebdav_server
+    auth = (user, password)
+    requests.request('MKCOL', url + '/tree', auth=auth)
+    names = ['file%d.txt' % i for i in range(20)]
+    for name in names:
+        requests.put(url + '/tree/' + name, data=name.encode(), auth=auth)
+
+    ret = requests.request('PROPFIND', url + '/tree', auth=auth,
+                           headers={'Depth': '1'}, stream=True)
+    assert ret.status_code == 207
+    assert ret.headers['Transfer-Encoding'] == 'chunked'
+    body = ret.content
+    assert body.startswith(b'<?xml version="1.0" encoding="utf-8"?>'
+                           b'<D:multistatus xmlns:D="DAV:"><D:response')
+    assert body.endswith(b'</D:response></D:multistatus>\n')
+    assert body.count(b'<D:response') == len(names) + 1
+    for name in names:
+        assert ('/tree/%s</D:href>' % name).encode() in body
+
+    # HTTP/1.0 clients get the same document with a length
+    parts = urllib.parse.urlparse(url)
+    conn = http_client.HTTPConnection(parts.hostname, parts.port)
+    conn._http_vsn, conn._http_vsn_str = 10, 'HTTP/1.0'
+    token = base64.b64encode(('%s:%s' % auth).encode()).decode()
+    try:
+        conn.request('PROPFIND', '/tree', headers={
+            'Depth': '1', 'Authorization': 'Basic ' + token})
+        ret = conn.getresponse()
+        assert int(ret.getheader('Content-Length')) == len(body)
+        assert ret.read() == body
+    finally:
+        conn.close()
+
+
+def test_propfind_return_minimal(pywebdav_server):
+    url, user, password = pywebdav_server
+    auth = (user, password)
+    requests.put(url + '/minimal.txt', data=b'x', auth=auth)
+    body = ('<?xml version="1.0"?><D:propfind xmlns:D="DAV:" xmlns:X="urn:x">'
+            '<D:prop><D:getcontentlength/><X:missing/></D:prop>'
+            '</D:propfind>')
+
+    ret = requests.request('PROPFIND', url + '/minimal.txt', auth=auth,
+                           data=body, headers={'Depth': '0'})
+    assert ret.status_code == 207
+    assert 'Preference-Applied' not in ret.headers
+    assert b'404 Not Found' in ret.content
+
+    ret = requests.request('PROPFIND', url + '/minimal.txt', auth=auth,
+                           data=body, headers={
+                               'Depth': '0',
+                               'Prefer': 'respond-async, return=minimal'})
+    assert ret.status_code == 207
+    assert ret.headers['Preference-Applied'] == 'return=minimal'
+    assert b'404 Not Found' not in ret.content
+    assert b'missing' not in ret.content
+    assert b'<D:getcontentlength>1</D:getcontentlength>' in ret.content
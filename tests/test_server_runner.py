@@ -1,5 +1,254 @@
-from .conftest import pywebdav_server_runner
+import os
+import sys
+import base64
+import signal
+import logging
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+from xml.dom import minidom
+
+import pytest
+import requests
+
+from .conftest import pywebdav_server_runner, HOST, PORT
+from pywebdav.lib.locks import LockItem, LockTable
+from pywebdav.server import prefork
+from pywebdav.server.fileauth import DAVAuthHandler
+from pywebdav.server.fshandler import FilesystemHandler
+from pywebdav.server.gzipcache import GzipCache
+from pywebdav.server.server import PooledHTTPServer, runserver, \
+    setupDummyConfig
+from pywebdav.server.statcache import StatCache
 
 def test_run():
     for val in pywebdav_server_runner():
         print(val)
+
+
+def test_pool_rejects_when_full():
+    for url, user, password in pywebdav_server_runner(
+            PORT + 2, 'pool', workers=1, queue_size=1):
+        address = (HOST, PORT + 2)
+        auth = base64.b64encode(('%s:%s' % (user, password)).encode())
+        request = (b'GET / HTTP/1.1\r\nHost: localhost\r\n'
+                   b'Authorization: Basic ' + auth + b'\r\n\r\n')
+
+        # keeps the only worker busy with a persistent connection
+        busy = socket.create_connection(address)
+        busy.sendall(request)
+        assert busy.recv(4096).startswith(b'HTTP/1.1 200')
+
+        queued = socket.create_connection(address)
+        time.sleep(0.5)
+
+        rejected = socket.create_connection(address)
+        response = rejected.recv(4096)
+        assert response.startswith(b'HTTP/1.1 503')
+        assert b'Retry-After: ' in response
+
+        for sock in busy, queued, rejected:
+            sock.close()
+
+
+@pytest.mark.skipif(not prefork.supported(), reason='needs fork and SO_REUSEPORT')
+def test_prefork_recycles_workers():
+    port = PORT + 3
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, 'file.txt'), 'w') as f:
+        f.write('content')
+
+    process = subprocess.Popen([
+        sys.executable, '-m', 'pywebdav.server.server', '-D', directory,
+        '-H', HOST, '-P', str(port), '-n', '-F', '2', '--max-requests', '3'])
+    try:
+        url = 'http://%s:%d/file.txt' % (HOST, port)
+        for i in range(50):
+            try:
+                requests.get(url)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+
+        # every worker is replaced several times on the way
+        for i in range(20):
+            response = requests.get(url)
+            assert response.status_code == 200
+            assert response.content == b'content'
+    finally:
+        process.send_signal(signal.SIGTERM)
+        assert process.wait(10) == 0
+
+
+def test_propfind_limits():
+    for url, user, password in pywebdav_server_runner(
+            PORT + 6, propfind_depth_infinity=0, propfind_max_responses=4):
+        auth = (user, password)
+        requests.request('MKCOL', url + '/tree', auth=auth)
+        names = ['file%d.txt' % i for i in range(10)]
+        for name in names:
+            requests.put(url + '/tree/' + name, data=b'x', auth=auth)
+
+        ret = requests.request('PROPFIND', url + '/tree', auth=auth)
+        assert ret.status_code == 403
+        assert b'<D:propfind-finite-depth/>' in ret.content
+
+        def pages():
+            """ fetch all pages, return their number and the hrefs """
+            found, number, offset = [], 0, 0
+            while offset is not None:
+                ret = requests.request('PROPFIND', url + '/tree', auth=auth,
+                                       headers={'Depth': '1',
+                                                'Continuation': str(offset)})
+                assert ret.status_code == 207
+                number += 1
+                offset = None
+                doc = minidom.parseString(ret.content)
+                for response in doc.getElementsByTagNameNS('DAV:',
+                                                           'response'):
+                    href = response.getElementsByTagNameNS('DAV:', 'href')
+                    status = response.getElementsByTagNameNS('DAV:', 'status')
+                    if status and '507' in status[-1].firstChild.data:
+                        assert response.getElementsByTagNameNS(
+                            'DAV:', 'number-of-matches-within-limits')
+                        desc = response.getElementsByTagNameNS(
+                            'DAV:', 'responsedescription')[0].firstChild.data
+                        offset = int(desc.split(':')[1])
+                    else:
+                        found.append(href[0].firstChild.data)
+            return number, found
+
+        number, found = pages()
+        assert number == 3
+        assert sorted(found) == sorted(
+            [url + '/tree'] + [url + '/tree/' + name for name in names])
+
+        # at least one response per page however short the time limit
+        DAVAuthHandler._config.DAV.propfind_time_limit = 1e-9
+        assert pages() == (len(names) + 1, found)
+
+        ret = requests.request('PROPFIND', url + '/tree', auth=auth,
+                               headers={'Depth': '1', 'Continuation': '-1'})
+        assert ret.status_code == 400
+
+
+SYNC_COLLECTION = '''<?xml version="1.0" encoding="utf-8"?>
+<D:sync-collection xmlns:D="DAV:">
+  <D:sync-token>%s</D:sync-token>
+  <D:sync-level>1</D:sync-level>
+  <D:prop><D:getetag/></D:prop>
+</D:sync-collection>'''
+
+
+def test_sync_collection():
+    for url, user, password in pywebdav_server_runner(
+            PORT + 7, sync_journal_size=100):
+        auth = (user, password)
+        requests.request('MKCOL', url + '/sync', auth=auth)
+        requests.put(url + '/sync/a.txt', data=b'a', auth=auth)
+        requests.put(url + '/sync/b.txt', data=b'b', auth=auth)
+
+        def sync(token):
+            """ return the answered (href, status) pairs and the new token """
+            ret = requests.request('REPORT', url + '/sync', auth=auth,
+                                   headers={'Depth': '0'},
+                                   data=SYNC_COLLECTION % token)
+            assert ret.status_code == 207
+            doc = minidom.parseString(ret.content)
+            found = []
+            for response in doc.getElementsByTagNameNS('DAV:', 'response'):
+                href = response.getElementsByTagNameNS('DAV:', 'href')[0]
+                status = response.getElementsByTagNameNS('DAV:', 'status')
+                found.append((href.firstChild.data.rsplit('/', 1)[1],
+                              status[-1].firstChild.data.split()[1]))
+            token = doc.getElementsByTagNameNS('DAV:', 'sync-token')[0]
+            return sorted(found), token.firstChild.data
+
+        found, token = sync('')
+        assert found == [('a.txt', '200'), ('b.txt', '200')]
+        assert sync(token) == ([], token)
+
+        requests.put(url + '/sync/c.txt', data=b'c', auth=auth)
+        requests.delete(url + '/sync/a.txt', auth=auth)
+        found, new_token = sync(token)
+        assert found == [('a.txt', '404'), ('c.txt', '200')]
+        assert new_token != token
+
+        ret = requests.request('REPORT', url + '/sync', auth=auth,
+                               headers={'Depth': '0'},
+                               data=SYNC_COLLECTION % (token + '0'))
+        assert ret.status_code == 403
+        assert b'<D:valid-sync-token/>' in ret.content
+
+
+def test_bandwidth_limit():
+    for url, user, password in pywebdav_server_runner(
+            PORT + 8, bandwidth_limit_per_connection=32768):
+        auth = (user, password)
+        data = os.urandom(98304)
+        assert requests.put(url + '/large.bin', data=data,
+                            auth=auth).status_code in (200, 201)
+
+        # a burst of one second, the rest at the configured rate
+        start = time.monotonic()
+        ret = requests.get(url + '/large.bin', auth=auth)
+        elapsed = time.monotonic() - start
+        assert ret.content == data
+        assert 1.8 <= elapsed < 10
+
+
+def test_prefork_lock_warning(caplog):
+    directory = tempfile.mkdtemp()
+    try:
+        for lockemulation, warned in (True, True), (False, False):
+            handler = type('Handler', (DAVAuthHandler, ), {
+                '_config': setupDummyConfig(lockemulation=lockemulation,
+                                            baseurl='')})
+            caplog.clear()
+            with caplog.at_level(logging.WARNING, logger='pywebdav'):
+                server = runserver(0, HOST, directory, handler=handler,
+                                   doserve=False, processes=2)
+            server.server_close()
+            assert ('own lock table' in caplog.text) == warned
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_stats_report(caplog):
+    dc = FilesystemHandler(tempfile.gettempdir(), 'http://localhost/')
+    dc.stat_cache = StatCache(10, 60, inotify=False)
+    cache_dir = tempfile.mkdtemp()
+    dc.gzip_cache = GzipCache(cache_dir)
+    handler = type('Handler', (DAVAuthHandler, ), {
+        '_config': setupDummyConfig(stats_interval=5, workers=2),
+        'IFACE_CLASS': dc})
+    server = PooledHTTPServer((HOST, 0), handler)
+    try:
+        with caplog.at_level(logging.INFO, logger='pywebdav'):
+            server.report_stats(now=0)
+            server.report_stats(now=4)
+            assert 'Server stats' not in caplog.text
+            server.report_stats(now=5)
+        assert 'Server stats' in caplog.text
+        assert "'saturation': 0.0" in caplog.text
+        assert "'idle_connections': 0" in caplog.text
+        assert "'locks': {'locks': " in caplog.text
+        assert "'contention_ratio': " in caplog.text
+        assert "'stat_cache': {'entries': 0" in caplog.text
+        assert "'gzip_cache': {'entries': 0" in caplog.text
+
+        # the reaper removes the expired locks
+        now = [0.0]
+        handler.lock_table = LockTable(clock=lambda: now[0])
+        lock = LockItem('/locked', 'test', '', timeout=10)
+        assert handler.lock_table.acquire(lock)
+        now[0] = 20.0
+        server.expire_locks()
+        assert lock.token not in handler.lock_table.tokens
+        assert handler.lock_table.stats()['expired'] == 1
+    finally:
+        server.server_close()
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,38 @@
+import os
+import shutil
+import tempfile
+
+from pywebdav.lib.snapshot import Snapshot
+from pywebdav.server.fshandler import FilesystemHandler
+
+
+def test_snapshot_looks_up_once():
+    directory = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(directory, 'file.txt'), 'wb') as fp:
+            fp.write(b'content')
+
+        dc = FilesystemHandler(directory, 'http://localhost/')
+        dc.mimecheck = True
+        stats = []
+        os_stat = dc._os_stat
+        dc._os_stat = lambda path: stats.append(path) or os_stat(path)
+
+        res = Snapshot(dc, b'http://localhost/file.txt')
+        etag = res.prop('getetag')
+        assert res.get('getlastmodified')
+        assert res.exists and not res.is_collection
+        assert res.get('getetag') == etag
+        assert len(stats) == 1
+
+        with open(os.path.join(directory, 'file.txt'), 'ab') as fp:
+            fp.write(b' more')
+        res.changed()
+        assert res.get('getetag') != etag
+        assert len(stats) == 2
+
+        missing = Snapshot(dc, b'http://localhost/missing')
+        assert missing.get('getetag') is None
+        assert not missing.exists
+    finally:
+        shutil.rmtree(directory)
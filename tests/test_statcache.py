@@ -0,0 +1,47 @@
+import os
+import time
+
+import requests
+
+from pywebdav.server.fileauth import DAVAuthHandler
+from pywebdav.server.statcache import INOTIFY_AVAILABLE
+from .conftest import pywebdav_server_runner, PORT
+
+
+def test_stat_cache():
+    for url, user, password in pywebdav_server_runner(
+            PORT + 5, stat_cache_size=100, stat_cache_ttl=60):
+        dc = DAVAuthHandler.IFACE_CLASS
+        cache = dc.stat_cache
+        auth = (user, password)
+        try:
+            requests.put(url + '/file.txt', data=b'first', auth=auth)
+            etag = requests.get(url + '/file.txt', auth=auth).headers['ETag']
+            hits = cache.hits
+            ret = requests.get(url + '/file.txt', auth=auth)
+            assert ret.headers['ETag'] == etag
+            assert cache.hits > hits
+
+            # changed by the server
+            requests.put(url + '/file.txt', data=b'second', auth=auth)
+            ret = requests.get(url + '/file.txt', auth=auth)
+            assert ret.content == b'second'
+            assert ret.headers['ETag'] != etag
+
+            # changed behind the back of the server
+            if INOTIFY_AVAILABLE:
+                etag = ret.headers['ETag']
+                with open(os.path.join(dc.directory, 'file.txt'), 'ab') as fp:
+                    fp.write(b' and third')
+                for i in range(50):
+                    ret = requests.get(url + '/file.txt', auth=auth)
+                    if ret.headers['ETag'] != etag:
+                        break
+                    time.sleep(0.1)
+                assert ret.content == b'second and third'
+
+            stats = cache.stats()
+            assert stats['hit_ratio'] > 0
+            assert stats['entries'] <= 100
+        finally:
+            cache.close()
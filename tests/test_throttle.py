@@ -0,0 +1,41 @@
+from pywebdav.lib.throttle import TokenBucket, BandwidthLimiter
+
+
+def test_token_bucket():
+    now = [100.0]
+    bucket = TokenBucket(1000, clock=lambda: now[0])
+
+    # the burst is granted at once, then the debt is paid by waiting
+    assert bucket.reserve(1000) == 0
+    assert bucket.reserve(500) == 0.5
+    now[0] += 0.5
+    assert bucket.reserve(500) == 0.5
+
+    # refilled up to the burst only
+    now[0] += 100
+    assert bucket.reserve(1000) == 0
+    assert bucket.reserve(1) > 0
+
+
+def test_bandwidth_limiter():
+    now = [0.0]
+    assert not BandwidthLimiter()
+    assert BandwidthLimiter().buckets('user', None) == []
+
+    limiter = BandwidthLimiter(3000, 2000, 1000, clock=lambda: now[0])
+    assert limiter
+    connection = limiter.connection_bucket()
+    buckets = limiter.buckets('alice', connection)
+    assert len(buckets) == 3
+    assert buckets[1] is limiter.buckets('alice')[1]
+    assert buckets[1] is not limiter.buckets('bob')[1]
+    # anonymous requests only draw from the global bucket
+    assert limiter.buckets(None) == buckets[:1]
+
+    # the slowest bucket decides
+    delays = [bucket.reserve(3000) for bucket in buckets]
+    assert delays == [0, 0.5, 2.0]
+
+    limiter = BandwidthLimiter(user_rate=1000)
+    assert limiter.connection_bucket() is None
+    assert len(limiter.buckets('alice')) == 1